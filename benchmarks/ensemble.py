@@ -0,0 +1,58 @@
+# Compares simulating an ensemble of parameter sets with solveEnsemble (all members in one vectorized ODE system)
+# against looping solveSystem over the members, on the bundled inputs. Run from the repository root:
+#   python benchmarks/ensemble.py
+
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402 (the inputs are loaded from the inputs directory of the current working directory)
+
+nDays = 90
+ensembleSizes = [1, 4, 16, 64]
+transmissionSpread = 0.2  # members' transmissionInfectionStage is scaled by a random factor within 1 +- this
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    baseParamDict = coexist.build_paramDict(coexist.dydt_Complete)
+    baseParamDict["transitionEngine"] = "fused"
+
+    print(f"\n{nDays} days")
+    print(
+        f"{'members':>7} {'loop (s)':>9} {'ensemble (s)':>13} {'speedup':>8} {'max rel diff':>13}"
+    )
+    for nMembers in ensembleSizes:
+        paramDicts = []
+        for _ in range(nMembers):
+            paramDict = copy.deepcopy(baseParamDict)
+            paramDict["trFunc_newInfections_params"]["transmissionInfectionStage"] = paramDict[
+                "trFunc_newInfections_params"
+            ]["transmissionInfectionStage"] * rng.uniform(
+                1.0 - transmissionSpread, 1.0 + transmissionSpread
+            )
+            paramDicts.append(paramDict)
+
+        startTime = time.perf_counter()
+        loopOut = np.stack(
+            [
+                coexist.solveSystem(coexist.stateTensor_init, nDays, **paramDict)
+                for paramDict in paramDicts
+            ],
+            axis=0,
+        )
+        loopTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        ensemble = coexist.build_ensemble(paramDicts, nDays)
+        ensembleOut = coexist.solveEnsemble(coexist.stateTensor_init, nDays, ensemble)
+        ensembleTime = time.perf_counter() - startTime
+
+        # The members share the solver's time steps, so they only agree within the solver tolerance
+        maxRelDiff = np.max(np.abs(ensembleOut - loopOut)) / np.max(np.abs(loopOut))
+        print(
+            f"{nMembers:7d} {loopTime:9.2f} {ensembleTime:13.2f} {loopTime / ensembleTime:8.1f} {maxRelDiff:13.2e}"
+        )
@@ -0,0 +1,111 @@
+# Times the metapopulation engine (build_metapopulation, solveMetapopulation) on synthetic districts: the population of the
+# default inputs split into regions of random sizes (each with its own input folder, and its share of the absolute inputs
+# and test capacities), each region sending 10% of its contacts to a few random other regions. Run from the repository root:
+#   python benchmarks/metapopulation.py [number of regions] [days] [mobility links per region]
+# e.g. python benchmarks/metapopulation.py 1000 180 5
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402
+
+# Inputs (by input file) and parameters that are absolute numbers, split between the regions by their population
+absoluteInputs = {
+    "sme_input.json": ["agePopulationTotal", "yearly_baseline_admissions", "ageTestingData"],
+    "user_input.json": ["deaths_by_age"],
+}
+absoluteParams = [
+    f"trFunc_testing_params_trFunc_testCapacity_params_testCapacity_{name}_total"
+    for name in ["pcr_phe", "pcr_country", "antibody_country"]
+]
+
+
+def write_regions(root, nRegions, nLinks, seed=0):
+    """
+    Writes the input folders, the regions table and the mobility table of the synthetic regions to root
+    """
+    rng = np.random.default_rng(seed)
+    shares = rng.lognormal(sigma=1.0, size=nRegions)
+    shares /= shares.sum()
+
+    dataDir = os.path.join(os.getcwd(), coexist.data_folder)
+    inputFiles = {}
+    for inputFile in absoluteInputs:
+        with open(f"{dataDir}/{inputFile}") as jf:
+            inputFiles[inputFile] = json.load(jf)
+    defaultTable = coexist.paramDict_toTable(coexist.build_model().paramDict)
+
+    for regionInd, share in enumerate(shares):
+        regionDir = f"{root}/r{regionInd}"
+        shutil.copytree(dataDir, regionDir)
+        for inputFile, names in absoluteInputs.items():
+            regionInput = dict(inputFiles[inputFile])
+            for name in names:
+                regionInput[name] = (np.array(regionInput[name]) * share).tolist()
+            with open(f"{regionDir}/{inputFile}", "w") as jf:
+                json.dump(regionInput, jf)
+
+    regionsTable = pd.DataFrame({"region": [f"d{ii}" for ii in range(nRegions)], "data_dir": [f"r{ii}" for ii in range(nRegions)]})
+    for param in absoluteParams:
+        regionsTable[param] = defaultTable.at[0, param] * shares
+    regionsTable.to_csv(f"{root}/regions.csv", index=False)
+
+    origins = np.repeat(np.arange(nRegions), nLinks)
+    destinations = (origins + rng.integers(1, nRegions, size=origins.size)) % nRegions
+    pd.DataFrame(
+        {
+            "origin": regionsTable["region"].values[origins],
+            "destination": regionsTable["region"].values[destinations],
+            "fraction": 0.1 / nLinks,
+        }
+    ).to_csv(f"{root}/mobility.csv", index=False)
+
+
+if __name__ == "__main__":
+    nRegions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    nDays = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+    nLinks = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    with tempfile.TemporaryDirectory() as root:
+        write_regions(root, nRegions, nLinks)
+
+        startTime = time.perf_counter()
+        regions, regionModels = coexist.load_regionsTable(f"{root}/regions.csv")
+        mobility = coexist.load_mobility(f"{root}/mobility.csv", regions)
+        loadTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        metapopulation = coexist.build_metapopulation(regionModels, nDays, mobility=mobility, regions=regions)
+        buildTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        result = coexist.solveMetapopulation(None, nDays, metapopulation, **coexist.solverPresets["balanced"])
+        solveTime = time.perf_counter() - startTime
+
+        # For comparison: simulating the (uncoupled) regions one by one, estimated from the first few
+        nLooped = min(nRegions, 3)
+        startTime = time.perf_counter()
+        for model in regionModels[:nLooped]:
+            coexist.solveSystem(
+                model.inputs["stateTensor_init"],
+                nDays,
+                **coexist.solverPresets["balanced"],
+                **dict(model.paramDict, transitionEngine="fused"),
+                model=model,
+            )
+        loopTime = (time.perf_counter() - startTime) * nRegions / nLooped
+
+    nStates = coexist.nAge * coexist.nHS * coexist.nIso * coexist.nTest
+    population = result[:, 0, :, :, 0].sum()
+    infected = result[:, 1, :, 1].sum()
+    print(f"\n{nRegions} regions x {nStates} states, {mobility.matrix.nnz - nRegions} mobility links, {nDays} days (balanced preset)")
+    print(f"{'load (s)':>9} {'build (s)':>10} {'solve (s)':>10} {'solveSystem loop (s)':>21} {'infected':>9}")
+    print(f"{loadTime:9.1f} {buildTime:10.1f} {solveTime:10.1f} {loopTime:21.1f} {infected / population:9.1%}")
@@ -0,0 +1,96 @@
+# Compares the output table pipeline (array_to_df + clean_df) with the previous implementation (MultiIndex over all
+# states, stack, groupby and a per-row date conversion), on a result the size of results/UK180days.csv,
+# and times writing and reading it back in each output format (save_output / load_output; Parquet and Feather
+# are skipped if pyarrow is not installed). Run from the repository root:
+#   python benchmarks/output.py
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402
+
+nDays = 180
+nRepeats = 3  # the best of this many runs is reported
+realStartDate = pd.to_datetime("2020-12-14", format="%Y-%m-%d")
+
+
+def legacy_array_to_df(total_days, result):
+    reshape = 2 * coexist.nAge * coexist.nHS * coexist.nIso * coexist.nTest * total_days
+    sim_days = [x + 1 for x in range(total_days)]
+
+    iterables = [
+        coexist.outputArrivalTypes,
+        coexist.outputAgeGroups,
+        coexist.outputHealthStates,
+        coexist.outputIsoStates,
+        coexist.outputTestStates,
+        sim_days,
+    ]
+    index = pd.MultiIndex.from_product(
+        iterables, names=["arrivalType", "ageGroup", "healthState", "isoState", "testState", "simDay"]
+    )
+
+    df = pd.DataFrame(result.reshape(reshape, 1), index=index).stack().reset_index().rename(columns={0: "value"})
+
+    for col in df.columns.to_list():
+        if "level" in col:
+            del df[col]
+
+    return df.groupby(["simDay", "arrivalType", "ageGroup", "healthState"], as_index=False)["value"].sum()
+
+
+def legacy_clean_df(df, realStartDate):
+    df["timestamp"] = df.simDay.apply(lambda x: str((realStartDate + timedelta(days=x)).date()))
+
+    ts = df["timestamp"]
+    df.drop(labels=["timestamp"], axis=1, inplace=True)
+    df.insert(0, "timestamp", ts)
+
+    return df
+
+
+def bestTime(func):
+    times = []
+    for _ in range(nRepeats):
+        startTime = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - startTime)
+
+    return min(times), out
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    result = rng.random((2, coexist.nAge, coexist.nHS, coexist.nIso, coexist.nTest, nDays)) * 1e5
+
+    legacyTime, legacyDf = bestTime(lambda: legacy_clean_df(legacy_array_to_df(nDays, result), realStartDate))
+    newTime, newDf = bestTime(lambda: coexist.clean_df(coexist.array_to_df(nDays, result), realStartDate))
+
+    # The values are summed in a different order, so they only agree to rounding
+    sameIndex = newDf.drop(columns="value").equals(legacyDf.drop(columns="value"))
+    maxRelDiff = np.max(np.abs(newDf["value"] - legacyDf["value"]) / np.abs(legacyDf["value"]))
+
+    print(f"\n{nDays} days, {len(newDf)} rows")
+    print(f"{'previous (s)':>13} {'vectorized (s)':>15} {'speedup':>8} {'same rows':>10} {'max rel diff':>13}")
+    print(f"{legacyTime:13.3f} {newTime:15.4f} {legacyTime / newTime:8.1f} {str(sameIndex):>10} {maxRelDiff:13.2e}")
+
+    print(f"\n{'format':>8} {'write (s)':>10} {'read (s)':>9} {'size (kB)':>10}")
+    with tempfile.TemporaryDirectory() as tempDir:
+        for extension, outputFormat in coexist.outputFormats.items():
+            if outputFormat in ["parquet", "feather"] and importlib.util.find_spec("pyarrow") is None:
+                print(f"{outputFormat:>8} (needs pyarrow)")
+                continue
+            filename = os.path.join(tempDir, f"output{extension}")
+            writeTime, _ = bestTime(
+                lambda: coexist.save_output(filename, newDf, result=result, realStartDate=realStartDate)
+            )
+            readTime, _ = bestTime(lambda: coexist.load_output(filename))
+            print(f"{outputFormat:>8} {writeTime:10.4f} {readTime:9.4f} {os.path.getsize(filename) / 1e3:10.0f}")
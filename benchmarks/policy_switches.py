@@ -0,0 +1,76 @@
+# Compares integrating across the policy switches (the previous solveSystem, one solve_ivp call over all days) with
+# integrating each segment between them separately, with the policies of before its switch (solve_ivpSegments, as
+# solveSystem does now), for intermittent social distancing (on for 30 days every 60 days) and case isolation stopping
+# on day 45: the number of steps, right-hand side evaluations, run time and the max error of the aggregated (per age and
+# health state) outputs, relative to the largest output, compared to the segmented reference preset.
+# Run from the repository root:
+#   python benchmarks/policy_switches.py [days]
+# e.g. python benchmarks/policy_switches.py 180
+
+import contextlib
+import io
+import os
+import sys
+import time
+from datetime import timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402
+
+
+def run(stateTensor_init, nDays, paramDict, switchDays, solverMethod, solverRtol, solverAtol, solverMaxStep):
+    """
+    Aggregated outputs, solver stats and wall time of integrating paramDict, restarting on switchDays
+    """
+    jacobianArgs = coexist.solveSystem_jacobianArgs(solverMethod, "analytic", paramDict)
+    startTime = time.perf_counter()
+    out, solverStats = coexist.solve_ivpSegments(
+        lambda t, y: coexist.dydt_Complete(t, y, **paramDict),
+        np.reshape(np.stack([stateTensor_init, stateTensor_init], axis=0), -1),
+        nDays,
+        switchDays,
+        return_solverStats=True,
+        method=solverMethod,
+        rtol=solverRtol,
+        atol=solverAtol,
+        max_step=solverMaxStep,
+        **jacobianArgs,
+    )
+    wallTime = time.perf_counter() - startTime
+    out = np.sum(np.reshape(out, (2,) + stateTensor_init.shape + (nDays,)), axis=(-3, -2))
+
+    return out, solverStats, wallTime
+
+
+if __name__ == "__main__":
+    nDays = int(sys.argv[1]) if len(sys.argv) > 1 else 180
+
+    model = coexist.build_model()
+    stateTensor_init = model.inputs["stateTensor_init"]
+    realStartDate = model.paramDict["realStartDate"]
+    paramDict = dict(
+        model.paramDict,
+        transitionEngine="fused",
+        tStartSocialDistancing=[realStartDate + timedelta(days=day) for day in range(0, nDays, 60)],
+        tStopSocialDistancing=[realStartDate + timedelta(days=day + 30) for day in range(0, nDays, 60)],
+        tStopQuarantineCaseIsolation=realStartDate + timedelta(days=45),
+    )
+    switchDays = coexist.policyCalendar_switchDays(coexist.paramDict_policyCalendar(paramDict), nDays + 1)
+
+    with contextlib.redirect_stdout(io.StringIO()):  # the progress output
+        reference, _, _ = run(stateTensor_init, nDays, paramDict, switchDays, **coexist.solverPresets["reference"])
+
+    print(f"\n{nDays} days, policies switching on days {switchDays}")
+    print(f"{'preset':>9} {'integration':>12} {'steps':>6} {'nfev':>6} {'time (s)':>9} {'max rel error':>14}")
+    for preset in ["balanced", "fast"]:
+        for name, days in [("across", []), ("segmented", switchDays)]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                out, solverStats, wallTime = run(
+                    stateTensor_init, nDays, paramDict, days, **coexist.solverPresets[preset]
+                )
+            maxRelError = np.max(np.abs(out - reference)) / np.max(np.abs(reference))
+            print(
+                f"{preset:>9} {name:>12} {solverStats['nSteps']:6d} {solverStats['nfev']:6d} {wallTime:9.2f} {maxRelError:14.2e}"
+            )
@@ -0,0 +1,67 @@
+# Compares a session of runs done one after another with solveSystem, and with solveSystem_cached (-cache) starting
+# from an empty cache: a baseline run, what-if runs stopping social distancing on different days of its last third,
+# and the baseline continued for more days. The cached runs resume from the latest day they share with an earlier run.
+# Run from the repository root:
+#   python benchmarks/prefix_cache.py [number of what-if runs] [days]
+# e.g. python benchmarks/prefix_cache.py 8 180
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402
+
+if __name__ == "__main__":
+    nRuns = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    nDays = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+
+    model = coexist.build_model()
+    defaultDict = dict(model.paramDict, transitionEngine="fused")
+    stateTensor_init = model.inputs["stateTensor_init"]
+    stopDays = [nDays * 2 // 3 + ii * (nDays // 3) // nRuns for ii in range(nRuns)]
+    runs = (
+        [("baseline", nDays, defaultDict)]
+        + [
+            (
+                f"stop{day}",
+                nDays,
+                dict(defaultDict, tStopSocialDistancing=defaultDict["realStartDate"] + timedelta(days=day)),
+            )
+            for day in stopDays
+        ]
+        + [("longer", nDays + 60, defaultDict)]
+    )
+
+    print(f"\n{len(runs)} runs: baseline of {nDays} days, social distancing stopping on days {stopDays[0]} ... {stopDays[-1]}, baseline of {nDays + 60} days")
+    print(f"{'preset':>9} {'solveSystem (s)':>16} {'cached (s)':>11} {'speedup':>8} {'identical':>10} {'cache (MB)':>11}")
+    for preset in ["balanced", "fast"]:
+        solverSettings = coexist.solverPresets[preset]
+        with tempfile.TemporaryDirectory() as cacheDir, contextlib.redirect_stdout(io.StringIO()):  # the progress output
+            prefixCache = coexist.open_prefixCache(cacheDir)
+
+            startTime = time.perf_counter()
+            results = [
+                coexist.solveSystem(stateTensor_init, days, **solverSettings, **paramDict) for _, days, paramDict in runs
+            ]
+            uncachedTime = time.perf_counter() - startTime
+
+            startTime = time.perf_counter()
+            cachedResults = [
+                coexist.solveSystem_cached(stateTensor_init, days, prefixCache, **solverSettings, **paramDict)
+                for _, days, paramDict in runs
+            ]
+            cachedTime = time.perf_counter() - startTime
+
+            identical = all(np.array_equal(result, cached) for result, cached in zip(results, cachedResults))
+            cacheSize = sum(entry.stat().st_size for entry in os.scandir(cacheDir)) / 2**20
+
+        print(
+            f"{preset:>9} {uncachedTime:16.1f} {cachedTime:11.1f} {uncachedTime / cachedTime:8.1f} {str(identical):>10} {cacheSize:11.0f}"
+        )
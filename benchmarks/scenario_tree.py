@@ -0,0 +1,56 @@
+# Compares running policy what-if scenarios in full (as -sweep does, here sequentially in one process) with running them
+# as a scenario tree (-sweep with -branch, run_scenarioTree), which simulates their shared history once: the scenarios
+# differ in the day social distancing stops, spread over the last third of the run. Run from the repository root:
+#   python benchmarks/scenario_tree.py [number of scenarios] [days]
+# e.g. python benchmarks/scenario_tree.py 16 180
+
+import contextlib
+import io
+import os
+import sys
+import time
+from datetime import timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402
+
+if __name__ == "__main__":
+    nScenarios = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    nDays = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+
+    model = coexist.build_model()
+    defaultDict = dict(model.paramDict, transitionEngine="fused")
+    stopDays = [nDays * 2 // 3 + ii * (nDays // 3) // nScenarios for ii in range(nScenarios)]
+    sweepTable = pd.DataFrame(
+        {
+            "scenario": [f"stop{day}" for day in stopDays],
+            "tStopSocialDistancing": [
+                str((defaultDict["realStartDate"] + timedelta(days=day)).date()) for day in stopDays
+            ],
+        }
+    )
+
+    print(f"\n{nScenarios} scenarios of {nDays} days, social distancing stopping on days {stopDays[0]} ... {stopDays[-1]}")
+    print(f"{'preset':>9} {'in full (s)':>12} {'tree (s)':>9} {'speedup':>8} {'identical':>10}")
+    for preset in ["balanced", "fast"]:
+        solverSettings = coexist.solverPresets[preset]
+        with contextlib.redirect_stdout(io.StringIO()):  # the progress output
+            startTime = time.perf_counter()
+            inFull = pd.concat(
+                [
+                    coexist.sweep_runScenario(
+                        (scenario, days, model.inputs["stateTensor_init"], paramDict, solverSettings, None)
+                    )[1]
+                    for scenario, days, paramDict in coexist.sweepTable_toParamDicts(sweepTable, defaultDict, nDays)
+                ],
+                ignore_index=True,
+            )
+            inFullTime = time.perf_counter() - startTime
+
+            startTime = time.perf_counter()
+            tree = coexist.run_scenarioTree(sweepTable, defaultDict, nDays, model=model, **solverSettings)
+            treeTime = time.perf_counter() - startTime
+
+        print(f"{preset:>9} {inFullTime:12.1f} {treeTime:9.1f} {inFullTime / treeTime:8.1f} {str(tree.equals(inFull)):>10}")
@@ -0,0 +1,52 @@
+# Compares the explicit RK23 solver (the default) with the implicit solvers using the analytic Jacobian,
+# on the bundled inputs. Run from the repository root:
+#   python benchmarks/solver_methods.py
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402 (the inputs are loaded from the inputs directory of the current working directory)
+
+nDays = 180
+transitionEngine = "fused"
+solverSettings = [
+    ("RK23", None),
+    ("BDF", "analytic"),
+    ("Radau", "analytic"),
+    ("LSODA", "analytic"),
+]
+
+if __name__ == "__main__":
+    paramDict = coexist.build_paramDict(coexist.dydt_Complete)
+    paramDict["transitionEngine"] = transitionEngine
+
+    results = []
+    for solverMethod, solverJacobian in solverSettings:
+        startTime = time.perf_counter()
+        out, solverStats = coexist.solveSystem(
+            coexist.stateTensor_init,
+            nDays,
+            solverMethod=solverMethod,
+            solverJacobian=solverJacobian,
+            return_solverStats=True,
+            **paramDict,
+        )
+        results.append(
+            (solverMethod, solverJacobian, time.perf_counter() - startTime, solverStats, out)
+        )
+
+    reference = results[0][-1]
+    print(f"\n{nDays} days, transitionEngine={transitionEngine!r}")
+    print(
+        f"{'method':8} {'jacobian':9} {'time (s)':>9} {'steps':>6} {'nfev':>6} {'njev':>5} {'nlu':>5} {'max rel diff to RK23':>21}"
+    )
+    for solverMethod, solverJacobian, wallTime, solverStats, out in results:
+        maxRelDiff = np.max(np.abs(out - reference)) / np.max(np.abs(reference))
+        print(
+            f"{solverMethod:8} {str(solverJacobian):9} {wallTime:9.2f} {solverStats['nSteps']:6d} {solverStats['nfev']:6d} "
+            f"{solverStats['njev']:5d} {solverStats['nlu']:5d} {maxRelDiff:21.2e}"
+        )
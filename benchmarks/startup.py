@@ -0,0 +1,53 @@
+# Measures the startup cost of coexist: the time of "python -c 'import coexist'", and of importing it and building
+# the default parameters (which loads the inputs and the heavy packages on first use), for the working tree
+# and optionally for earlier git revisions of coexist.py. Run from the repository root:
+#   python benchmarks/startup.py [git revision ...]
+# e.g. python benchmarks/startup.py HEAD~1
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+nRepeats = 5  # the best of this many runs is reported
+statements = [
+    ("import", "import coexist"),
+    ("import + build_paramDict", "import coexist; coexist.build_paramDict(coexist.dydt_Complete)"),
+]
+
+
+def startupTime(moduleDir, statement):
+    """
+    Best wall time of running statement in a fresh interpreter, importing coexist from moduleDir
+    """
+    # (moduleDir goes before the working directory, which "python -c" puts first on the path)
+    statement = f"import sys; sys.path.insert(0, {moduleDir!r}); {statement}"
+    times = []
+    for _ in range(nRepeats):
+        startTime = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - startTime)
+
+    return min(times)
+
+
+if __name__ == "__main__":
+    # Each revision's coexist.py is imported from a temporary directory, the inputs are always read from the working directory
+    versions = [("working tree", os.getcwd())]
+    tempDir = tempfile.TemporaryDirectory()
+    for revision in sys.argv[1:]:
+        moduleDir = os.path.join(tempDir.name, revision.replace("/", "_").replace("~", "_"))
+        os.makedirs(moduleDir)
+        with open(os.path.join(moduleDir, "coexist.py"), "wb") as f:
+            f.write(subprocess.run(["git", "show", f"{revision}:coexist.py"], check=True, capture_output=True).stdout)
+        versions.append((revision, moduleDir))
+
+    print(f"\n{'version':>14} " + " ".join(f"{name + ' (s)':>28}" for name, _ in statements))
+    for version, moduleDir in versions:
+        print(
+            f"{version:>14} "
+            + " ".join(f"{startupTime(moduleDir, statement):28.3f}" for _, statement in statements)
+        )
+
+    tempDir.cleanup()
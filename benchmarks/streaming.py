@@ -0,0 +1,72 @@
+# Peak memory (of the Python / numpy allocations, measured with tracemalloc) of a single run written with save_output
+# after solveSystem, and written day by day with save_streamedOutput (-stream), for growing numbers of days,
+# and whether the two output files are identical. Run from the repository root:
+#   python benchmarks/streaming.py [days ...]
+# e.g. python benchmarks/streaming.py 90 180 360
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+import coexist  # noqa: E402
+
+outputFormat = "npy"
+
+
+def peakMemory(func):
+    """
+    Wall time and peak traced memory (MB) of func()
+    """
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # the "Sim Day" progress output
+        func()
+    wallTime = time.perf_counter() - startTime
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return wallTime, peak / 1e6
+
+
+if __name__ == "__main__":
+    nDays = [int(days) for days in sys.argv[1:]] or [90, 180, 360]
+    model = coexist.build_model()
+    paramDict = dict(model.paramDict, transitionEngine="fused")
+    realStartDate = paramDict["realStartDate"]
+
+    # Build the cached operators first, so that they are not counted in the first run
+    with contextlib.redirect_stdout(io.StringIO()):
+        coexist.solveSystem(None, 1, model=model, **paramDict)
+
+    print(f"\n{'days':>5} {'in memory (s)':>14} {'peak (MB)':>10} {'streamed (s)':>13} {'peak (MB)':>10} {'same file':>10}")
+    with tempfile.TemporaryDirectory() as tempDir:
+        for days in nDays:
+            inMemoryFile = os.path.join(tempDir, f"inMemory{days}.{outputFormat}")
+            streamedFile = os.path.join(tempDir, f"streamed{days}.{outputFormat}")
+
+            def inMemory():
+                result = coexist.solveSystem(None, days, model=model, **paramDict)
+                coexist.save_output(inMemoryFile, result=result, realStartDate=realStartDate, paramDict=paramDict)
+
+            def streamed():
+                coexist.save_streamedOutput(
+                    streamedFile,
+                    coexist.solveSystem_stream(None, days, model=model, **paramDict),
+                    days,
+                    realStartDate,
+                    paramDict=paramDict,
+                )
+
+            inMemoryTime, inMemoryPeak = peakMemory(inMemory)
+            streamedTime, streamedPeak = peakMemory(streamed)
+            sameFile = np.array_equal(np.load(inMemoryFile), np.load(streamedFile))
+            print(
+                f"{days:5d} {inMemoryTime:14.2f} {inMemoryPeak:10.1f} {streamedTime:13.2f} {streamedPeak:10.1f} {str(sameFile):>10}"
+            )
@@ -29,74 +29,234 @@ SOFTWARE.
 
 # Basic packages
 import numpy as np
-from scipy import integrate, stats, spatial
-from scipy.special import expit, binom
-import pandas as pd
 import copy
 import warnings
 import argparse
+import importlib.util
 
 
 # Building parameter/computation graph
 import inspect
-from collections import OrderedDict
+import functools
+import contextlib
+import contextvars
+from collections import OrderedDict, namedtuple
 
 # OS/filesystem tools
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import random
 import string
 import os
 import shutil
 import sys
 import itertools
+import multiprocessing
+import numbers
 import json
+import hashlib
+import pickle
+import threading
+
+
+def lazy_import(name):
+    """
+    Returns the module name, only actually imported on first attribute access (keeps "import coexist" fast)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+# Heavy packages, imported on first use
+pd = lazy_import("pandas")
+integrate = lazy_import("scipy.integrate")
+optimize = lazy_import("scipy.optimize")
+sparse = lazy_import("scipy.sparse")
+special = lazy_import("scipy.special")
+stats = lazy_import("scipy.stats")
 
 ################### COMMAND LINE RUN
 # $ python3 coexist.py -days=200 -out=stateResults.csv
 
 ################### COMMAND LINE ARGS
 
-parser = argparse.ArgumentParser(description="Get number of days to run simulation")
-parser.add_argument("-days", dest="total_days", type=int, help="Number of days to run simulation")
-parser.add_argument("-out", dest="outfile", type=str, help="Name of output file")
+def build_argParser():
+    """
+    Returns the parser of the command line arguments (see the __main__ section at the bottom)
+    """
+
+    parser = argparse.ArgumentParser(description="Get number of days to run simulation")
+    parser.add_argument("-days", dest="total_days", type=int, help="Number of days to run simulation")
+    parser.add_argument("-out", dest="outfile", type=str, help="Name of output file")
+    parser.add_argument(
+        "-format",
+        dest="outputFormat",
+        type=str,
+        default=None,
+        choices=["csv", "parquet", "feather", "npz", "npy"],
+        help="Format of the output file (default: by its extension, CSV otherwise), see save_output",
+    )
+    parser.add_argument(
+        "-stream",
+        dest="streamOutput",
+        action="store_true",
+        help="Write the output of a single run day by day as it is simulated (csv, parquet or npy), see save_streamedOutput",
+    )
+    parser.add_argument(
+        "-checkpoint",
+        dest="checkpointDays",
+        type=str,
+        default=None,
+        help="Days (comma separated, eg. 100,200) to write checkpoints of a single run at, to <out>_checkpoint_<day>.pkl",
+    )
+    parser.add_argument(
+        "-resume",
+        dest="resumeFile",
+        type=str,
+        default=None,
+        help="Checkpoint file to continue a single run from, for -days days from its day (see solveSystem_stream)",
+    )
+    parser.add_argument(
+        "-cache",
+        dest="cacheDir",
+        type=str,
+        default=None,
+        help="Folder of a cache of simulated states to resume a single run or the -sweep scenarios from (see solveSystem_cached)",
+    )
+    parser.add_argument(
+        "-cacheSize",
+        dest="cacheSize",
+        type=float,
+        default=prefixCacheMaxBytes / 2**20,
+        help="Size (MB) the -cache is kept within, removing the least recently used states",
+    )
+    parser.add_argument(
+        "-engine",
+        dest="transitionEngine",
+        type=str,
+        default="dense",
+        choices=["dense", "sparse", "fused"],
+        help="Numerical engine for the transition rates",
+    )
+    parser.add_argument(
+        "-preset",
+        dest="solverPreset",
+        type=str,
+        default="balanced",
+        choices=["fast", "balanced", "reference"],
+        help="ODE solver settings (see solverPresets)",
+    )
+    parser.add_argument(
+        "-tune",
+        dest="tuneSolver",
+        action="store_true",
+        help="Compare ODE solver settings against the reference preset instead of running the model",
+    )
+    parser.add_argument(
+        "-sweep",
+        dest="sweepFile",
+        type=str,
+        default=None,
+        help="CSV or Parquet table of scenarios (parameter overrides, one row per scenario) to run instead of the default parameters",
+    )
+    parser.add_argument(
+        "-branch",
+        dest="scenarioTree",
+        action="store_true",
+        help="Run the -sweep scenarios as a scenario tree in this process, simulating their shared prefixes once (see run_scenarioTree)",
+    )
+    parser.add_argument(
+        "-workers",
+        dest="nWorkers",
+        type=int,
+        default=None,
+        help="Number of worker processes for -sweep, -sensitivity and -calibrate (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "-blasThreads",
+        dest="blasThreads",
+        type=int,
+        default=1,
+        help="Number of BLAS threads per -sweep, -sensitivity and -calibrate worker process",
+    )
+    parser.add_argument(
+        "-sensitivity",
+        dest="sensitivityFile",
+        type=str,
+        default=None,
+        help="CSV table of parameters (columns param, low, high) to run a global sensitivity analysis of, instead of the model",
+    )
+    parser.add_argument(
+        "-method",
+        dest="sensitivityMethod",
+        type=str,
+        default="sobol",
+        choices=["sobol", "morris"],
+        help="Sensitivity analysis method for -sensitivity",
+    )
+    parser.add_argument(
+        "-samples",
+        dest="sensitivitySamples",
+        type=int,
+        default=64,
+        help="Number of base samples (sobol) or trajectories (morris) for -sensitivity",
+    )
+    parser.add_argument(
+        "-calibrate",
+        dest="observedFile",
+        type=str,
+        default=None,
+        help="CSV table of observed daily admissions and / or deaths to calibrate the -calibrateParams inputs to, instead of running the model",
+    )
+    parser.add_argument(
+        "-calibrateParams",
+        dest="calibrateParamsFile",
+        type=str,
+        default=None,
+        help="CSV table of the inputs to calibrate (columns param, low, high), see calibrationInputs",
+    )
+    parser.add_argument(
+        "-optimizer",
+        dest="optimizer",
+        type=str,
+        default="differential_evolution",
+        help="Optimizer for -calibrate: differential_evolution, L-BFGS-B or a derivative-free scipy.optimize.minimize method",
+    )
+    parser.add_argument(
+        "-maxiter",
+        dest="maxiter",
+        type=int,
+        default=20,
+        help="Maximum number of optimizer iterations for -calibrate",
+    )
+    parser.add_argument(
+        "-regions",
+        dest="regionsFile",
+        type=str,
+        default=None,
+        help="CSV table of regions (columns region, data_dir and parameter overrides) to simulate as coupled regions instead of the model, see load_regionsTable",
+    )
+    parser.add_argument(
+        "-mobility",
+        dest="mobilityFile",
+        type=str,
+        default=None,
+        help="CSV table of the mobility between the -regions (columns origin, destination, fraction), see load_mobility",
+    )
 
-args = parser.parse_args()
+    return parser
 
-total_days = args.total_days
-outfile = args.outfile
 
-# Set Working/Data dirs
-workdir = os.getcwd()
+# Data dir, relative to the working directory (see load_inputs)
 data_folder = "inputs"
-data_dir = f"{workdir}/{data_folder}"
-
-############# Static Input Parameters#############  ref: "baked_in_parameters.ipynb"
-with open(f"{data_dir}/sme_input.json") as jf:
-    sme_input = json.load(jf)
-print(data_dir)
-# Population by Age (0-9, 10-19, ... 70-79, 80+) ref: https://en.wikipedia.org/wiki/Demographics_of_Ethiopia "AGE STRUCTURE"
-agePopulationTotal = np.array(sme_input["agePopulationTotal"])
-agePopulationRatio = agePopulationTotal / np.sum(agePopulationTotal)
-
-## Social Mixing Matrices
-# BASELINE
-ageSocialMixingBaseline = (
-    pd.read_csv(f"{data_dir}/social_mixing_BASELINE.csv", sep=",")
-    .iloc[:, 1:]
-    .values
-)
-ageSocialMixingBaseline = (ageSocialMixingBaseline + ageSocialMixingBaseline.T) / 2.0
-
-# SOCIAL DISTANCING
-ageSocialMixingDistancing = (
-    pd.read_csv(f"{data_dir}/social_mixing_DISTANCE.csv", sep=",")
-    .iloc[:, 1:]
-    .values
-)
-ageSocialMixingDistancing = (
-    ageSocialMixingDistancing + ageSocialMixingDistancing.T
-) / 2.0
 
 # Travel Data Gamma Distribution
 travelMaxTime = 200
@@ -119,120 +279,388 @@ nTest = 4  # Testing states: untested/negative, Virus positive, Antibody positiv
 
 stateTensor = np.zeros((nAge, nHS, nIso, nTest))
 
-### Hospitalization
+# ageRelativeRecoverySpeed = np.array([0.2]*5+[-0.1, -0.2, -0.3, -0.5]) # TODO - this is a guess, find data and fix
+ageRelativeRecoverySpeed = np.array([0.0] * 9)  # For now we make it same for everyone, makes calculations easier
+
+# From coexist model
+# Getting Infected in the Hospital
+elevatedMixingRatioInHospital = 3.0
+
+
+def load_testingData(filename):
+    """
+    Reads the daily number of tests done per age group from a csv file
+    (first column the date in YYYY-MM-DD format, then one column per age group),
+    returns them as a DataFrame indexed by (sorted) date
+    """
+    df = pd.read_csv(filename, sep=",")
+    df.index = pd.to_datetime(df.iloc[:, 0], format="%Y-%m-%d")
+    df = df.iloc[:, 1:].astype(float)
+
+    if df.shape[1] != nAge:
+        raise ValueError(
+            f"{filename} has {df.shape[1]} age group columns, expected {nAge}"
+        )
+    if df.index.duplicated().any():
+        raise ValueError(f"{filename} has more than one row for the same date")
 
-# Hospitalization rate by age: mapped UK to ETH population (see "baked_in_parameters")
-yearly_baseline_admissions = np.array(sme_input["yearly_baseline_admissions"])
-ageHospitalisationRateBaseline = yearly_baseline_admissions / (365 * agePopulationTotal)
+    return df.sort_index()
 
 
-# Average days in the hospital by age
-ageHospitalMeanLengthOfStay = np.array(sme_input["ageHospitalMeanLengthOfStay"])
-ageHospitalisationRecoveryRateBaseline = 1.0 / ageHospitalMeanLengthOfStay
+# ## Model inputs
+#
+# Nothing is read at import time: the input files (sme_input.json, user_input.json, the social mixing matrices
+# and the optional testing_data.csv) are read by load_inputs on first use, and the model constants derived from them
+# are returned as a dict. Default arguments that depend on them are InputDefault placeholders (see inputDefault),
+# replaced by the loaded values in build_paramDict (or by model_aware, when a function is called without them).
+# The inputs of the default data dir are also available as module attributes (eg. coexist.agePopulationTotal),
+# loaded on first access.
+
+# Names of the loaded and derived inputs returned by load_inputs
+inputNames = [
+    "sme_input",
+    "user_input",
+    "agePopulationTotal",
+    "agePopulationRatio",
+    "ageSocialMixingBaseline",
+    "ageSocialMixingDistancing",
+    "yearly_baseline_admissions",
+    "ageHospitalisationRateBaseline",
+    "ageHospitalMeanLengthOfStay",
+    "ageHospitalisationRecoveryRateBaseline",
+    "ageNhsClinicalStaffPopulationRatio",
+    "transmissionInfectionStage",
+    "nDaysInHomeIsolation",
+    "tStartSocialDistancing",
+    "tStopSocialDistancing",
+    "tStartImmunityPassports",
+    "tStopImmunityPassports",
+    "tStartQuarantineCaseIsolation",
+    "tStopQuarantineCaseIsolation",
+    "CONST_DATA_START_DATE",
+    "CONST_DATA_CUTOFF_DATE",
+    "totalCOVIDAdmitted_byAge_regroup",
+    "relativeAdmissionRisk_given_COVID_by_age",
+    "totalDeaths_byAge_regroupLinear",
+    "relativeDeathRisk_given_COVID_by_age",
+    "caseFatalityRatioHospital_given_COVID_by_age",
+    "percent_not_isolating",
+    "percent_isolating_mat",
+    "ageSocialMixingIsolation",
+    "withinHospitalSocialMixing",
+    "initBaselineHospitalOccupancyEquilibriumAgeRatio",
+    "infToHospitalExtra",
+    "riskOfAEAttandance_by_age",
+    "ageRelativeExtraAdmissionRiskToCovid",
+    "symptomHospitalisedRate_ageAdjusted",
+    "testingStartDate",
+    "ageTestingData",
+    "df_CHESS_numTests_regroup",
+    "stateTensor_init",
+]
+
+_inputsCache = {}
+
+
+def load_inputs(data_dir=None):
+    """
+    Reads the input files of data_dir (default: the "inputs" folder of the current working directory),
+    returns the OrderedDict of inputNames -> values. Each data dir is only read once.
+    """
+    if data_dir is None:
+        data_dir = f"{os.getcwd()}/{data_folder}"
+    data_dir = os.path.abspath(data_dir)
+    if data_dir in _inputsCache:
+        return _inputsCache[data_dir]
+
+    ############# Static Input Parameters#############  ref: "baked_in_parameters.ipynb"
+    with open(f"{data_dir}/sme_input.json") as jf:
+        sme_input = json.load(jf)
+    # Population by Age (0-9, 10-19, ... 70-79, 80+) ref: https://en.wikipedia.org/wiki/Demographics_of_Ethiopia "AGE STRUCTURE"
+    agePopulationTotal = np.array(sme_input["agePopulationTotal"])
+    agePopulationRatio = agePopulationTotal / np.sum(agePopulationTotal)
+
+    ## Social Mixing Matrices
+    # BASELINE
+    ageSocialMixingBaseline = (
+        pd.read_csv(f"{data_dir}/social_mixing_BASELINE.csv", sep=",")
+        .iloc[:, 1:]
+        .values
+    )
+    ageSocialMixingBaseline = (ageSocialMixingBaseline + ageSocialMixingBaseline.T) / 2.0
 
-# Ratio of Hospital Staff by Age
-ageNhsClinicalStaffPopulationRatio = np.array(sme_input["ageNhsClinicalStaffPopulationRatio"])
+    # SOCIAL DISTANCING
+    ageSocialMixingDistancing = (
+        pd.read_csv(f"{data_dir}/social_mixing_DISTANCE.csv", sep=",")
+        .iloc[:, 1:]
+        .values
+    )
+    ageSocialMixingDistancing = (
+        ageSocialMixingDistancing + ageSocialMixingDistancing.T
+    ) / 2.0
 
-# Rate of transmission given contact for differnt states [exposed, asymptomatic, I1 (symptomatic early), I2 (symptomatic late)]
-transmissionInfectionStage = np.array(sme_input["transmissionInfectionStage"])
+    ### Hospitalization
 
+    # Hospitalization rate by age: mapped UK to ETH population (see "baked_in_parameters")
+    yearly_baseline_admissions = np.array(sme_input["yearly_baseline_admissions"])
+    ageHospitalisationRateBaseline = yearly_baseline_admissions / (365 * agePopulationTotal)
 
-############# USER INPUT PARAMETERS ############# from "USER_build_data.ipynb"
-with open(f"{data_dir}/user_input.json") as jf:
-    user_input = json.load(jf)
+    # Average days in the hospital by age
+    ageHospitalMeanLengthOfStay = np.array(sme_input["ageHospitalMeanLengthOfStay"])
+    ageHospitalisationRecoveryRateBaseline = 1.0 / ageHospitalMeanLengthOfStay
 
-# Number of Days in Isolation
-nDaysInHomeIsolation = user_input["nDaysInHomeIsolation"]
+    # Ratio of Hospital Staff by Age
+    ageNhsClinicalStaffPopulationRatio = np.array(sme_input["ageNhsClinicalStaffPopulationRatio"])
 
-tStartSocialDistancing = pd.to_datetime(
-    user_input["tStartSocialDistancing"], format="%Y-%m-%d"
-)
-tStopSocialDistancing = pd.to_datetime(
-    user_input["tStopSocialDistancing"], format="%Y-%m-%d"
-)
-tStartImmunityPassports = pd.to_datetime(
-    user_input["tStartImmunityPassports"], format="%Y-%m-%d"
-)
-tStopImmunityPassports = pd.to_datetime(
-    user_input["tStopImmunityPassports"], format="%Y-%m-%d"
-)
-tStartQuarantineCaseIsolation = pd.to_datetime(
-    user_input["tStartQuarantineCaseIsolation"], format="%Y-%m-%d"
-)
-tStopQuarantineCaseIsolation = pd.to_datetime(
-    user_input["tStopQuarantineCaseIsolation"], format="%Y-%m-%d"
-)
-CONST_DATA_START_DATE = user_input["CONST_DATA_START_DATE"]
-CONST_DATA_CUTOFF_DATE = user_input["CONST_DATA_CUTOFF_DATE"]
+    # Rate of transmission given contact for differnt states [exposed, asymptomatic, I1 (symptomatic early), I2 (symptomatic late)]
+    transmissionInfectionStage = np.array(sme_input["transmissionInfectionStage"])
 
+    ############# USER INPUT PARAMETERS ############# from "USER_build_data.ipynb"
+    with open(f"{data_dir}/user_input.json") as jf:
+        user_input = json.load(jf)
 
-# Risk of Admission by age
-totalCOVIDAdmitted_byAge_regroup = user_input["percent_admitted"] * agePopulationTotal
-relativeAdmissionRisk_given_COVID_by_age = (totalCOVIDAdmitted_byAge_regroup / agePopulationTotal)
+    # Number of Days in Isolation
+    nDaysInHomeIsolation = user_input["nDaysInHomeIsolation"]
 
-relativeAdmissionRisk_given_COVID_by_age /= np.mean(relativeAdmissionRisk_given_COVID_by_age)
-relativeAdmissionRisk_given_COVID_by_age -= 1
+    tStartSocialDistancing = parse_policyDates(user_input["tStartSocialDistancing"])
+    tStopSocialDistancing = parse_policyDates(user_input["tStopSocialDistancing"])
+    tStartImmunityPassports = parse_policyDates(user_input["tStartImmunityPassports"])
+    tStopImmunityPassports = parse_policyDates(user_input["tStopImmunityPassports"])
+    tStartQuarantineCaseIsolation = parse_policyDates(user_input["tStartQuarantineCaseIsolation"])
+    tStopQuarantineCaseIsolation = parse_policyDates(user_input["tStopQuarantineCaseIsolation"])
+    CONST_DATA_START_DATE = user_input["CONST_DATA_START_DATE"]
+    CONST_DATA_CUTOFF_DATE = user_input["CONST_DATA_CUTOFF_DATE"]
 
-# Risk of Death by Age
-totalDeaths_byAge_regroupLinear = user_input["deaths_by_age"]
-relativeDeathRisk_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / agePopulationTotal)
-relativeDeathRisk_given_COVID_by_age /= np.mean(relativeDeathRisk_given_COVID_by_age)
-relativeDeathRisk_given_COVID_by_age -= 1
+    # Risk of Admission by age
+    totalCOVIDAdmitted_byAge_regroup = user_input["percent_admitted"] * agePopulationTotal
+    relativeAdmissionRisk_given_COVID_by_age = (totalCOVIDAdmitted_byAge_regroup / agePopulationTotal)
 
+    relativeAdmissionRisk_given_COVID_by_age /= np.mean(relativeAdmissionRisk_given_COVID_by_age)
+    relativeAdmissionRisk_given_COVID_by_age -= 1
 
-# Death Rate by Age
-caseFatalityRatioHospital_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / totalCOVIDAdmitted_byAge_regroup)
+    # Risk of Death by Age
+    totalDeaths_byAge_regroupLinear = user_input["deaths_by_age"]
+    relativeDeathRisk_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / agePopulationTotal)
+    relativeDeathRisk_given_COVID_by_age /= np.mean(relativeDeathRisk_given_COVID_by_age)
+    relativeDeathRisk_given_COVID_by_age -= 1
 
-# ageRelativeRecoverySpeed = np.array([0.2]*5+[-0.1, -0.2, -0.3, -0.5]) # TODO - this is a guess, find data and fix
-ageRelativeRecoverySpeed = np.array([0.0] * 9)  # For now we make it same for everyone, makes calculations easier
+    # Death Rate by Age
+    caseFatalityRatioHospital_given_COVID_by_age = (totalDeaths_byAge_regroupLinear / totalCOVIDAdmitted_byAge_regroup)
 
-# Social Mixing WHILE Isolating (rule-breakers)
-percent_not_isolating = np.array(user_input["percent_not_isolating"])
-percent_isolating_mat = np.array([percent_not_isolating,] * nAge).transpose()
+    # Social Mixing WHILE Isolating (rule-breakers)
+    percent_not_isolating = np.array(user_input["percent_not_isolating"])
+    percent_isolating_mat = np.array([percent_not_isolating,] * nAge).transpose()
 
-# ageSocialMixingIsolation = percent_isolating_mat*ageSocialMixingDistancing
-ageSocialMixingIsolation = np.zeros_like(ageSocialMixingBaseline)  # OR PERFECT ISOLATION
+    # ageSocialMixingIsolation = percent_isolating_mat*ageSocialMixingDistancing
+    ageSocialMixingIsolation = np.zeros_like(ageSocialMixingBaseline)  # OR PERFECT ISOLATION
 
-# From coexist model
-# Getting Infected in the Hospital
-elevatedMixingRatioInHospital = 3.0
-withinHospitalSocialMixing = elevatedMixingRatioInHospital * np.sum(np.dot(agePopulationRatio, ageSocialMixingBaseline))
+    # Getting Infected in the Hospital
+    withinHospitalSocialMixing = elevatedMixingRatioInHospital * np.sum(np.dot(agePopulationRatio, ageSocialMixingBaseline))
 
-# Calculate initial hospitalisation (occupancy), that will be used to initialise the model
-initBaselineHospitalOccupancyEquilibriumAgeRatio = ageHospitalisationRateBaseline / (ageHospitalisationRateBaseline + ageHospitalisationRecoveryRateBaseline)
+    # Calculate initial hospitalisation (occupancy), that will be used to initialise the model
+    initBaselineHospitalOccupancyEquilibriumAgeRatio = ageHospitalisationRateBaseline / (ageHospitalisationRateBaseline + ageHospitalisationRecoveryRateBaseline)
 
-# Extra rate of hospitalisation due to COVID-19 infection stages; Symptom to hospitalisation is 5.76 days on average (Imperial #8)
-infToHospitalExtra = np.array(sme_input["infToHospitalExtra"])
+    # Extra rate of hospitalisation due to COVID-19 infection stages; Symptom to hospitalisation is 5.76 days on average (Imperial #8)
+    infToHospitalExtra = np.array(sme_input["infToHospitalExtra"])
 
-# We do know at least how age affects these risks:
-# For calculations see data_cleaning_py.ipynb, calculations from CHESS dataset as per 05 Apr
-riskOfAEAttandance_by_age = np.array(sme_input["riskOfAEAttandance_by_age"])
-# riskOfAEAttandance_by_age = np.array([0.41261361, 0.31560648, 0.3843979 , 0.30475704, 0.26659415,0.25203475, 0.24970244, 0.31549102, 0.65181376])
+    # We do know at least how age affects these risks:
+    # For calculations see data_cleaning_py.ipynb, calculations from CHESS dataset as per 05 Apr
+    riskOfAEAttandance_by_age = np.array(sme_input["riskOfAEAttandance_by_age"])
+    # riskOfAEAttandance_by_age = np.array([0.41261361, 0.31560648, 0.3843979 , 0.30475704, 0.26659415,0.25203475, 0.24970244, 0.31549102, 0.65181376])
 
+    # Age modulation of the extra COVID hospitalisation rate (see trFunc_HospitalAdmission)
+    ageRelativeExtraAdmissionRiskToCovid = relativeAdmissionRisk_given_COVID_by_age * riskOfAEAttandance_by_age
 
-testingStartDate = pd.to_datetime(user_input["testingStartDate"], format="%Y-%m-%d")
-ageTestingData = sme_input["ageTestingData"]
-df_CHESS_numTests_regroup = pd.DataFrame({testingStartDate: ageTestingData}).T
+    # On average this many people get hospitalised (compared to home isolation), but modulated by age (TODO: values > 1? clip for now..)
+    symptomHospitalisedRate_ageAdjusted = np.clip(
+        adjustRatesByAge_KeepAverageRate(
+            0.3,
+            ageRelativeAdjustment=relativeAdmissionRisk_given_COVID_by_age,
+            agePopulationRatio=agePopulationRatio,
+        ),
+        0.0,
+        1.0,
+    )
+
+    testingStartDate = pd.to_datetime(user_input["testingStartDate"], format="%Y-%m-%d")
+    ageTestingData = sme_input["ageTestingData"]
 
-#df_CHESS_numTests_regroup.index = df_CHESS_numTests.index
+    # Real testing data: daily tests per age group from testing_data.csv if given, otherwise the single ageTestingData day
+    testingDataFile = f"{data_dir}/testing_data.csv"
+    if os.path.exists(testingDataFile):
+        df_CHESS_numTests_regroup = load_testingData(testingDataFile)
+    else:
+        df_CHESS_numTests_regroup = pd.DataFrame({testingStartDate: ageTestingData}).T
+
+    #df_CHESS_numTests_regroup.index = df_CHESS_numTests.index
+
+    # ## Initialise the model
+
+    # Initialise state
+    stateTensor_init = copy.deepcopy(stateTensor)
+    # Populate
+    stateTensor_init[:, 0, 0, 0] = agePopulationTotal
+    # Move hospital staff to working in hospital
+    stateTensor_init[:, 0, 0, 0] -= ageNhsClinicalStaffPopulationRatio * agePopulationTotal
+    stateTensor_init[:, 0, 3, 0] += ageNhsClinicalStaffPopulationRatio * agePopulationTotal
+    # Move people to hospital according to baseline occupation (move only from normal people, not hospital staff!)
+    stateTensor_init[:, 0, 2, 0] += (
+        initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
+    )
+    stateTensor_init[:, 0, 0, 0] -= (
+        initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
+    )
+
+    loadedInputs = locals()
+    inputs = OrderedDict((name, loadedInputs[name]) for name in inputNames)
+    _inputsCache[data_dir] = inputs
 
-# ## Initialise the model
+    return inputs
 
-# Initialise state
-stateTensor_init = copy.deepcopy(stateTensor)
-# Populate
-stateTensor_init[:, 0, 0, 0] = agePopulationTotal
-# Move hospital staff to working in hospital
-stateTensor_init[:, 0, 0, 0] -= ageNhsClinicalStaffPopulationRatio * agePopulationTotal
-stateTensor_init[:, 0, 3, 0] += ageNhsClinicalStaffPopulationRatio * agePopulationTotal
-# Move people to hospital according to baseline occupation (move only from normal people, not hospital staff!)
-stateTensor_init[:, 0, 2, 0] += (
-    initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
+
+def __getattr__(name):
+    # Inputs of the default data dir as (lazily loaded) module attributes, eg. coexist.stateTensor_init
+    if name in inputNames:
+        return load_inputs()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+InputDefault = namedtuple(
+    "InputDefault",
+    [
+        "name",  # name of the input (see inputNames), or None for a fixed date
+        "date",  # YYYY-MM-DD date string if name is None
+    ],
 )
-stateTensor_init[:, 0, 0, 0] -= (
-    initBaselineHospitalOccupancyEquilibriumAgeRatio * stateTensor_init[:, 0, 0, 0]
+
+
+def inputDefault(name):
+    """
+    Placeholder default argument for the input called name (see load_inputs), resolved in build_paramDict
+    """
+    return InputDefault(name, None)
+
+
+def dateDefault(date):
+    """
+    Placeholder default argument for a fixed YYYY-MM-DD date, resolved to a pd.Timestamp in build_paramDict
+    (so pandas doesn't need to be imported when the function is defined)
+    """
+    return InputDefault(None, date)
+
+
+def resolve_inputDefault(value, inputs):
+    """
+    Returns the value an InputDefault placeholder stands for (any other value is returned as is)
+    """
+    if not isinstance(value, InputDefault):
+        return value
+    if value.name is None:
+        return pd.to_datetime(value.date, format="%Y-%m-%d")
+    return inputs[value.name]
+
+
+# ## Model context
+#
+# A Model owns one set of inputs (eg. of one region, see load_inputs), the parameters built from them, and the operators
+# precomputed for them (see cached_staticOperator), so that several models can be simulated in one process, also
+# concurrently from threads. solveSystem, dydt_Complete and the transition functions take a Model as their model keyword
+# argument: the parameters not given explicitly are then taken from the model, and the operators are cached in it.
+
+Model = namedtuple(
+    "Model",
+    [
+        "data_dir",  # folder the inputs were read from (None if they were given directly)
+        "inputs",  # OrderedDict of the inputs (see load_inputs)
+        "paramDict",  # parameters of dydt_Complete, by default built from the inputs (may be modified)
+        "operatorCache",  # OrderedDict of the operators precomputed for this model (see cached_staticOperator)
+    ],
 )
 
+currentModel = contextvars.ContextVar("currentModel", default=None)  # model whose operatorCache is in use
+
+
+def build_model(data_dir=None, inputs=None):
+    """
+    Returns the Model of the inputs of data_dir (default: see load_inputs), or of the given inputs (see inputNames)
+    """
+    if inputs is None:
+        inputs = load_inputs(data_dir)
+
+    return Model(data_dir, inputs, build_paramDict(dydt_Complete, inputs), OrderedDict())
+
+
+@contextlib.contextmanager
+def model_context(model):
+    """
+    Within this context cached_staticOperator uses the operatorCache of model (the shared cache if model is None)
+    """
+    token = currentModel.set(model)
+    try:
+        yield model
+    finally:
+        currentModel.reset(token)
+
+
+def model_paramDict(model, func):
+    """
+    Default parameters of func built from the inputs of model (see build_paramDict), model.paramDict for dydt_Complete
+    """
+    func = inspect.unwrap(func)
+    if func is inspect.unwrap(dydt_Complete):
+        return model.paramDict
+
+    with model_context(model):
+        return cached_staticOperator(("paramDict", func.__qualname__), build_paramDict, func, model.inputs)
+
+
+_defaultModels = {}
+
+
+def default_model():
+    """
+    The Model of the inputs of the default data dir (see load_inputs), built once per data dir
+    """
+    inputs = load_inputs()
+    # (the loaded inputs are kept for good in _inputsCache, so their id identifies them)
+    if id(inputs) not in _defaultModels:
+        _defaultModels[id(inputs)] = build_model(inputs=inputs)
+    return _defaultModels[id(inputs)]
+
+
+def model_aware(func):
+    """
+    Decorator adding the model keyword argument to func: if a Model is given, the arguments of func that are not given
+    are taken from model_paramDict(model, func), and func is run in model_context(model).
+    Without a model, if func is not given all arguments that depend on the model inputs (InputDefault placeholders,
+    and the "_params" of function arguments), it is run with the default_model()
+    """
+    allArgs = inspect.getfullargspec(func)
+    defaults = dict(zip(allArgs.args[len(allArgs.args) - len(allArgs.defaults or ()) :], allArgs.defaults or ()))
+    # (name, position) of these arguments, the "_params" can only be given as keyword arguments
+    inputArgs = [
+        (argname, allArgs.args.index(argname)) for argname, argval in defaults.items() if isinstance(argval, InputDefault)
+    ] + [(argname + "_params", np.inf) for argname, argval in defaults.items() if callable(argval)]
+
+    @functools.wraps(func)
+    def modelAwareFunc(*args, model=None, **kwargs):
+        if model is None:
+            if all(argname in kwargs or position < len(args) for argname, position in inputArgs):
+                return func(*args, **kwargs)
+            model = default_model()
+
+        positionalNames = inspect.getfullargspec(func).args[: len(args)]
+        modelKwargs = {
+            key: value
+            for key, value in model_paramDict(model, func).items()
+            if key not in positionalNames
+        }
+        modelKwargs.update(kwargs)
+        with model_context(model):
+            return func(*args, **modelKwargs)
+
+    return modelAwareFunc
+
 
 def regroup_by_age(
     inp,  # first dimension is ages, others don't matter.
@@ -276,7 +704,7 @@ def regroup_by_age(
 
 
 # Build the nested parameter/computation graph of a single function.
-def build_paramDict(cur_func):
+def build_paramDict(cur_func, inputs=None):
     """
     This function iterates through all inputs of a function,
     and saves the default argument names and values into a dictionary.
@@ -284,13 +712,16 @@ def build_paramDict(cur_func):
     If any of the default arguments are functions themselves, then recursively (depth-first) adds an extra field to
     the dictionary, named <funcName + "_params">, that contains its inputs and arguments.
 
+    Defaults that depend on the model inputs (InputDefault placeholders) are taken from inputs
+    (see load_inputs, loaded from the default data dir if not given).
+
     The output of this function can then be passed as a "kwargs" object to the highest level function,
     which will then pass the parameter values to the lower dictionary levels appropriately
     """
 
     paramDict = OrderedDict()
 
-    allArgs = inspect.getfullargspec(cur_func)
+    allArgs = inspect.getfullargspec(inspect.unwrap(cur_func))
 
     # Check if there are any default parameters, if no, just return empty dict
     if allArgs.defaults is None:
@@ -299,13 +730,18 @@ def build_paramDict(cur_func):
     for argname, argval in zip(
         allArgs.args[-len(allArgs.defaults) :], allArgs.defaults
     ):
+        if isinstance(argval, InputDefault):
+            if inputs is None and argval.name is not None:
+                inputs = load_inputs()
+            argval = resolve_inputDefault(argval, inputs)
+
         # Save the default argument
         paramDict[argname] = argval
         # If the default argument is a function, inspect it for further
 
         if callable(argval):
             # print(argname)
-            paramDict[argname + "_params"] = build_paramDict(argval)
+            paramDict[argname + "_params"] = build_paramDict(argval, inputs)
 
     return paramDict
 
@@ -363,9 +799,86 @@ def paramTable_toDict(paramTable, defaultDict=None):
     return paramDict
 
 
+# Stable fingerprint of (a part of) the nested parameter dictionary, used as a cache key for precomputed operators
+def paramDict_fingerprint(paramDict):
+    """
+    Returns a hex digest that only changes if a value in the (nested) parameter dictionary changes.
+
+    Numpy arrays and pandas objects are hashed by content, functions by their qualified name
+    (so the fingerprint is stable across processes), everything else by its repr.
+    """
+
+    hasher = hashlib.sha1()
+
+    def fingerprintRecurse(value):
+        if isinstance(value, dict):
+            hasher.update(b"{")
+            for key in sorted(value.keys()):
+                hasher.update(repr(key).encode())
+                fingerprintRecurse(value[key])
+            hasher.update(b"}")
+        elif isinstance(value, (list, tuple)):
+            hasher.update(b"[")
+            for item in value:
+                fingerprintRecurse(item)
+            hasher.update(b"]")
+        elif isinstance(value, np.ndarray):
+            hasher.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+            if value.dtype == object:
+                hasher.update(repr(value.tolist()).encode())
+            else:
+                hasher.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (pd.DataFrame, pd.Series)):
+            hasher.update(type(value).__name__.encode())
+            fingerprintRecurse(value.index.to_numpy())
+            if isinstance(value, pd.DataFrame):
+                fingerprintRecurse(value.columns.to_numpy())
+            fingerprintRecurse(value.to_numpy())
+        elif callable(value):
+            hasher.update(
+                f"func:{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}".encode()
+            )
+        else:
+            hasher.update(f"{type(value).__name__}:{value!r}".encode())
+
+    fingerprintRecurse(paramDict)
+
+    return hasher.hexdigest()
+
+
+# The cached operators are looked up by fingerprint on every evaluation of dydt_Complete, but the parameters do not change
+# during a solve: there the fingerprints are memoized by the identity of the parameter objects (see solve_memoizedFunctions)
+solveFingerprintMemo = contextvars.ContextVar("solveFingerprintMemo", default=None)
+
+
+def memoized_fingerprint(values):
+    """
+    paramDict_fingerprint of the list of values, only computed once per solve for the same objects
+    """
+    memo = solveFingerprintMemo.get()
+    if memo is None:
+        return paramDict_fingerprint(values)
+
+    key = tuple(id(value) for value in values)
+    if key not in memo:
+        if len(memo) >= staticOperatorCacheSize:  # (values built anew on each evaluation)
+            memo.clear()
+        # The values are kept, so that their ids are not reused during the solve
+        memo[key] = (values, paramDict_fingerprint(values))
+    return memo[key][1]
+
+
+def batch_expand(value, nDims):
+    """
+    Appends nDims singleton dimensions to value (a scalar, or an array of per ensemble member values),
+    so that it broadcasts against arrays with nDims dimensions after the ensemble dimensions
+    """
+    return np.reshape(value, np.shape(value) + (1,) * nDims)
+
+
 # Helper function to adjust average rates to age-aware rates
 def adjustRatesByAge_KeepAverageRate(
-    rate, ageRelativeAdjustment, agePopulationRatio=agePopulationRatio, maxOutRate=1e20
+    rate, ageRelativeAdjustment, agePopulationRatio, maxOutRate=1e20
 ):
     """This is a helper function and wont be picked up as a model parameter!"""
     if rate == 0:
@@ -402,23 +915,26 @@ def adjustRatesByAge_KeepAverageRate(
 # - people's age distribution in travel is square of the usual age distribution
 # - travel rates declined from a base rate as a sigmoid due to border closures, with given mean and slope
 # - infection rates due to travel are modelled as a gamma pdf over time, with given peak value, loc, and scale parameter
-def trFunc_travelInfectionRate_ageAdjusted(
-    t,  # Time (int, in days) within simulation
-    travelMaxTime=travelMaxTime,
-    travelBaseRate=travelBaseRate,  # How many people normally travel back to the country per day # TODO - get data
-    travelDecline_mean=travelDecline_mean,
-    travelDecline_slope=travelDecline_slope,
-    travelInfection_peak=travelInfection_peak,
-    travelInfection_maxloc=travelInfection_maxloc,
-    travelInfection_shape=travelInfection_shape,
-    **kwargs,
+def build_travelInfectionRateTable(
+    travelMaxTime,
+    travelBaseRate,
+    travelDecline_mean,
+    travelDecline_slope,
+    travelInfection_peak,
+    travelInfection_maxloc,
+    travelInfection_shape,
+    agePopulationRatio,
 ):
+    """
+    Returns the nAge x (travelMaxTime+1) table of travel infection rates for each day within simulation,
+    the last column is zero (no more travel infections after travelMaxTime)
+    """
 
     tmpTime = np.arange(travelMaxTime)
     # nAge x T TODO get some realistic data on this
     travelAgeRateByTime = travelBaseRate * np.outer(
         agePopulationRatio,
-        1 - expit((tmpTime - travelDecline_mean) / travelDecline_slope),
+        1 - special.expit((tmpTime - travelDecline_mean) / travelDecline_slope),
     )
 
     # 1 x T TODO get some realistic data on this, maybe make it age weighted
@@ -434,25 +950,73 @@ def trFunc_travelInfectionRate_ageAdjusted(
         / np.max(travelContractionRateByTime)
     )
 
-    if t >= travelAgeRateByTime.shape[-1]:
-        return np.zeros(travelAgeRateByTime.shape[0])
+    travelInfectionRateTable = np.zeros((len(agePopulationRatio), travelMaxTime + 1))
+    travelInfectionRateTable[:, :travelMaxTime] = (
+        travelAgeRateByTime * travelContractionRateByTime
+    )
+    travelInfectionRateTable.setflags(write=False)
+
+    return travelInfectionRateTable
+
+
+@model_aware
+def trFunc_travelInfectionRate_ageAdjusted(
+    t,  # Time (int, in days) within simulation
+    travelMaxTime=travelMaxTime,
+    travelBaseRate=travelBaseRate,  # How many people normally travel back to the country per day # TODO - get data
+    travelDecline_mean=travelDecline_mean,
+    travelDecline_slope=travelDecline_slope,
+    travelInfection_peak=travelInfection_peak,
+    travelInfection_maxloc=travelInfection_maxloc,
+    travelInfection_shape=travelInfection_shape,
+    travelInterpolate=False,  # If True, linearly interpolate between days for fractional t, otherwise use the rate of day int(t)
+    agePopulationRatio=inputDefault("agePopulationRatio"),
+    **kwargs,
+):
+
+    # The rate curves only depend on the parameters, precompute the whole table once per parameter set
+    travelParams = (
+        travelMaxTime,
+        travelBaseRate,
+        travelDecline_mean,
+        travelDecline_slope,
+        travelInfection_peak,
+        travelInfection_maxloc,
+        travelInfection_shape,
+        agePopulationRatio,
+    )
+    travelInfectionRateTable = cached_staticOperator(
+        ("travelInfectionRateTable", memoized_fingerprint(travelParams)),
+        build_travelInfectionRateTable,
+        *travelParams,
+    )
+
+    if t >= travelMaxTime:
+        return travelInfectionRateTable[:, -1]
+    elif travelInterpolate:
+        day = int(t)
+        frac = t - day
+        return (1.0 - frac) * travelInfectionRateTable[
+            :, day
+        ] + frac * travelInfectionRateTable[:, day + 1]
     else:
-        return travelAgeRateByTime[:, int(t)] * travelContractionRateByTime[int(t)]
+        return travelInfectionRateTable[:, int(t)]
 
 
 # Overall new infections include within quarantine and hospital infections
 # ------------------------------------------------------------------------
 
 
+@model_aware
 def trFunc_newInfections_Complete(
     stateTensor,
     policySocialDistancing,  # True / False, no default because it's important to know which one we use at any moment!
     policyImmunityPassports,  # True / False, no default because it's important to know which one we use at any moment!
-    ageSocialMixingBaseline=ageSocialMixingBaseline,
-    ageSocialMixingDistancing=ageSocialMixingDistancing,
-    ageSocialMixingIsolation=ageSocialMixingIsolation,
-    withinHospitalSocialMixing=withinHospitalSocialMixing,
-    transmissionInfectionStage=transmissionInfectionStage,
+    ageSocialMixingBaseline=inputDefault("ageSocialMixingBaseline"),
+    ageSocialMixingDistancing=inputDefault("ageSocialMixingDistancing"),
+    ageSocialMixingIsolation=inputDefault("ageSocialMixingIsolation"),
+    withinHospitalSocialMixing=inputDefault("withinHospitalSocialMixing"),
+    transmissionInfectionStage=inputDefault("transmissionInfectionStage"),
     **kwargs,
 ):
     """
@@ -476,31 +1040,36 @@ def trFunc_newInfections_Complete(
     vs case isolation (policy = False, but with serious ageSocialMixingIsolation)
     """
 
-    ageIsoContractionRate = np.zeros((nAge, nIso, nTest))
+    # stateTensor may have extra leading (ensemble) dimensions, then the policies and parameters may too (see stack_paramDicts)
+    batchShape = stateTensor.shape[:-4]
+    ageIsoContractionRate = np.zeros(batchShape + (nAge, nIso, nTest))
+
+    def infectiousPerAge(mixing, infected):
+        # mixing (nAge x nAge) times all infected people per age, weighted by their transmission rate
+        return np.einsum(
+            "...ij,...j->...i",
+            mixing,
+            np.einsum("...ijl,...j->...i", infected, transmissionInfectionStage),
+        )
 
     # Add non-hospital infections
     # --------------------------------
 
-    curNonIsolatedSocialMixing = (
-        ageSocialMixingDistancing if policySocialDistancing else ageSocialMixingBaseline
+    curNonIsolatedSocialMixing = np.where(
+        batch_expand(policySocialDistancing, 2),
+        ageSocialMixingDistancing,
+        ageSocialMixingBaseline,
     )
 
     # Add baseline interactions only between non-isolated people
     for k1 in [0, 3]:
         for k2 in [0, 3]:
-            ageIsoContractionRate[:, k1, :] += np.expand_dims(
-                np.matmul(
-                    curNonIsolatedSocialMixing,
-                    np.einsum(
-                        "ijl,j->i",
-                        stateTensor[:, 1 : (nI + 1), k2, :],
-                        transmissionInfectionStage,
-                    ),  # all infected in non-isolation
-                ),
-                axis=1,
-            )
+            ageIsoContractionRate[..., k1, :] += infectiousPerAge(
+                curNonIsolatedSocialMixing,
+                stateTensor[..., 1 : (nI + 1), k2, :],  # all infected in non-isolation
+            )[..., np.newaxis]
 
-    if policyImmunityPassports:
+    if np.any(policyImmunityPassports):
         # If the immunity passports policy is on, everyone who tested antibody positive, can roam freely
         # Therefore replace the interactions between people with testingState = 2 with ageSocialMixingBaseline
         # we do this by using the distributive property of matrix multiplication, and adding extra interactions
@@ -508,11 +1077,14 @@ def trFunc_newInfections_Complete(
         # TODO - this is a bit hacky?, but probably correct - double check though!
         for k1 in [0, 3]:
             for k2 in [0, 3]:
-                ageIsoContractionRate[:, k1, 2:] += np.matmul(
+                ageIsoContractionRate[..., k1, 2:] += batch_expand(
+                    policyImmunityPassports, 2
+                ) * np.einsum(
+                    "...ij,...jk->...ik",
                     ageSocialMixingBaseline - curNonIsolatedSocialMixing,
                     np.einsum(
-                        "ijk,j->ik",
-                        stateTensor[:, 1 : (nI + 1), k2, 2:],
+                        "...ijk,...j->...ik",
+                        stateTensor[..., 1 : (nI + 1), k2, 2:],
                         transmissionInfectionStage,
                     ),  # all infected in non-isolation
                 )
@@ -520,31 +1092,17 @@ def trFunc_newInfections_Complete(
     # Add isolation interactions only between isolated and non-isolated people
     # non-isolated contracting it from isolated
     for k1 in [0, 3]:
-        ageIsoContractionRate[:, k1, :] += np.expand_dims(
-            np.matmul(
-                ageSocialMixingIsolation,
-                np.einsum(
-                    "ijl,j->i",
-                    stateTensor[:, 1 : (nI + 1), 1, :],
-                    transmissionInfectionStage,
-                ),  # all infected in isolation
-            ),
-            axis=1,
-        )
+        ageIsoContractionRate[..., k1, :] += infectiousPerAge(
+            ageSocialMixingIsolation,
+            stateTensor[..., 1 : (nI + 1), 1, :],  # all infected in isolation
+        )[..., np.newaxis]
 
     # isolated contracting it from non-isolated
     for k1 in [0, 3]:
-        ageIsoContractionRate[:, 1, :] += np.expand_dims(
-            np.matmul(
-                ageSocialMixingIsolation,
-                np.einsum(
-                    "ijl,j->i",
-                    stateTensor[:, 1 : (nI + 1), k1, :],
-                    transmissionInfectionStage,
-                ),  # all infected in non-hospital, non-isolation
-            ),
-            axis=1,
-        )
+        ageIsoContractionRate[..., 1, :] += infectiousPerAge(
+            ageSocialMixingIsolation,
+            stateTensor[..., 1 : (nI + 1), k1, :],  # all infected in non-hospital, non-isolation
+        )[..., np.newaxis]
 
         # isolated cannot contracting it from another isolated
 
@@ -553,16 +1111,17 @@ def trFunc_newInfections_Complete(
     # (TODO - within hospitals we probably want to take into effect the testing state;
     #      tested people are better isolated and there's less mixing)
 
-    ageIsoContractionRate[:, 2:, :] += np.expand_dims(
-        withinHospitalSocialMixing
+    ageIsoContractionRate[..., 2:, :] += (
+        batch_expand(withinHospitalSocialMixing, 1)
         * np.einsum(
-            "ijkl,j->i", stateTensor[:, 1 : (nI + 1), 2:, :], transmissionInfectionStage
-        ),  # all infected in hospital (sick or working)
-        axis=(1, 2),
-    )
-
-    return ageIsoContractionRate / np.sum(
-        stateTensor
+            "...ijkl,...j->...i",
+            stateTensor[..., 1 : (nI + 1), 2:, :],
+            transmissionInfectionStage,
+        )  # all infected in hospital (sick or working)
+    )[..., np.newaxis, np.newaxis]
+
+    return ageIsoContractionRate / batch_expand(
+        np.sum(stateTensor, axis=(-4, -3, -2, -1)), 3
     )  # Normalise the rate by total population
 
 
@@ -575,11 +1134,12 @@ def trFunc_newInfections_Complete(
 # but now hospitalised (the rest of people remain in whatever state they were in)
 
 
+@model_aware
 def trFunc_HospitalAdmission(
-    ageHospitalisationRateBaseline=ageHospitalisationRateBaseline,
-    infToHospitalExtra=infToHospitalExtra,
-    ageRelativeExtraAdmissionRiskToCovid=relativeAdmissionRisk_given_COVID_by_age
-    * riskOfAEAttandance_by_age,
+    ageHospitalisationRateBaseline=inputDefault("ageHospitalisationRateBaseline"),
+    infToHospitalExtra=inputDefault("infToHospitalExtra"),
+    ageRelativeExtraAdmissionRiskToCovid=inputDefault("ageRelativeExtraAdmissionRiskToCovid"),
+    agePopulationRatio=inputDefault("agePopulationRatio"),
     **kwargs,
 ):
 
@@ -594,6 +1154,7 @@ def trFunc_HospitalAdmission(
         ageAdjusted_infToHospitalExtra[:, ii] = adjustRatesByAge_KeepAverageRate(
             infToHospitalExtra[ii],
             ageRelativeAdjustment=ageRelativeExtraAdmissionRiskToCovid,
+            agePopulationRatio=agePopulationRatio,
         )
 
     # Add baseline hospitalisation to all non-dead states
@@ -614,8 +1175,9 @@ def trFunc_HospitalAdmission(
 # TODO - check with health experts if this is correct assumption; probably also depends on testing state
 
 
+@model_aware
 def trFunc_HospitalDischarge(
-    ageHospitalisationRecoveryRateBaseline=ageHospitalisationRecoveryRateBaseline,
+    ageHospitalisationRecoveryRateBaseline=inputDefault("ageHospitalisationRecoveryRateBaseline"),
     dischargeDueToCovidRateMultiplier=3.0,
     **kwargs,
 ):
@@ -639,6 +1201,7 @@ def trFunc_HospitalDischarge(
     return trTensor_HospitalDischarge
 
 
+@model_aware
 def trFunc_diseaseProgression(
     # Basic parameters to adhere to
     nonsymptomatic_ratio=0.86,
@@ -651,8 +1214,10 @@ def trFunc_diseaseProgression(
     IgG_formation=15.0,
     # Age related parameters
     # for now we'll assume that all hospitalised cases are known (overall 23% of hospitalised COVID patients die. 9% overall case fatality ratio)
-    caseFatalityRatioHospital_given_COVID_by_age=caseFatalityRatioHospital_given_COVID_by_age,
+    caseFatalityRatioHospital_given_COVID_by_age=inputDefault("caseFatalityRatioHospital_given_COVID_by_age"),
+    relativeDeathRisk_given_COVID_by_age=inputDefault("relativeDeathRisk_given_COVID_by_age"),
     ageRelativeRecoverySpeed=ageRelativeRecoverySpeed,
+    agePopulationRatio=inputDefault("agePopulationRatio"),
     # Unknown rates to estimate
     nonsymp_to_recovery=15.0,
     inverse_IS1_IS2=4.0,
@@ -707,6 +1272,7 @@ def trFunc_diseaseProgression(
         ageAdjusted_diseaseProgBaseline[:, ii, -1] = adjustRatesByAge_KeepAverageRate(
             ageAdjusted_diseaseProgBaseline[0, ii, -1],
             ageRelativeAdjustment=relativeDeathRisk_given_COVID_by_age,
+            agePopulationRatio=agePopulationRatio,
         )
 
         # Adjust recovery rate by age dependent recovery speed
@@ -750,6 +1316,89 @@ def trFunc_diseaseProgression(
 # assumptions about practical (not theoretical, see discrapancy in PCR!) parameters of tests
 # TODO - but particular data and references from lit (or estimates based on previous similar tests)
 
+# Test specifications are kept as numpy arrays (these are evaluated in every dydt_Complete call),
+# use testSpecifications_toDataFrame for a readable table
+CompiledTestSpecifications = namedtuple(
+    "CompiledTestSpecifications",
+    [
+        "testTypes",  # list of test names, defines the order of the first axis of all arrays below
+        "outputTestState",  # nTestTypes, what information state does a pos test transition you to
+        "falseNegativeRate",  # nTestTypes x nHS, ratio of positive (infected / immune) people missed by the test
+        "falsePositiveRate",  # nTestTypes x nHS, ratio of negative (non-infected or not immune) people deemed positive by the test
+        "truePositive",  # nTestTypes x nHS, whether a positive test result is correct in the given health state
+        "posTestState",  # nTestTypes x nTest, test state after a positive result, given the current test state
+        "negTestState",  # nTestTypes x nTest, test state after a negative result, given the current test state
+        "testOutcomeRates",  # nTestTypes x nHS x nTest x nTest, rate of moving between test states per administered test
+    ],
+)
+
+
+def build_testSpecifications(
+    testTypes, outputTestState, truePositive, falseNegativeRate, falsePositiveRate
+):
+    """
+    Computes the test state routing of the test specifications, and returns them as (read-only) CompiledTestSpecifications
+    """
+    posTestState = np.zeros((len(testTypes), nTest), dtype=int)
+    negTestState = np.zeros((len(testTypes), nTest), dtype=int)
+
+    for testInd in range(len(testTypes)):
+        curOutputTestState = int(outputTestState[testInd])
+        for curTS in range(nTest):
+            # Set output positive test state based on current test state
+            if curTS == curOutputTestState:
+                # already positive for the given test
+                posTestState[testInd, curTS] = curTS
+            elif curTS == 3:
+                # If already positive for both, stay positive
+                posTestState[testInd, curTS] = 3
+            else:
+                # Transition 0->1, 0->2, 1->2, 1->3 or 2->3
+                posTestState[testInd, curTS] = curTS + curOutputTestState
+
+            # Where do we go after negative test based on where we are now?
+            if curTS == 0:
+                # Negatives stay negatives
+                negTestState[testInd, curTS] = 0
+            elif curTS == 3:
+                # go to only virus or antibody positive from both positive
+                negTestState[testInd, curTS] = 3 - curOutputTestState
+            elif curTS == curOutputTestState:
+                # go to 0 if tested for the one you're positive for
+                negTestState[testInd, curTS] = 0
+            else:
+                # stay where you are if you test negative for the one you didnt have anyway
+                negTestState[testInd, curTS] = curTS
+
+    # Positive results: true positives * (1-FNR), false positives * FPR
+    posRate = np.where(truePositive, 1.0 - falseNegativeRate, falsePositiveRate)
+    # Negative results: false negatives * FNR, and true negatives (as in the original formulation) * FPR
+    negRate = np.where(truePositive, falseNegativeRate, falsePositiveRate)
+
+    # One-hot routing of current test state to the test state after a positive / negative result
+    posRouting = np.eye(nTest)[posTestState]
+    negRouting = np.eye(nTest)[negTestState]
+
+    testOutcomeRates = np.einsum("jh,jlm->jhlm", posRate, posRouting) + np.einsum(
+        "jh,jlm->jhlm", negRate, negRouting
+    )
+
+    testSpecifications = CompiledTestSpecifications(
+        testTypes=list(testTypes),
+        outputTestState=np.array(outputTestState, dtype=int),
+        falseNegativeRate=np.array(falseNegativeRate, dtype=float),
+        falsePositiveRate=np.array(falsePositiveRate, dtype=float),
+        truePositive=np.array(truePositive, dtype=bool),
+        posTestState=posTestState,
+        negTestState=negTestState,
+        testOutcomeRates=testOutcomeRates,
+    )
+    for arr in testSpecifications[1:]:
+        arr.setflags(write=False)
+
+    return testSpecifications
+
+
 # TODO - MANUAL! - this function is VERY specific to current health state setup, and needs to be manually edited if number of health states change
 def inpFunc_testSpecifications(
     PCR_FNR_I1_to_R2=np.array([0.9, 0.4, 0.15, 0.35, 0.5, 0.8]),
@@ -759,106 +1408,101 @@ def inpFunc_testSpecifications(
     antibody_FNR_I1_to_R2=np.array([0.99, 0.85, 0.8, 0.65, 0.3, 0.05]),
     antibody_FPR_S_to_I4=np.array([0.05, 0.04, 0.03, 0.02, 0.01]),
 ):
+    """
+    Returns the CompiledTestSpecifications of the PCR, antigen and antibody tests.
+    Only computed once per distinct set of inputs, the result is read-only.
+    """
+
+    def buildTestSpecifications():
+        # For each health stage:
+        #  S -> I1 (asymp) -> I2 (mild symp) -> I3 (symp, sick) -> I4 (symp, less sick) -> R1 / R2 (IgM, IgG avail) -> D
+        falseNegativeRate = np.zeros((3, nHS))
+        falseNegativeRate[0, 1 : (nI + nR + 1)] = PCR_FNR_I1_to_R2
+        falseNegativeRate[1, 1 : (nI + nR + 1)] = antigen_FNR_I1_to_R2
+        falseNegativeRate[2, 1 : (nI + nR + 1)] = antibody_FNR_I1_to_R2
+
+        # Virus tests give false positives in susceptible and recovered states, antibody tests in susceptible and infected states
+        falsePositiveRate = np.zeros((3, nHS))
+        falsePositiveRate[0, [0, nI + 1, nI + 2]] = PCR_FPR
+        falsePositiveRate[1, [0, nI + 1, nI + 2]] = antigen_FPR
+        falsePositiveRate[2, 0 : (nI + 1)] = antibody_FPR_S_to_I4
+
+        # Virus tests are truly positive in infected states, antibody tests in recovered states
+        truePositive = np.zeros((3, nHS), dtype=bool)
+        truePositive[:2, 1 : (nI + 1)] = True
+        truePositive[2, (nI + 1) : (nI + nR + 1)] = True
+
+        return build_testSpecifications(
+            testTypes=["PCR", "Antigen", "Antibody"],
+            outputTestState=[1, 1, 2],
+            truePositive=truePositive,
+            falseNegativeRate=falseNegativeRate,
+            falsePositiveRate=falsePositiveRate,
+        )
 
-    testSpecifications = pd.DataFrame(
-        columns=["Name"],  # , "Infection stage"],#, "Sensitivity", "Specificity"],
-        data=(["PCR"] * nHS + ["Antigen"] * (nHS) + ["Antibody"] * (nHS)),
+    return cached_staticOperator(
+        (
+            "inpFunc_testSpecifications",
+            memoized_fingerprint(
+                [
+                    PCR_FNR_I1_to_R2,
+                    PCR_FPR,
+                    antigen_FNR_I1_to_R2,
+                    antigen_FPR,
+                    antibody_FNR_I1_to_R2,
+                    antibody_FPR_S_to_I4,
+                ]
+            ),
+        ),
+        buildTestSpecifications,
     )
 
-    testSpecifications["OutputTestState"] = (
-        [1] * nHS + [1] * nHS + [2] * nHS
-    )  # what information state does a pos test transition you to.
 
-    testSpecifications["TruePosHealthState"] = (
-        [np.arange(1, nI + 1)] * nHS
-        + [np.arange(1, nI + 1)] * nHS
-        + [np.arange(nI + 1, nI + nR + 1)] * nHS
-    )  # what information state does a pos test transition you to.
+def testSpecifications_toDataFrame(testSpecifications):
+    """
+    Table view of CompiledTestSpecifications (one row per test type and input health state), for inspection and export
+    """
+    nTestTypes = len(testSpecifications.testTypes)
+
+    return pd.DataFrame(
+        {
+            "Name": np.repeat(testSpecifications.testTypes, nHS),
+            "OutputTestState": np.repeat(testSpecifications.outputTestState, nHS),
+            "TruePosHealthState": [
+                np.nonzero(testSpecifications.truePositive[testInd])[0]
+                for testInd in range(nTestTypes)
+                for _ in range(nHS)
+            ],
+            "InputHealthState": np.tile(np.arange(nHS), nTestTypes),
+            "FalseNegativeRate": testSpecifications.falseNegativeRate.reshape(-1),
+            "FalsePositiveRate": testSpecifications.falsePositiveRate.reshape(-1),
+        }
+    )
 
-    # In some health states some people are true negatives and some are true positives! (No, makes litte sense to use, just account for it in FPR? Only matters for test makers...)
-    # testSpecifications['AmbiguousPosHealthState'] = [np.arange(nI+1, nI+nR+1)]*nHS + [np.arange(nI+1, nI+nR+1)]*nHS + [np.arange(1, nI+1)]*nHS # what information state does a pos test transition you to.
 
-    testSpecifications["InputHealthState"] = list(np.tile(range(nHS), 3))
+def compile_testSpecifications(testSpecifications):
+    """
+    Converts a testSpecifications DataFrame (as given by testSpecifications_toDataFrame) into CompiledTestSpecifications
+    """
+    testTypes = list(pd.unique(testSpecifications["Name"]))
 
-    # These numbers below are "defaults" illustrating the concept, but are modified by the inputs!!!
+    outputTestState = np.zeros(len(testTypes), dtype=int)
+    falseNegativeRate = np.zeros((len(testTypes), nHS))
+    falsePositiveRate = np.zeros((len(testTypes), nHS))
+    truePositive = np.zeros((len(testTypes), nHS), dtype=bool)
 
-    testSpecifications[
-        "FalseNegativeRate"
-    ] = [  # ratio of positive (infected / immune) people missed by the test
-        # For each health stage:
-        #  S -> I1 (asymp) -> I2 (mild symp) -> I3 (symp, sick) -> I4 (symp, less sick) -> R1 / R2 (IgM, IgG avail) -> D
-        # PCR
-        0.0,
-        0.9,
-        0.4,
-        0.15,
-        0.35,
-        0.5,
-        0.8,
-        0.0,
-        # Antigen
-        0.0,
-        0.95,
-        0.6,
-        0.35,
-        0.45,
-        0.6,
-        0.9,
-        0.0,
-        # Antibody
-        0.0,
-        0.99,
-        0.85,
-        0.8,
-        0.65,
-        0.3,
-        0.05,
-        0.0,
-    ]
+    for testInd, testType in enumerate(testTypes):
+        curTestSpecs = testSpecifications[testSpecifications["Name"] == testType]
+        curHS = curTestSpecs["InputHealthState"].values.astype(int)
 
-    testSpecifications.loc[1:6, "FalseNegativeRate"] = PCR_FNR_I1_to_R2
-    testSpecifications.loc[9:14, "FalseNegativeRate"] = antigen_FNR_I1_to_R2
-    testSpecifications.loc[17:22, "FalseNegativeRate"] = antibody_FNR_I1_to_R2
+        outputTestState[testInd] = int(curTestSpecs["OutputTestState"].values[0])
+        falseNegativeRate[testInd, curHS] = curTestSpecs["FalseNegativeRate"].values
+        falsePositiveRate[testInd, curHS] = curTestSpecs["FalsePositiveRate"].values
+        truePositive[testInd, curTestSpecs["TruePosHealthState"].values[0]] = True
 
-    testSpecifications[
-        "FalsePositiveRate"
-    ] = [  # ratio of negative (non-infected or not immune) people deemed positive by the test
-        # PCR
-        0.01,
-        0.0,
-        0.0,
-        0.0,
-        0.0,
-        0.01,
-        0.01,
-        0.0,
-        # Antigen
-        0.1,
-        0.0,
-        0.0,
-        0.0,
-        0.0,
-        0.1,
-        0.1,
-        0.0,
-        # Antibody
-        0.05,
-        0.04,
-        0.03,
-        0.02,
-        0.01,
-        0.0,
-        0.0,
-        0.0,
-    ]
-
-    testSpecifications.loc[0, "FalsePositiveRate"] = PCR_FPR
-    testSpecifications.loc[5:6, "FalsePositiveRate"] = PCR_FPR
-    testSpecifications.loc[8, "FalsePositiveRate"] = antigen_FPR
-    testSpecifications.loc[13:14, "FalsePositiveRate"] = antigen_FPR
-    testSpecifications.loc[16:20, "FalsePositiveRate"] = antibody_FPR_S_to_I4
-
-    return testSpecifications
+    return build_testSpecifications(
+        testTypes, outputTestState, truePositive, falseNegativeRate, falsePositiveRate
+    )
 
 
 # For PCR - we will model this (for now, for fitting we'll plug in real data!), as the sum of two sigmoids:
@@ -869,54 +1513,55 @@ def inpFunc_testSpecifications(
 # We further define a ratio between the production of the two, due to them requiring the same capabilities.
 
 
+@model_aware
 def trFunc_testCapacity(
     realTime,  # time within simulation (day)
     # PCR capacity - initial
     testCapacity_pcr_phe_total=1e4,
-    testCapacity_pcr_phe_inflexday=pd.to_datetime("2020-03-25", format="%Y-%m-%d"),
+    testCapacity_pcr_phe_inflexday=dateDefault("2020-03-25"),
     testCapacity_pcr_phe_inflexslope=5.0,
     # PCR capacity - increased
     testCapacity_pcr_country_total=1e5,
-    testCapacity_pcr_country_inflexday=pd.to_datetime("2020-04-25", format="%Y-%m-%d"),
+    testCapacity_pcr_country_inflexday=dateDefault("2020-04-25"),
     testCapacity_pcr_country_inflexslope=10,
     # Antibody / antigen capacity
-    testCapacity_antibody_country_firstday=pd.to_datetime(
-        "2020-04-25", format="%Y-%m-%d"
-    ),
+    testCapacity_antibody_country_firstday=dateDefault("2020-04-25"),
     testCapacity_antibody_country_total=5e6,
-    testCapacity_antibody_country_inflexday=pd.to_datetime(
-        "2020-05-20", format="%Y-%m-%d"
-    ),
+    testCapacity_antibody_country_inflexday=dateDefault("2020-05-20"),
     testCapacity_antibody_country_inflexslope=20,
     testCapacity_antigenratio_country=0.7,
     **kwargs,
 ):
 
-    # Returns a dictionary with test names and number available at day "t"
+    # Returns a dictionary with test names and number available at day "realTime"
+    # realTime may also be a pd.DatetimeIndex, then each entry is an array with the numbers available on each day
+    # (this is how the simulation calendar evaluates it, only once for all days)
 
     outPCR = (
         # phe phase
         testCapacity_pcr_phe_total
-        * expit(
-            (realTime - testCapacity_pcr_phe_inflexday).days
+        * special.expit(
+            np.asarray((realTime - testCapacity_pcr_phe_inflexday).days)
             / testCapacity_pcr_phe_inflexslope
         )
         +
         # whole country phase
         testCapacity_pcr_country_total
-        * expit(
-            (realTime - testCapacity_pcr_country_inflexday).days
+        * special.expit(
+            np.asarray((realTime - testCapacity_pcr_country_inflexday).days)
             / testCapacity_pcr_country_inflexslope
         )
     )
 
-    if realTime < testCapacity_antibody_country_firstday:
-        outAntiTotal = 0.0
-    else:
-        outAntiTotal = testCapacity_antibody_country_total * expit(
-            (realTime - testCapacity_antibody_country_inflexday).days
+    outAntiTotal = np.where(
+        realTime < testCapacity_antibody_country_firstday,
+        0.0,
+        testCapacity_antibody_country_total
+        * special.expit(
+            np.asarray((realTime - testCapacity_antibody_country_inflexday).days)
             / testCapacity_antibody_country_inflexslope
-        )
+        ),
+    )
 
     return {
         "PCR": outPCR,
@@ -925,18 +1570,297 @@ def trFunc_testCapacity(
     }
 
 
+@model_aware
 def inpFunc_testingDataCHESS_PCR(
-    realTime, realTestData=df_CHESS_numTests_regroup, **kwargs
+    realTime, realTestData=inputDefault("df_CHESS_numTests_regroup"), **kwargs
 ):
-    def nearest(items, pivot):
-        return min(items, key=lambda x: abs(x - pivot))
+    """
+    Real number of tests done per age group on the days of realTime (pd.DatetimeIndex).
+    Returns a tuple of
+        - boolean vector, True where realTestData has data on exactly that day
+        - len(realTime) x nAge array of the data on the closest day with data
+    """
 
-    return df_CHESS_numTests_regroup.loc[
-        nearest(
-            df_CHESS_numTests_regroup.index, pd.to_datetime(realTime, format="%Y-%m-%d")
-        )
+    # Sorted integer day index of the data, relative to the first day asked for
+    dataDays = np.asarray((realTestData.index - realTime[0]).days)
+    dataOrder = np.argsort(dataDays, kind="stable")
+    dataDays = dataDays[dataOrder]
+    dataValues = realTestData.to_numpy(dtype=float)[dataOrder]
+
+    days = np.asarray((realTime - realTime[0]).days)
+
+    # Closest day with data is either the first one not before the day, or the one before that (preferred if equally close)
+    afterInd = np.minimum(np.searchsorted(dataDays, days), len(dataDays) - 1)
+    beforeInd = np.maximum(afterInd - 1, 0)
+    closestInd = np.where(
+        np.abs(days - dataDays[beforeInd]) <= np.abs(dataDays[afterInd] - days),
+        beforeInd,
+        afterInd,
+    )
+
+    return dataDays[closestInd] == days, dataValues[closestInd]
+
+
+# Simulation calendar
+# -------------------
+
+# All configured dates are converted once to integer day offsets relative to the start of the simulation (realStartDate),
+# and the time-dependent inputs (policy flags, test capacity, real testing data) are precomputed as per-day vectors,
+# so no date arithmetic is done during the integration. Within the simulation, day "t" is int(t).
+
+calendarHorizonDays = 1024  # number of days the non-constant vectors are precomputed for (extended if the simulation runs longer)
+
+
+def date_toDayIndex(date, realStartDate):
+    """
+    Day offset (int) of date relative to realStartDate
+    """
+    return (
+        pd.to_datetime(date, format="%Y-%m-%d")
+        - pd.to_datetime(realStartDate, format="%Y-%m-%d")
+    ).days
+
+
+def parse_policyDates(value):
+    """
+    The start or stop date(s) of a policy (YYYY-MM-DD) as a pd.Timestamp, or a list of them if given as a list
+    (or a JSON list)
+    """
+    if isinstance(value, str) and value.strip().startswith("["):
+        value = json.loads(value)
+    if isinstance(value, (list, tuple, np.ndarray, pd.Index)):
+        return [pd.to_datetime(date, format="%Y-%m-%d") for date in value]
+
+    return pd.to_datetime(value, format="%Y-%m-%d")
+
+
+def policy_intervals(realStartDate, tStart, tStop):
+    """
+    Returns the (start day, stop day) intervals (relative to realStartDate) a policy is in place in, from tStart
+    until before tStop: single dates, or lists of dates of the same length (the i-th start with the i-th stop)
+    """
+    if isinstance(tStart, (list, tuple)) != isinstance(tStop, (list, tuple)) or (
+        isinstance(tStart, (list, tuple)) and len(tStart) != len(tStop)
+    ):
+        raise ValueError(f"policy_intervals: different numbers of start ({tStart}) and stop dates ({tStop})")
+    if not isinstance(tStart, (list, tuple)):
+        tStart, tStop = [tStart], [tStop]
+
+    return [
+        (date_toDayIndex(start, realStartDate), date_toDayIndex(stop, realStartDate))
+        for start, stop in zip(tStart, tStop)
+    ]
+
+
+# Parameters of dydt_Complete giving the policy start / stop dates
+policyDateParams = [
+    "tStartSocialDistancing",
+    "tStopSocialDistancing",
+    "tStartImmunityPassports",
+    "tStopImmunityPassports",
+    "tStartQuarantineCaseIsolation",
+    "tStopQuarantineCaseIsolation",
+]
+
+PolicyCalendar = namedtuple(
+    "PolicyCalendar",
+    [
+        "firstDay",  # day (relative to realStartDate) of the first entry of the vectors below
+        "socialDistancing",  # per-day boolean vectors of whether the policy is in place
+        "immunityPassports",
+        "quarantineCaseIsolation",
+    ],
+)
+
+
+def build_policyCalendar(
+    realStartDate,
+    tStartSocialDistancing,
+    tStopSocialDistancing,
+    tStartImmunityPassports,
+    tStopImmunityPassports,
+    tStartQuarantineCaseIsolation,
+    tStopQuarantineCaseIsolation,
+):
+    """
+    Returns the PolicyCalendar of the policy start / stop dates: each policy is in place from its start day, until before
+    its stop day, or in each interval of lists of start / stop dates (see policy_intervals)
+    """
+    policyIntervals = [
+        policy_intervals(realStartDate, tStart, tStop)
+        for tStart, tStop in [
+            (tStartSocialDistancing, tStopSocialDistancing),
+            (tStartImmunityPassports, tStopImmunityPassports),
+            (tStartQuarantineCaseIsolation, tStopQuarantineCaseIsolation),
+        ]
     ]
 
+    # The flags are constant before the earliest and after the latest of these days, so we only need to store the days in between
+    intervalDays = [day for intervals in policyIntervals for interval in intervals for day in interval] or [0]
+    firstDay = min(intervalDays) - 1
+    lastDay = max(intervalDays)
+    days = np.arange(firstDay, lastDay + 1)
+
+    policyFlags = []
+    for intervals in policyIntervals:
+        policyFlags.append(np.zeros(len(days), dtype=bool))
+        for startDay, stopDay in intervals:
+            policyFlags[-1] |= (days >= startDay) & (days < stopDay)
+        policyFlags[-1].setflags(write=False)
+
+    return PolicyCalendar(firstDay, *policyFlags)
+
+
+def policyCalendar(
+    realStartDate,
+    tStartSocialDistancing,
+    tStopSocialDistancing,
+    tStartImmunityPassports,
+    tStopImmunityPassports,
+    tStartQuarantineCaseIsolation,
+    tStopQuarantineCaseIsolation,
+):
+    """
+    Cached version of build_policyCalendar
+    """
+    policyDates = (
+        realStartDate,
+        tStartSocialDistancing,
+        tStopSocialDistancing,
+        tStartImmunityPassports,
+        tStopImmunityPassports,
+        tStartQuarantineCaseIsolation,
+        tStopQuarantineCaseIsolation,
+    )
+    # (lists of dates as tuples, to be hashable)
+    policyDates = tuple(tuple(dates) if isinstance(dates, list) else dates for dates in policyDates)
+
+    return cached_staticOperator(
+        ("policyCalendar",) + policyDates, build_policyCalendar, *policyDates
+    )
+
+
+def policyCalendar_flags(policyCalendar, t):
+    """
+    Returns the (socialDistancing, immunityPassports, quarantineCaseIsolation) flags on (float) day t
+    """
+    # The flags only change at integer days, so (t >= start) & (t < stop) is the same as looking up floor(t)
+    dayInd = min(
+        max(int(np.floor(t)) - policyCalendar.firstDay, 0),
+        len(policyCalendar.socialDistancing) - 1,
+    )
+
+    return (
+        policyCalendar.socialDistancing[dayInd],
+        policyCalendar.immunityPassports[dayInd],
+        policyCalendar.quarantineCaseIsolation[dayInd],
+    )
+
+
+def paramDict_policyCalendar(paramDict):
+    """
+    The (cached) PolicyCalendar of the parameters of dydt_Complete
+    """
+    return policyCalendar(paramDict["realStartDate"], *[paramDict[name] for name in policyDateParams])
+
+
+def policyCalendar_switchDays(policyCalendar, total_days):
+    """
+    Days 1 ... total_days - 1 on which any of the policies of the PolicyCalendar (of any member, for an ensemble's)
+    starts or stops
+    """
+    nCalendarDays = np.shape(policyCalendar.socialDistancing)[-1]
+    dayInds = np.clip(np.arange(total_days) - policyCalendar.firstDay, 0, nCalendarDays - 1)
+
+    switches = np.zeros(max(total_days - 1, 0), dtype=bool)
+    for policyFlags in policyCalendar[1:]:
+        policyFlags = np.asarray(policyFlags)[..., dayInds]
+        switches |= np.any(policyFlags[..., 1:] != policyFlags[..., :-1], axis=tuple(range(policyFlags.ndim - 1)))
+
+    return [int(day) + 1 for day in np.flatnonzero(switches)]
+
+
+TestingCalendar = namedtuple(
+    "TestingCalendar",
+    [
+        "testsAvailable",  # dict of test name -> nDays vector of the tests available on each day (trFunc_testCapacity)
+        "realDataAvailable",  # nDays boolean vector, True if there is real data on the number of tests done on that day
+        "realData",  # nDays x nAge real (closest available) number of tests done on each day
+    ],
+)
+
+
+def build_testingCalendar(
+    realStartDate,
+    nDays,
+    trFunc_testCapacity,
+    inpFunc_realData_testCapacity,
+    **kwargs,
+):
+    """
+    Returns the TestingCalendar of simulation days 0, ..., nDays-1
+    """
+    calendarDates = pd.date_range(
+        pd.to_datetime(realStartDate, format="%Y-%m-%d"), periods=nDays, freq="D"
+    )
+
+    testsAvailable = trFunc_testCapacity(
+        realTime=calendarDates, **kwargs["trFunc_testCapacity_params"]
+    )
+    testsAvailable = {
+        testType: np.broadcast_to(np.asarray(testsAvailable[testType], dtype=float), (nDays,))
+        for testType in testsAvailable
+    }
+
+    realDataAvailable, realData = inpFunc_realData_testCapacity(
+        realTime=calendarDates, **kwargs["inpFunc_realData_testCapacity_params"]
+    )
+    realDataAvailable = np.asarray(realDataAvailable, dtype=bool)
+    realData = np.asarray(realData, dtype=float)
+
+    for arr in list(testsAvailable.values()) + [realDataAvailable, realData]:
+        arr.setflags(write=False)
+
+    return TestingCalendar(testsAvailable, realDataAvailable, realData)
+
+
+def testingCalendar(
+    t,
+    realStartDate,
+    trFunc_testCapacity,
+    inpFunc_realData_testCapacity,
+    **kwargs,
+):
+    """
+    Cached version of build_testingCalendar, covering at least day int(t)
+    """
+    nDays = calendarHorizonDays
+    while int(t) >= nDays:
+        nDays *= 2
+
+    return cached_staticOperator(
+        (
+            "testingCalendar",
+            realStartDate,
+            nDays,
+            memoized_fingerprint(
+                [
+                    trFunc_testCapacity,
+                    inpFunc_realData_testCapacity,
+                    kwargs["trFunc_testCapacity_params"],
+                    kwargs["inpFunc_realData_testCapacity_params"],
+                ]
+            ),
+        ),
+        lambda: build_testingCalendar(
+            realStartDate,
+            nDays,
+            trFunc_testCapacity,
+            inpFunc_realData_testCapacity,
+            **kwargs,
+        ),
+    )
+
 
 # Symptom parameters
 # ------------------
@@ -955,14 +1879,14 @@ def inpFunc_testingDataCHESS_PCR(
 
 
 def f_symptoms_nonCOVID(
-    realTime,
+    realTime,  # simulation day (int, days since realStartDate)
     symptomsIliRCGP=15.0
     / 100000.0,  # Symptom rate in general non-hospitalised population
     symptomsRespInHospitalFAEs=1.1 / 17.1,  # Symptom rate in hospitalised population
     **kwargs,
 ):
     """
-    This function defines the non-COVID ILI symptoms rate in the population at a given t time
+    This function defines the non-COVID ILI symptoms rate in the population on simulation day realTime
     """
 
     # TODO, add extra data etc as input. For now:
@@ -979,29 +1903,42 @@ def distTestsSymp(
 ):
     """
     distribute tests amongst symptomatic people
-    people is nAge x nHS-1 x ... (excluding dead)
+    people is nAge x nHS-1 x ... (excluding dead),
+    with extra leading (ensemble) dimensions if testsAvailable is an array of per member numbers
     """
+    nBatchDims = np.ndim(testsAvailable)
+    nPeopleDims = people.ndim - nBatchDims
+    healthStateAxis = (slice(None),) * (nBatchDims + 1)
 
     # Calculate noncovid, but symptomatic people
     peopleSymp = copy.deepcopy(people)
-    peopleSymp[:, : min(symp_HS)] *= noncovid_sympRatio
-    peopleSymp[:, max(symp_HS) :] *= noncovid_sympRatio
+    peopleSymp[healthStateAxis + (slice(None, min(symp_HS)),)] *= batch_expand(
+        noncovid_sympRatio, nPeopleDims
+    )
+    peopleSymp[healthStateAxis + (slice(max(symp_HS), None),)] *= batch_expand(
+        noncovid_sympRatio, nPeopleDims
+    )
 
     # Subtract already tested people
     if alreadyTestedRate is not None:
         peopleSymp -= people * alreadyTestedRate
 
-    # Check if we already tested everyone with a different test
-    if np.sum(peopleSymp) < 1e-6:  # avoid numerical instabilities
-        return (0.0, 0.0)
+    peopleSympTotal = np.sum(peopleSymp, axis=tuple(range(nBatchDims, people.ndim)))
 
-    testedRatio = min(1.0, testsAvailable / np.sum(peopleSymp))
+    # Check if we already tested everyone with a different test
+    anyToTest = peopleSympTotal >= 1e-6  # avoid numerical instabilities
+    testedRatio = np.where(
+        anyToTest,
+        np.minimum(1.0, testsAvailable / np.where(anyToTest, peopleSympTotal, 1.0)),
+        0.0,
+    )
 
     return (
         # test rate
-        testedRatio * (peopleSymp / (people + 1e-6)),  # avoid dividing by zero
+        batch_expand(testedRatio, nPeopleDims)
+        * (peopleSymp / (people + 1e-6)),  # avoid dividing by zero
         # tests used to achieve this
-        testedRatio * np.sum(peopleSymp),
+        testedRatio * peopleSympTotal,
     )
 
 
@@ -1011,7 +1948,7 @@ def distTestsSymp(
 # Estimate at any one time how many people are getting tested (with which tests) from which health states
 def policyFunc_testing_symptomaticOnly(
     stateTensor,
-    realTime,
+    realTime,  # simulation day (int, days since realStartDate)
     # Test types (names correspoding to testSpecifications)
     testTypes,  # = ["PCR", "Antigen", "Antibody"],
     # Test Capacity (dict with names above and numbers available on day t)
@@ -1046,46 +1983,46 @@ def policyFunc_testing_symptomaticOnly(
     # Hospitalised people get priority over PCR tests
     testRate, testsUsed = distTestsSymp(
         people=stateTensor[
-            :, :-1, 2, 0
+            ..., :-1, 2, 0
         ],  # hospitalised non-positive people, exclude tested and dead people
         testsAvailable=testsAvailable["PCR"],
         noncovid_sympRatio=cur_noncovid_sympRatio[1],
     )
 
-    out_testRate[:, :-1, 2, 0, testTypes.index("PCR")] += testRate
+    out_testRate[..., :-1, 2, 0, testTypes.index("PCR")] += testRate
     testsAvailable["PCR"] -= testsUsed
 
     # Prioritise hospital workers next:
     # TODO: check if we should do this? In UK policy there was a 15% max for hospital worker testing until ~2 April...
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, 3, 0],
+        people=stateTensor[..., :-1, 3, 0],
         testsAvailable=testsAvailable["PCR"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
     )
 
-    out_testRate[:, :-1, 3, 0, testTypes.index("PCR")] += testRate
+    out_testRate[..., :-1, 3, 0, testTypes.index("PCR")] += testRate
     testsAvailable["PCR"] -= testsUsed
 
     # Distribute PCRs left over the other populations
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :2, 0],
+        people=stateTensor[..., :-1, :2, 0],
         testsAvailable=testsAvailable["PCR"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
     )
 
-    out_testRate[:, :-1, :2, 0, testTypes.index("PCR")] += testRate
+    out_testRate[..., :-1, :2, 0, testTypes.index("PCR")] += testRate
     testsAvailable["PCR"] -= testsUsed
 
     if distributeRemainingToRandom:
         # Distribute PCRs left over the other populations
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :, 0],
+            people=stateTensor[..., :-1, :, 0],
             testsAvailable=testsAvailable["PCR"],
             noncovid_sympRatio=1.0,
-            alreadyTestedRate=out_testRate[:, :-1, :, 0, testTypes.index("PCR")],
+            alreadyTestedRate=out_testRate[..., :-1, :, 0, testTypes.index("PCR")],
         )
 
-        out_testRate[:, :-1, :, 0, testTypes.index("PCR")] += testRate
+        out_testRate[..., :-1, :, 0, testTypes.index("PCR")] += testRate
         testsAvailable["PCR"] -= testsUsed
 
     # Antigen testing
@@ -1094,49 +2031,49 @@ def policyFunc_testing_symptomaticOnly(
     # Hospitalised people get priority over PCR tests
     testRate, testsUsed = distTestsSymp(
         people=stateTensor[
-            :, :-1, 2, 0
+            ..., :-1, 2, 0
         ],  # hospitalised non-positive people, exclude tested and dead people
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=cur_noncovid_sympRatio[1],
-        alreadyTestedRate=out_testRate[:, :-1, 2, 0, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, 2, 0, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, 2, 0, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, 2, 0, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Prioritise hospital workers next:
     # TODO: check if we should do this? In UK policy there was a 15% max for hospital worker testing until ~2 April...
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, 3, 0],
+        people=stateTensor[..., :-1, 3, 0],
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
-        alreadyTestedRate=out_testRate[:, :-1, 3, 0, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, 3, 0, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, 3, 0, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, 3, 0, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Distribute Antigen tests left over the other symptomatic people
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :2, 0],
+        people=stateTensor[..., :-1, :2, 0],
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=cur_noncovid_sympRatio[0],
-        alreadyTestedRate=out_testRate[:, :-1, :2, 0, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, :2, 0, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, :2, 0, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, :2, 0, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     if distributeRemainingToRandom:
         # Distribute antigen tests left over the other non-symptmatic populations
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :, 0],
+            people=stateTensor[..., :-1, :, 0],
             testsAvailable=testsAvailable["Antigen"],
             noncovid_sympRatio=1.0,
-            alreadyTestedRate=out_testRate[:, :-1, :, 0, :].sum(-1),
+            alreadyTestedRate=out_testRate[..., :-1, :, 0, :].sum(-1),
         )
 
-        out_testRate[:, :-1, :, 0, testTypes.index("Antigen")] += testRate
+        out_testRate[..., :-1, :, 0, testTypes.index("Antigen")] += testRate
         testsAvailable["Antigen"] -= testsUsed
 
     # Antibody testing
@@ -1146,56 +2083,56 @@ def policyFunc_testing_symptomaticOnly(
 
         # For now: give to hospital workers first, not taking into account previous tests or symptoms
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, 3, :2],
+            people=stateTensor[..., :-1, 3, :2],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically workers get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, 3, :2, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, 3, :2, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
         # Afterwards let's just distribute randomly in the rest of the population
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :3, :2],
+            people=stateTensor[..., :-1, :3, :2],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, :3, :2, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, :3, :2, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
     if antibody_testing_policy == "virus_positive_only_hospworker_first":
 
         # For now: give to hospital workers first, not taking into account previous tests or symptoms
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, 3, 1],
+            people=stateTensor[..., :-1, 3, 1],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically workers get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, 3, 1, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, 3, 1, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
         # Afterwards let's just distribute randomly in the rest of the population
         # TODO: Maybe prioratise people who tested positive for the virus before???
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :3, 1],
+            people=stateTensor[..., :-1, :3, 1],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, :3, 1, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, :3, 1, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
     if antibody_testing_policy == "virus_positive_only":
 
         testRate, testsUsed = distTestsSymp(
-            people=stateTensor[:, :-1, :, 1],
+            people=stateTensor[..., :-1, :, 1],
             testsAvailable=testsAvailable["Antibody"],
             noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
         )
 
-        out_testRate[:, :-1, :, 1, testTypes.index("Antibody")] += testRate
+        out_testRate[..., :-1, :, 1, testTypes.index("Antibody")] += testRate
         testsAvailable["Antibody"] -= testsUsed
 
     if antibody_testing_policy == "none":
@@ -1211,7 +2148,7 @@ def policyFunc_testing_symptomaticOnly(
 # Define reTesting policy(s) (ie give tests to people in non-0 test states!)
 def policyFunc_testing_massTesting_with_reTesting(
     stateTensor,
-    realTime,
+    realTime,  # simulation day (int, days since realStartDate)
     # Test types (names correspoding to testSpecifications)
     testTypes,  # = ["PCR", "Antigen", "Antibody"],
     # Test Capacity (dict with names above and numbers available on day t)
@@ -1265,46 +2202,46 @@ def policyFunc_testing_massTesting_with_reTesting(
 
     # Retesting immune positive people
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :, 2:],  # immune positive people
+        people=stateTensor[..., :-1, :, 2:],  # immune positive people
         testsAvailable=testsAvailable["Antigen"] * retesting_antigen_immunepos_ratio,
         noncovid_sympRatio=1.0,  # set to 1. for ignoring symptom vs non-symptom
     )
 
-    out_testRate[:, :-1, :, 2:, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, :, 2:, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Distribute antigen tests left over the other non-symptmatic populations
     # UPDATE <- here we use tests equally distributed among people with negative or positive previous virus tests,
     # as long as they are in non-quarantined state (isoState 0) # TODO - hospital worker testing???
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, 0, :2],  # non-quarantined virus positive people
+        people=stateTensor[..., :-1, 0, :2],  # non-quarantined virus positive people
         testsAvailable=testsAvailable["Antigen"],
         noncovid_sympRatio=1.0,
-        alreadyTestedRate=out_testRate[:, :-1, 0, :2, testTypes.index("Antigen")]
-        + out_testRate[:, :-1, 0, :2, testTypes.index("PCR")],
+        alreadyTestedRate=out_testRate[..., :-1, 0, :2, testTypes.index("Antigen")]
+        + out_testRate[..., :-1, 0, :2, testTypes.index("PCR")],
     )
 
-    out_testRate[:, :-1, 0, :2, testTypes.index("Antigen")] += testRate
+    out_testRate[..., :-1, 0, :2, testTypes.index("Antigen")] += testRate
     testsAvailable["Antigen"] -= testsUsed
 
     # Antibody testing
     # -----------------
     # Retesting antibody positive people
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :, 2:],  # virus positive people
+        people=stateTensor[..., :-1, :, 2:],  # virus positive people
         testsAvailable=testsAvailable["Antibody"] * retesting_antibody_immunepos_ratio,
         noncovid_sympRatio=1.0,  # set to 1. for ignoring symptom vs non-symptom
     )
 
     # Afterwards let's just distribute randomly in the rest of the population
     testRate, testsUsed = distTestsSymp(
-        people=stateTensor[:, :-1, :, :2],
+        people=stateTensor[..., :-1, :, :2],
         testsAvailable=testsAvailable["Antibody"],
         noncovid_sympRatio=1.0,  # basically people get antibody tested regardless of symptoms
-        alreadyTestedRate=out_testRate[:, :-1, :, :2, testTypes.index("Antibody")],
+        alreadyTestedRate=out_testRate[..., :-1, :, :2, testTypes.index("Antibody")],
     )
 
-    out_testRate[:, :-1, :, :2, testTypes.index("Antibody")] += testRate
+    out_testRate[..., :-1, :, :2, testTypes.index("Antibody")] += testRate
     testsAvailable["Antibody"] -= testsUsed
 
     if return_testsAvailable_remaining:
@@ -1313,53 +2250,39 @@ def policyFunc_testing_massTesting_with_reTesting(
     return out_testRate
 
 
-def trFunc_testing(
+def testing_administeredRate(
     stateTensor,
-    t,
-    realStartDate,
-    #policyFunc = policyFunc_testing_symptomaticOnly,
-    policyFunc=policyFunc_testing_massTesting_with_reTesting,
-    inpFunc_testSpecifications=inpFunc_testSpecifications,
-    trFunc_testCapacity=trFunc_testCapacity,
-    inpFunc_realData_testCapacity=inpFunc_testingDataCHESS_PCR,
+    curDay,
+    testTypes,
+    realDataAvailable,
+    realData,
+    testsAvailable,
+    policyFunc,
     **kwargs,
 ):
     """
-    Returns a tensor of rates transitioning to tested states
+    Returns the stateTensor x testTypes rates of administering each test type on day curDay:
+    the real number of tests done if realDataAvailable, otherwise as distributed by the policyFunc given testsAvailable.
+    stateTensor may have leading ensemble dimensions, then realDataAvailable, realData and testsAvailable have them too
     """
-    trTensor_testTransitions = np.zeros((nAge, nHS, nIso, nTest, nTest))
-
-    testSpecifications = inpFunc_testSpecifications(
-        **kwargs["inpFunc_testSpecifications_params"]
-    )
-
-    testTypes = list(set(testSpecifications["Name"]))
+    useRealData = np.any(realDataAvailable)
+    usePolicy = not np.all(realDataAvailable)
 
     # Check if we have real data on the administered tests
 
-    # Add the current data on within-hospital PCRs carried out already
-    curDate = pd.to_datetime(realStartDate, format="%Y-%m-%d") + pd.to_timedelta(
-        int(t), unit="D"
-    )
-    realData_closest = inpFunc_realData_testCapacity(
-        realTime=curDate, **kwargs["inpFunc_realData_testCapacity_params"]
-    )
-
-    if realData_closest.name == curDate:  # We do have data, just fill it in
-        testsAdministeredRate = np.zeros(stateTensor.shape + (len(testTypes),))
+    if useRealData:  # We do have data, just fill it in
+        realData_testsAdministeredRate = np.zeros(stateTensor.shape + (len(testTypes),))
 
         # TODO - fix this very hacky solution accessing symptomatic ratio as a subfunc of the policy func
-        noncovid_sympRatio = kwargs["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID"](curDate, **kwargs["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID_params"])
+        noncovid_sympRatio = kwargs["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID"](curDay, **kwargs["policyFunc_params"]["basic_policyFunc_params"]["f_symptoms_nonCOVID_params"])
 
         noncovid_sympRatio = noncovid_sympRatio[1]  # Use hospitalised patient symptom ratio
-        symptomaticRatePerDiseaseState = np.array([noncovid_sympRatio] * stateTensor.shape[1])
-        symptomaticRatePerDiseaseState[3 : -(nR + 1)] = 1.0  # set the symptomatic ratio of symptomatic states to 1
-        symptomaticPeoplePerDiseaseStateInHospital = stateTensor[:, :-1, 2, 0] * np.expand_dims(symptomaticRatePerDiseaseState[:-1], axis=0)
-
-        testsAdministeredRate[:, :-1, 2, 0, testTypes.index("PCR")] += (
-            np.expand_dims(
-                realData_closest.to_numpy(), 1
-            )  # true number of tests on given day per age group
+        symptomaticRatePerDiseaseState = np.multiply.outer(noncovid_sympRatio, np.ones(stateTensor.shape[-3]))
+        symptomaticRatePerDiseaseState[..., 3 : -(nR + 1)] = 1.0  # set the symptomatic ratio of symptomatic states to 1
+        symptomaticPeoplePerDiseaseStateInHospital = stateTensor[..., :-1, 2, 0] * symptomaticRatePerDiseaseState[..., np.newaxis, :-1]
+
+        realData_testsAdministeredRate[..., :-1, 2, 0, testTypes.index("PCR")] += (
+            realData[..., :, np.newaxis]  # true number of tests on given day per age group
             * (
                 symptomaticPeoplePerDiseaseStateInHospital
                 / np.sum(
@@ -1368,101 +2291,107 @@ def trFunc_testing(
             )
             # Calculate in what ratio we distribute the tests to people along disease states based on symptomatic (age is given in data!)
         ) / (
-            stateTensor[:, :-1, 2, 0] + 1e-10
+            stateTensor[..., :-1, 2, 0] + 1e-10
         )  # Divide by total people in each state to get testing rate
 
-    else:  # we don't have data, follow our assumed availability and policy curves
+    if usePolicy:  # we don't have data, follow our assumed availability and policy curves
 
         # policyFunc returns stateTensor x testTypes tensor of test administration rates
-        testsAdministeredRate = policyFunc(
+        policy_testsAdministeredRate = policyFunc(
             stateTensor,
-            realTime=curDate,
+            realTime=curDay,
             testTypes=testTypes,
-            testsAvailable=trFunc_testCapacity(
-                realTime=curDate, **kwargs["trFunc_testCapacity_params"]
-            ),
+            testsAvailable=testsAvailable,
             **kwargs["policyFunc_params"],
         )
 
-    # Compute the transition ratio to tested states, given the administered tests
+    if not usePolicy:
+        return realData_testsAdministeredRate
+    if not useRealData:
+        return policy_testsAdministeredRate
 
-    for testType in testTypes:
-        # Get the appropriate slices from testsAdmin. and testSpecs
-        curTestSpecs = testSpecifications[testSpecifications["Name"] == testType]
+    # Ensemble members with and without real data on the day
+    return np.where(
+        batch_expand(realDataAvailable, 5),
+        realData_testsAdministeredRate,
+        policy_testsAdministeredRate,
+    )
 
-        for curTS in range(nTest):
-            # Set output positive test state based on current test state
-            if curTS == int(curTestSpecs["OutputTestState"].values[0]):
-                # already positive for the given test
-                outTS_pos = curTS
-            elif curTS == 3:
-                # If already positive for both, stay positive
-                outTS_pos = 3
-            else:
-                # Transition 0->1, 0->2, 1->2, 1->3 or 2->3
-                outTS_pos = curTS + int(curTestSpecs["OutputTestState"].values[0])
 
-            # Where do we go after negative test based on where we are now?
-            if curTS == 0:
-                # Negatives stay negatives
-                outTS_neg = 0
-            elif curTS == 3:
-                # go to only virus or antibody positive from both positive
-                outTS_neg = 3 - int(curTestSpecs["OutputTestState"].values[0])
-            elif curTS == int(curTestSpecs["OutputTestState"].values[0]):
-                # go to 0 if tested for the one you're positive for
-                outTS_neg = 0
-            else:
-                # stay where you are if you test negative for the one you didnt have anyway
-                outTS_neg = curTS
-
-            # Get the transition rates based on current health states
-            for curHS in range(nHS):
-                # Add the true positives * (1-FNR)
-                if curHS in curTestSpecs["TruePosHealthState"].values[0]:
-                    trTensor_testTransitions[
-                        :, curHS, :, curTS, outTS_pos
-                    ] += testsAdministeredRate[
-                        :, curHS, :, curTS, testTypes.index(testType)
-                    ] * (
-                        1
-                        - curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalseNegativeRate"
-                        ].values[0]
-                    )
-
-                else:
-                    # Add the false positives * FPR
-                    trTensor_testTransitions[:, curHS, :, curTS, outTS_pos] += (
-                        testsAdministeredRate[
-                            :, curHS, :, curTS, testTypes.index(testType)
-                        ]
-                        * curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalsePositiveRate"
-                        ].values[0]
-                    )
-
-                # Add the false negatives (FNR)
-                if curHS in curTestSpecs["TruePosHealthState"].values[0]:
-                    trTensor_testTransitions[:, curHS, :, curTS, outTS_neg] += (
-                        testsAdministeredRate[
-                            :, curHS, :, curTS, testTypes.index(testType)
-                        ]
-                        * curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalseNegativeRate"
-                        ].values[0]
-                    )
-
-                else:
-                    # Add the true negatives * (1-FNR)
-                    trTensor_testTransitions[:, curHS, :, curTS, outTS_neg] += (
-                        testsAdministeredRate[
-                            :, curHS, :, curTS, testTypes.index(testType)
-                        ]
-                        * curTestSpecs[curTestSpecs["InputHealthState"] == curHS][
-                            "FalsePositiveRate"
-                        ].values[0]
-                    )
+def compiledTestSpecifications(
+    inpFunc_testSpecifications, inpFunc_testSpecifications_params
+):
+    """
+    Returns the CompiledTestSpecifications given by inpFunc_testSpecifications
+    """
+    testSpecifications = inpFunc_testSpecifications(**inpFunc_testSpecifications_params)
+    if isinstance(testSpecifications, pd.DataFrame):
+        # Specifications given as a table, compile them into arrays once per parameter set
+        testSpecifications = cached_staticOperator(
+            (
+                "compile_testSpecifications",
+                paramDict_fingerprint(
+                    [inpFunc_testSpecifications, inpFunc_testSpecifications_params]
+                ),
+            ),
+            compile_testSpecifications,
+            testSpecifications,
+        )
+
+    return testSpecifications
+
+
+@model_aware
+def trFunc_testing(
+    stateTensor,
+    t,
+    realStartDate,
+    #policyFunc = policyFunc_testing_symptomaticOnly,
+    policyFunc=policyFunc_testing_massTesting_with_reTesting,
+    inpFunc_testSpecifications=inpFunc_testSpecifications,
+    trFunc_testCapacity=trFunc_testCapacity,
+    inpFunc_realData_testCapacity=inpFunc_testingDataCHESS_PCR,
+    **kwargs,
+):
+    """
+    Returns a tensor of rates transitioning to tested states
+    """
+
+    testSpecifications = compiledTestSpecifications(
+        inpFunc_testSpecifications, kwargs["inpFunc_testSpecifications_params"]
+    )
+
+    testTypes = testSpecifications.testTypes
+
+    # Test capacity and real data per simulation day (realTime passed on to the policy functions is this integer day)
+    curDay = max(int(t), 0)
+    calendar = testingCalendar(
+        t,
+        realStartDate,
+        trFunc_testCapacity=trFunc_testCapacity,
+        inpFunc_realData_testCapacity=inpFunc_realData_testCapacity,
+        **kwargs,
+    )
+
+    testsAdministeredRate = testing_administeredRate(
+        stateTensor,
+        curDay,
+        testTypes,
+        realDataAvailable=calendar.realDataAvailable[curDay],
+        realData=calendar.realData[curDay],
+        testsAvailable={
+            testType: calendar.testsAvailable[testType][curDay]
+            for testType in calendar.testsAvailable
+        },
+        policyFunc=policyFunc,
+        **kwargs,
+    )
+
+    # Compute the transition ratio to tested states, given the administered tests
+    # (positive and negative results routed to the appropriate test states, for all test types at once)
+    trTensor_testTransitions = np.einsum(
+        "ijklt,tjlm->ijklm", testsAdministeredRate, testSpecifications.testOutcomeRates
+    )
 
     return trTensor_testTransitions  # , testsAdministeredRate
 
@@ -1474,78 +2403,68 @@ def trFunc_testing(
 # One alternative is case isolation, either by hospitalisation or by home isolation. We will assume that all non-symptomatic people who test
 # positive are home isolated along with families for
 # nDaysInIsolation days. Symptomatic people have a chance of being immediately hospitalised instead of sent into home isolation
-def trFunc_quarantine_caseIsolation(
-    trTensor_complete,
-    t,
-    trTensor_testing,  # This is used to establish who gets tests and how many of those end up positive.
-    nDaysInHomeIsolation=nDaysInHomeIsolation,
-    timeToIsolation=0.5,  # (days) time from testing positive to actually getting isolated
-    # On average this many people get hospitalised (compared to home isolation), but modulated by age (TODO: values > 1? clip for now..)
-    symptomHospitalisedRate_ageAdjusted=np.clip(
-        adjustRatesByAge_KeepAverageRate(
-            0.3, ageRelativeAdjustment=relativeAdmissionRisk_given_COVID_by_age
-        ),
-        0.0,
-        1.0,
-    ),
-    symptomaticHealthStates=[
-        3,
-        4,
-    ],  # TODO - define this in global variable and just pass here!
+# Rates of moving people to home isolation or hospital after a positive test, and of releasing them from home isolation
+def quarantineRate_caseIsolation(
+    trTensor_testing,
+    nDaysInHomeIsolation,
+    timeToIsolation,
+    symptomHospitalisedRate_ageAdjusted,
+    symptomaticHealthStates,
     **kwargs,
 ):
-    """
-    This function redistributes testing rates, so they dont only create a testing state update, but also an isolation state update
-    """
-    trTensor_quarantineRate = np.zeros(stateTensor.shape + (nIso,))
+    """This is a helper function and wont be picked up as a model parameter!
+    Returns a stateTensor x nIso tensor of isolation state transition rates
+    (trTensor_testing and the parameters may have leading ensemble dimensions)"""
+    trTensor_quarantineRate = np.zeros(trTensor_testing.shape[:-1] + (nIso,))
 
     trTensor_freshlyVirusPositiveRate_inIso0 = copy.deepcopy(
-        trTensor_testing[:, :, 0, :2, 1]
+        trTensor_testing[..., 0, :2, 1]
     )
     trTensor_freshlyBothPositiveRate_inIso0 = copy.deepcopy(
-        trTensor_testing[:, :, 0, 2:, 3]
+        trTensor_testing[..., 0, 2:, 3]
     )
 
+    isolationRate = 1.0 / batch_expand(timeToIsolation, 2)
+    symptomHospitalisedRate = symptomHospitalisedRate_ageAdjusted[..., np.newaxis]
+
     for curHS in range(stateTensor.shape[1] - 1):  # ignore dead
         if curHS in symptomaticHealthStates:
             # Send a fraction of people (normal) who are symptomatic and tested positive to hospital, based on their age
-            trTensor_quarantineRate[:, curHS, 0, :2, 2] += (
-                (1.0 / timeToIsolation)
-                * symptomHospitalisedRate_ageAdjusted[:, np.newaxis]
-                * trTensor_freshlyVirusPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, :2, 2] += (
+                isolationRate
+                * symptomHospitalisedRate
+                * trTensor_freshlyVirusPositiveRate_inIso0[..., curHS, :]
             )
-            trTensor_quarantineRate[:, curHS, 0, 2:, 2] += (
-                (1.0 / timeToIsolation)
-                * symptomHospitalisedRate_ageAdjusted[:, np.newaxis]
-                * trTensor_freshlyBothPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, 2:, 2] += (
+                isolationRate
+                * symptomHospitalisedRate
+                * trTensor_freshlyBothPositiveRate_inIso0[..., curHS, :]
             )
             # The rest to home isolation
-            trTensor_quarantineRate[:, curHS, 0, :2, 1] += (
-                (1.0 / timeToIsolation)
-                * (1.0 - symptomHospitalisedRate_ageAdjusted[:, np.newaxis])
-                * trTensor_freshlyVirusPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, :2, 1] += (
+                isolationRate
+                * (1.0 - symptomHospitalisedRate)
+                * trTensor_freshlyVirusPositiveRate_inIso0[..., curHS, :]
             )
-            trTensor_quarantineRate[:, curHS, 0, 2:, 1] += (
-                (1.0 / timeToIsolation)
-                * (1.0 - symptomHospitalisedRate_ageAdjusted[:, np.newaxis])
-                * trTensor_freshlyBothPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, 2:, 1] += (
+                isolationRate
+                * (1.0 - symptomHospitalisedRate)
+                * trTensor_freshlyBothPositiveRate_inIso0[..., curHS, :]
             )
 
         else:
             # Send all non-symptomatic (normal) who tested freshly positive to home isolation
-            trTensor_quarantineRate[:, curHS, 0, :2, 1] += (
-                1.0
-                / timeToIsolation
-                * trTensor_freshlyVirusPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, :2, 1] += (
+                isolationRate
+                * trTensor_freshlyVirusPositiveRate_inIso0[..., curHS, :]
             )
-            trTensor_quarantineRate[:, curHS, 0, 2:, 1] += (
-                1.0
-                / timeToIsolation
-                * trTensor_freshlyBothPositiveRate_inIso0[:, curHS]
+            trTensor_quarantineRate[..., curHS, 0, 2:, 1] += (
+                isolationRate
+                * trTensor_freshlyBothPositiveRate_inIso0[..., curHS, :]
             )
 
     # Release people from home isolation after isolation period
-    trTensor_quarantineRate[:, :, 1, :, 0] = 1.0 / nDaysInHomeIsolation
+    trTensor_quarantineRate[..., :, 1, :, 0] = 1.0 / batch_expand(nDaysInHomeIsolation, 3)
 
     # Hospitalised people are assumed to be released after recovery, with normal rates (TODO: think if this is correct)
 
@@ -1555,6 +2474,35 @@ def trFunc_quarantine_caseIsolation(
     # A simple (slightly incorrect) solution would be to just implement a non-specific "pull" from isoState=0 people to hospital workers to fill up the missing people?
     # But the rate of this pull would be impossible to compute and would still be incorrect. Gotta think more on this.
 
+    return trTensor_quarantineRate
+
+
+@model_aware
+def trFunc_quarantine_caseIsolation(
+    trTensor_complete,
+    t,
+    trTensor_testing,  # This is used to establish who gets tests and how many of those end up positive.
+    nDaysInHomeIsolation=inputDefault("nDaysInHomeIsolation"),
+    timeToIsolation=0.5,  # (days) time from testing positive to actually getting isolated
+    # On average this many people get hospitalised (compared to home isolation), but modulated by age (TODO: values > 1? clip for now..)
+    symptomHospitalisedRate_ageAdjusted=inputDefault("symptomHospitalisedRate_ageAdjusted"),
+    symptomaticHealthStates=[
+        3,
+        4,
+    ],  # TODO - define this in global variable and just pass here!
+    **kwargs,
+):
+    """
+    This function redistributes testing rates, so they dont only create a testing state update, but also an isolation state update
+    """
+    trTensor_quarantineRate = quarantineRate_caseIsolation(
+        trTensor_testing,
+        nDaysInHomeIsolation=nDaysInHomeIsolation,
+        timeToIsolation=timeToIsolation,
+        symptomHospitalisedRate_ageAdjusted=symptomHospitalisedRate_ageAdjusted,
+        symptomaticHealthStates=symptomaticHealthStates,
+    )
+
     # Update the whole tensor accordingly
     # Make a copy for safety:
     out_trTensor_complete = copy.deepcopy(trTensor_complete)
@@ -1590,49 +2538,654 @@ def trFunc_quarantine_caseIsolation(
     return out_trTensor_complete
 
 
-# ## Full simulation function
-# Function that computes the right side of the non-lin model ODE
-def dydt_Complete(
-    t,
-    stateTensor_flattened,  # Might be double the normal size (as first dimension) _withNewOnlyCopy, if debugReturnNewPerDay
-    realStartDate = testingStartDate,
-    #realStartDate=pd.to_datetime("2020-02-20", format="%Y-%m-%d"),
-    # debug
-    debugTransition=False,
-    debugTimestep=False,
-    debugReturnNewPerDay=True,  # Now implemented by default into state iteration
-    # Dimensions
-    nAge=nAge,
-    nHS=nHS,
-    nI=nI,
-    nR=nR,
-    nIso=nIso,
-    nTest=nTest,
-    # Input functions and tensors
-    # ----------------------------
-    
-    # Health state updates
-    trFunc_diseaseProgression=trFunc_diseaseProgression,
-    trFunc_newInfections=trFunc_newInfections_Complete,
-    
-    # Initial incoming travel-based infections (before restrictions)
-    trFunc_travelInfectionRate_ageAdjusted=trFunc_travelInfectionRate_ageAdjusted,
-    
-    # Hospitalisation and recovery
-    trFunc_HospitalAdmission=trFunc_HospitalAdmission,
-    trFunc_HospitalDischarge=trFunc_HospitalDischarge,
-    
-    # Policy changes (on social distancing for now) (TODO - possibly make more changes)
-    tStartSocialDistancing=tStartSocialDistancing,
-    tStopSocialDistancing=tStopSocialDistancing,
-    tStartImmunityPassports=tStartImmunityPassports,
-    tStopImmunityPassports=tStopImmunityPassports,
-    tStartQuarantineCaseIsolation=tStartQuarantineCaseIsolation,
-    tStopQuarantineCaseIsolation=tStopQuarantineCaseIsolation,
-    trFunc_quarantine=trFunc_quarantine_caseIsolation,
+# ## Static transition operators
+#
+# Disease progression, hospital admission and hospital discharge do not depend on time or on the current state,
+# only on their parameters. We build their part of the full transition tensor once per parameter set
+# and reuse it across all evaluations of dydt_Complete (until the relevant "_params" change).
+
+staticOperatorCacheSize = 16  # number of distinct parameter sets to keep precomputed operators for
+_staticOperatorCache = OrderedDict()  # shared cache, used outside of model_context
+_staticOperatorCacheLock = threading.Lock()
+
+
+def build_staticTransitionTensor(
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    trFunc_diseaseProgression_params,
+    trFunc_HospitalAdmission_params,
+    trFunc_HospitalDischarge_params,
+):
+    """
+    Returns the time-invariant part of the full nAge x nHS x nIso x nTest x nHS x nIso x nTest transition tensor
+    """
+    trTensor_static = np.zeros((nAge, nHS, nIso, nTest, nHS, nIso, nTest))
+
+    # Get disease condition updates with no isolation or test transition ("diagonal along those")
+    trTensor_diseaseProgression = trFunc_diseaseProgression(
+        **trFunc_diseaseProgression_params
+    )
+    for k1 in [0, 1, 2, 3]:
+        np.einsum("ijlml->ijlm", trTensor_static[:, :, k1, :, :, k1, :])[
+            :
+        ] += np.expand_dims(
+            trTensor_diseaseProgression[:, :, k1, :], [2]
+        )  # all non-hospitalised disease progression is same
+
+    # Hospitalisation state updates
+    # We assume for now that these only depend on age and disease progression, not on testing state
+    # (TODO - update this given new policies)
+
+    # The disease and testing states don't change due to hospitalisation.
+    # Hospital staff is treated as already hospitalised from all aspects expect social mixing, should suffice for now
+    # TODO - Could try to devise a scheme in which hospital staff gets hospitalised and some recoveries from hospitalised state go back to hospital staff.
+    # TODO - same issue with hospital staff home isolating; that's probably more important question!
+    trTensor_HospitalAdmission = trFunc_HospitalAdmission(
+        **trFunc_HospitalAdmission_params
+    )
+    for k1 in [0, 1]:
+        np.einsum("ijljl->ijl", trTensor_static[:, :, k1, :, :, 2, :])[
+            :
+        ] += np.expand_dims(trTensor_HospitalAdmission, [2])
+
+    # Add recovery from hospital rates
+    # TODO - again here (for now) we assume all discharged people go back to "normal state" instead of home isolation, have to think more on this
+    np.einsum("ijljl->ijl", trTensor_static[:, :, 2, :, :, 0, :])[
+        :
+    ] += np.expand_dims(
+        trFunc_HospitalDischarge(**trFunc_HospitalDischarge_params), [2]
+    )
+
+    return trTensor_static
+
+
+def staticOperatorKey(
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    **kwargs,
+):
+    """
+    Fingerprint of the functions and "_params" sub-dicts the static transition operators are built from
+    (computed once per solve, see memoized_fingerprint)
+    """
+    return memoized_fingerprint(
+        [
+            trFunc_diseaseProgression,
+            trFunc_HospitalAdmission,
+            trFunc_HospitalDischarge,
+            kwargs["trFunc_diseaseProgression_params"],
+            kwargs["trFunc_HospitalAdmission_params"],
+            kwargs["trFunc_HospitalDischarge_params"],
+        ]
+    )
+
+
+def cached_staticOperator(cacheKey, buildFunc, *args):
+    """
+    Returns buildFunc(*args), only computing it once per cacheKey (for the last staticOperatorCacheSize keys).
+    Cached in the operatorCache of the current model (see model_context), or in the shared cache.
+    """
+    model = currentModel.get()
+    cache = _staticOperatorCache if model is None else model.operatorCache
+
+    with _staticOperatorCacheLock:
+        if cacheKey in cache:
+            cache.move_to_end(cacheKey)
+            return cache[cacheKey]
+
+    # (built outside the lock, two threads may build the same operator, both results are equal)
+    out = buildFunc(*args)
+
+    with _staticOperatorCacheLock:
+        cache[cacheKey] = out
+        while len(cache) > staticOperatorCacheSize:
+            cache.popitem(last=False)
+
+    return out
+
+
+def staticTransitionTensor(
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    **kwargs,
+):
+    """
+    Cached version of build_staticTransitionTensor, keyed by the fingerprint of the relevant "_params" sub-dicts.
+    The returned tensor is read-only, copy it before modifying.
+    """
+
+    def buildReadOnly():
+        trTensor_static = build_staticTransitionTensor(
+            trFunc_diseaseProgression,
+            trFunc_HospitalAdmission,
+            trFunc_HospitalDischarge,
+            kwargs["trFunc_diseaseProgression_params"],
+            kwargs["trFunc_HospitalAdmission_params"],
+            kwargs["trFunc_HospitalDischarge_params"],
+        )
+        trTensor_static.setflags(write=False)
+        return trTensor_static
+
+    return cached_staticOperator(
+        (
+            "staticTransitionTensor",
+            staticOperatorKey(
+                trFunc_diseaseProgression,
+                trFunc_HospitalAdmission,
+                trFunc_HospitalDischarge,
+                **kwargs,
+            ),
+        ),
+        buildReadOnly,
+    )
+
+
+# ## Sparse transition engine
+#
+# Alternative to building the dense nAge x nHS x nIso x nTest x nHS x nIso x nTest tensor on every evaluation:
+# the transition generator over the flattened nAge*nHS*nIso*nTest states is assembled as a sparse matrix,
+# whose sparsity pattern is fixed (built once per static parameter set), only the values change between evaluations.
+# The matrix is stored transposed (rows are the to-states), such that dydt = trMatrix_complete.dot(state).
+
+SparseTransitionLayout = namedtuple(
+    "SparseTransitionLayout",
+    [
+        "nStates",
+        "indptr",  # CSR structure of the (transposed) generator
+        "indices",
+        "fromState",  # from-state of each stored entry
+        "staticSlots",  # stored entries (and values) of the time-invariant transitions
+        "staticValues",
+        "infectionSlots",  # nAge x nIso x nTest, S -> E
+        "testingSlots",  # nAge x nHS x nIso x nTest x nTest, diagonal in age, health and isolation state
+        "quarantineMaskSlots",  # entries removed when case isolation is on
+        "quarantineSlots",  # entries set when case isolation is on, in the order of sparse_quarantineRateValues
+        "diagonalSlots",  # nAge*nHS*nIso*nTest
+    ],
+)
+
+
+def sparse_quarantineRateValues(trTensor_quarantineRate):
+    """Flattens the isolation transitions of a quarantine rate tensor in the order of SparseTransitionLayout.quarantineSlots"""
+    return np.concatenate(
+        [
+            trTensor_quarantineRate[:, :, 0, :2, 1].reshape(-1),  # newly virus positive, home isolated
+            trTensor_quarantineRate[:, :, 0, 2:, 1].reshape(-1),
+            trTensor_quarantineRate[:, :, 0, :2, 2].reshape(-1),  # newly virus positive, hospitalised
+            trTensor_quarantineRate[:, :, 0, 2:, 2].reshape(-1),
+            trTensor_quarantineRate[:, :, 1, :, 0].reshape(-1),  # released from home isolation
+        ]
+    )
+
+
+def build_sparseTransitionLayout(trTensor_static):
+    nStates = nAge * nHS * nIso * nTest
+    stateIndex = np.arange(nStates).reshape(nAge, nHS, nIso, nTest)
+
+    # Time-invariant transitions, as given by the static tensor (that is diagonal in age)
+    nStatesPerAge = nStates // nAge
+    trMatrix_static = trTensor_static.reshape(nAge, nStatesPerAge, nStatesPerAge)
+    staticAge, staticFrom, staticTo = np.nonzero(trMatrix_static)
+    staticValues = trMatrix_static[staticAge, staticFrom, staticTo]
+    staticFrom = staticFrom + staticAge * nStatesPerAge
+    staticTo = staticTo + staticAge * nStatesPerAge
+
+    # New infections (and travel), S -> E without isolation or test transition
+    infectionFrom = stateIndex[:, 0, :, :]
+    infectionTo = stateIndex[:, 1, :, :]
+
+    # Testing, diagonal in everything except the test state
+    testingFrom = np.broadcast_to(stateIndex[..., np.newaxis], stateIndex.shape + (nTest,))
+    testingTo = np.broadcast_to(stateIndex[..., np.newaxis, :], stateIndex.shape + (nTest,))
+
+    # Case isolation, see trFunc_quarantine_caseIsolation
+    quarantineFrom = np.concatenate(
+        [
+            stateIndex[:, :, 0, :2].reshape(-1),
+            stateIndex[:, :, 0, 2:].reshape(-1),
+            stateIndex[:, :, 0, :2].reshape(-1),
+            stateIndex[:, :, 0, 2:].reshape(-1),
+            stateIndex[:, :, 1, :].reshape(-1),
+        ]
+    )
+    quarantineTo = np.concatenate(
+        [
+            np.repeat(stateIndex[:, :, 1, 1], 2, axis=-1).reshape(-1),
+            np.repeat(stateIndex[:, :, 1, 3], 2, axis=-1).reshape(-1),
+            np.repeat(stateIndex[:, :, 2, 1], 2, axis=-1).reshape(-1),
+            np.repeat(stateIndex[:, :, 2, 3], 2, axis=-1).reshape(-1),
+            stateIndex[:, :, 0, :].reshape(-1),
+        ]
+    )
+
+    diagonal = stateIndex.reshape(-1)
+
+    # The fixed sparsity pattern is the union of all of the above, sorted by to-state (CSR rows) then from-state
+    allFrom = np.concatenate(
+        [staticFrom, infectionFrom.reshape(-1), testingFrom.reshape(-1), quarantineFrom, diagonal]
+    )
+    allTo = np.concatenate(
+        [staticTo, infectionTo.reshape(-1), testingTo.reshape(-1), quarantineTo, diagonal]
+    )
+    patternKeys = np.unique(allTo * nStates + allFrom)
+
+    def slotsOf(fromState, toState):
+        return np.searchsorted(patternKeys, toState * nStates + fromState)
+
+    patternTo, patternFrom = np.divmod(patternKeys, nStates)
+
+    # Transitions that case isolation removes: iso 0 -> 0 and test 0,1 -> 1 or test 2,3 -> 3
+    _, _, fromIso, fromTest = np.unravel_index(patternFrom, stateIndex.shape)
+    _, _, toIso, toTest = np.unravel_index(patternTo, stateIndex.shape)
+    quarantineMask = (fromIso == 0) * (toIso == 0) * (
+        ((fromTest < 2) * (toTest == 1)) + ((fromTest >= 2) * (toTest == 3))
+    )
+
+    return SparseTransitionLayout(
+        nStates=nStates,
+        indptr=np.searchsorted(patternTo, np.arange(nStates + 1)),
+        indices=patternFrom,
+        fromState=patternFrom,
+        staticSlots=slotsOf(staticFrom, staticTo),
+        staticValues=staticValues,
+        infectionSlots=slotsOf(infectionFrom, infectionTo),
+        testingSlots=slotsOf(testingFrom, testingTo),
+        quarantineMaskSlots=np.nonzero(quarantineMask)[0],
+        quarantineSlots=slotsOf(quarantineFrom, quarantineTo),
+        diagonalSlots=slotsOf(diagonal, diagonal),
+    )
+
+
+def sparseTransitionLayout(
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    **kwargs,
+):
+    """
+    Cached version of build_sparseTransitionLayout, keyed by the fingerprint of the relevant "_params" sub-dicts
+    """
+    return cached_staticOperator(
+        (
+            "sparseTransitionLayout",
+            staticOperatorKey(
+                trFunc_diseaseProgression,
+                trFunc_HospitalAdmission,
+                trFunc_HospitalDischarge,
+                **kwargs,
+            ),
+        ),
+        lambda: build_sparseTransitionLayout(
+            staticTransitionTensor(
+                trFunc_diseaseProgression,
+                trFunc_HospitalAdmission,
+                trFunc_HospitalDischarge,
+                **kwargs,
+            )
+        ),
+    )
+
+
+def assemble_sparseTransitionMatrix(
+    layout,
+    trTensor_newInfections,
+    travelInfectionRate,
+    trTensor_testing,
+    trTensor_quarantineRate=None,
+):
+    """
+    Fills the values of the fixed sparsity pattern, and returns the (transposed) generator as a CSR matrix.
+    Mirrors the dense tensor computation in dydt_Complete, including its final "rows sum to 0" correction.
+    """
+    data = np.zeros(len(layout.indices))
+
+    data[layout.staticSlots] = layout.staticValues
+    data[layout.infectionSlots] += trTensor_newInfections
+    data[layout.infectionSlots[:, 0, 0]] += travelInfectionRate
+    data[layout.testingSlots] += trTensor_testing
+
+    if trTensor_quarantineRate is not None:
+        data[layout.quarantineMaskSlots] = 0.0
+        data[layout.quarantineSlots] = sparse_quarantineRateValues(trTensor_quarantineRate)
+
+    # Ensure that every "row" of the generator sums to 0 (doesn't create new people out of nowhere)
+    data[layout.diagonalSlots] = 0.0
+    data[layout.diagonalSlots] = -np.bincount(
+        layout.fromState, weights=data, minlength=layout.nStates
+    )
+
+    return sparse.csr_matrix(
+        (data, layout.indices, layout.indptr), shape=(layout.nStates, layout.nStates)
+    )
+
+
+# ## Fused transition engine
+#
+# Computes the in- and outflows of people block by block (disease progression, infection, hospitalisation,
+# testing and case isolation) directly from the state, without building any transition tensor or matrix.
+# Every flux is subtracted from its origin and added to its destination, so (like the "rows sum to 0" correction
+# of the dense engine) the total number of people is preserved.
+
+FusedStaticRates = namedtuple(
+    "FusedStaticRates",
+    [
+        "diseaseProgression",  # nAge x nHS x nIso x nHS, without the (health state) diagonal
+        "diseaseProgressionOut",  # nAge x nHS x nIso, total outgoing disease progression rate
+        "hospitalAdmission",  # nAge x nHS, from isolation states 0 and 1
+        "hospitalDischarge",  # nAge x nHS, from isolation state 2 to 0
+    ],
+)
+
+
+def build_fusedStaticRates(
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    trFunc_diseaseProgression_params,
+    trFunc_HospitalAdmission_params,
+    trFunc_HospitalDischarge_params,
+):
+    trTensor_diseaseProgression = trFunc_diseaseProgression(
+        **trFunc_diseaseProgression_params
+    ) * np.expand_dims(1.0 - np.eye(nHS), [0, 2])
+
+    return FusedStaticRates(
+        diseaseProgression=trTensor_diseaseProgression,
+        diseaseProgressionOut=trTensor_diseaseProgression.sum(-1),
+        hospitalAdmission=trFunc_HospitalAdmission(**trFunc_HospitalAdmission_params),
+        hospitalDischarge=trFunc_HospitalDischarge(**trFunc_HospitalDischarge_params),
+    )
+
+
+def fusedStaticRates(
+    trFunc_diseaseProgression,
+    trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge,
+    **kwargs,
+):
+    """
+    Cached version of build_fusedStaticRates, keyed by the fingerprint of the relevant "_params" sub-dicts
+    """
+    return cached_staticOperator(
+        (
+            "fusedStaticRates",
+            staticOperatorKey(
+                trFunc_diseaseProgression,
+                trFunc_HospitalAdmission,
+                trFunc_HospitalDischarge,
+                **kwargs,
+            ),
+        ),
+        build_fusedStaticRates,
+        trFunc_diseaseProgression,
+        trFunc_HospitalAdmission,
+        trFunc_HospitalDischarge,
+        kwargs["trFunc_diseaseProgression_params"],
+        kwargs["trFunc_HospitalAdmission_params"],
+        kwargs["trFunc_HospitalDischarge_params"],
+    )
+
+
+# nIso x nTest masks of the transitions that stay within the same isolation and test state,
+# case isolation removes the iso 0 -> 0, test 1 -> 1 and test 3 -> 3 ones (see trFunc_quarantine_caseIsolation)
+fused_keepIsoTest = np.ones((nIso, nTest))
+fused_keepIsoTest_caseIsolation = np.ones((nIso, nTest))
+fused_keepIsoTest_caseIsolation[0, [1, 3]] = 0.0
+
+# nIso x nTest x nTest masks of the testing transitions (the diagonal is not a transition),
+# case isolation removes the iso 0 -> 0, test 0,1 -> 1 and test 2,3 -> 3 ones
+fused_keepTesting = np.expand_dims(1.0 - np.eye(nTest), 0).repeat(nIso, axis=0)
+fused_keepTesting_caseIsolation = fused_keepTesting.copy()
+fused_keepTesting_caseIsolation[0, :2, 1] = 0.0
+fused_keepTesting_caseIsolation[0, 2:, 3] = 0.0
+
+
+def fused_inOutFlows(
+    stateTensor,
+    staticRates,
+    trTensor_newInfections,
+    travelInfectionRate,
+    trTensor_testing,
+    trTensor_quarantineRate=None,
+    policyQuarantineCaseIsolation=None,
+):
+    """
+    Returns the (inflow, outflow) number of people per day for each state.
+    All inputs may have extra leading (batch) dimensions before the nAge dimension.
+    If policyQuarantineCaseIsolation is given (one flag per batch member), trTensor_quarantineRate is only applied
+    to the members where case isolation is in place.
+    """
+    if trTensor_quarantineRate is None:
+        keepIsoTest, keepTesting = fused_keepIsoTest, fused_keepTesting
+    elif policyQuarantineCaseIsolation is None:
+        keepIsoTest, keepTesting = (
+            fused_keepIsoTest_caseIsolation,
+            fused_keepTesting_caseIsolation,
+        )
+    else:
+        # Select the masks per member, shaped to broadcast against the nAge x nHS axes
+        keepIsoTest = np.where(
+            batch_expand(policyQuarantineCaseIsolation, 4),
+            fused_keepIsoTest_caseIsolation,
+            fused_keepIsoTest,
+        )
+        keepTesting = np.where(
+            batch_expand(policyQuarantineCaseIsolation, 5),
+            fused_keepTesting_caseIsolation,
+            fused_keepTesting,
+        )
+        trTensor_quarantineRate = trTensor_quarantineRate * batch_expand(
+            policyQuarantineCaseIsolation, 5
+        )
+
+    inflow = np.zeros_like(stateTensor)
+    outflow = np.zeros_like(stateTensor)
+
+    # Disease progression, no isolation or test transition
+    stateTensor_kept = stateTensor * keepIsoTest
+    inflow += np.einsum(
+        "...ahkl,...ahkg->...agkl", stateTensor_kept, staticRates.diseaseProgression
+    )
+    outflow += stateTensor_kept * staticRates.diseaseProgressionOut[..., np.newaxis]
+
+    # New infections and travel (S -> E), no isolation or test transition
+    infectionRate = trTensor_newInfections.copy()
+    infectionRate[..., 0, 0] += travelInfectionRate
+    flux = stateTensor_kept[..., 0, :, :] * infectionRate
+    outflow[..., 0, :, :] += flux
+    inflow[..., 1, :, :] += flux
+
+    # Hospitalisation from isolation states 0, 1 and discharge to isolation state 0, no health or test transition
+    flux = (
+        stateTensor[..., :2, :]
+        * staticRates.hospitalAdmission[..., np.newaxis, np.newaxis]
+        * keepIsoTest[..., :2, :]
+    )
+    outflow[..., :2, :] += flux
+    inflow[..., 2, :] += flux.sum(-2)
+
+    flux = stateTensor[..., 2, :] * staticRates.hospitalDischarge[..., np.newaxis]
+    outflow[..., 2, :] += flux
+    inflow[..., 0, :] += flux
+
+    # Testing, only the test state changes
+    flux = stateTensor[..., np.newaxis] * trTensor_testing * keepTesting
+    outflow += flux.sum(-1)
+    inflow += flux.sum(-2)
+
+    # Case isolation
+    if trTensor_quarantineRate is not None:
+        # Newly positive tested people move to home isolation or hospital, into test state 1 (virus) or 3 (both)
+        for toIso in [1, 2]:
+            flux = stateTensor[..., 0, :] * trTensor_quarantineRate[..., 0, :, toIso]
+            outflow[..., 0, :] += flux
+            inflow[..., toIso, 1] += flux[..., :2].sum(-1)
+            inflow[..., toIso, 3] += flux[..., 2:].sum(-1)
+
+        # Release from home isolation
+        flux = stateTensor[..., 1, :] * trTensor_quarantineRate[..., 1, :, 0]
+        outflow[..., 1, :] += flux
+        inflow[..., 0, :] += flux
+
+    return inflow, outflow
+
+
+def dydt_fusedEngine(
+    stateTensor,
+    trTensor_newInfections,
+    travelInfectionRate,
+    trTensor_testing,
+    policyQuarantineCaseIsolation,
+    debugTransition=False,
+    debugReturnNewPerDay=True,
+    trFunc_diseaseProgression=trFunc_diseaseProgression,
+    trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+    trFunc_quarantine=trFunc_quarantine_caseIsolation,
+    **kwargs,
+):
+    """
+    The transitionEngine="fused" part of dydt_Complete, given the already computed time- and state-dependent rates
+    (only called with trFunc_quarantine_caseIsolation, dydt_Complete uses the dense engine for other quarantine functions)
+    """
+    if debugTransition:
+        raise ValueError(
+            "dydt_Complete: transitionEngine='fused' never builds the transition tensor, use 'dense' or 'sparse' with debugTransition"
+        )
+
+    inflow, outflow = fused_inOutFlows(
+        stateTensor,
+        fusedStaticRates(
+            trFunc_diseaseProgression,
+            trFunc_HospitalAdmission,
+            trFunc_HospitalDischarge,
+            **kwargs,
+        ),
+        trTensor_newInfections,
+        travelInfectionRate,
+        trTensor_testing,
+        trTensor_quarantineRate=(
+            quarantineRate_caseIsolation(
+                trTensor_testing, **kwargs["trFunc_quarantine_params"]
+            )
+            if policyQuarantineCaseIsolation
+            else None
+        ),
+    )
+
+    dydt = inflow - outflow
+
+    if debugReturnNewPerDay:
+        # Only the positive "incoming" people (see dydt_Complete)
+        dydt = np.stack([dydt, inflow], axis=0)
+
+    return np.reshape(dydt, -1)
+
+
+def dydt_sparseEngine(
+    stateTensor,
+    trTensor_newInfections,
+    travelInfectionRate,
+    trTensor_testing,
+    policyQuarantineCaseIsolation,
+    debugTransition=False,
+    debugReturnNewPerDay=True,
+    trFunc_diseaseProgression=trFunc_diseaseProgression,
+    trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+    trFunc_quarantine=trFunc_quarantine_caseIsolation,
+    **kwargs,
+):
+    """
+    The transitionEngine="sparse" part of dydt_Complete, given the already computed time- and state-dependent rates
+    (only called with trFunc_quarantine_caseIsolation, dydt_Complete uses the dense engine for other quarantine functions)
+    """
+
+    layout = sparseTransitionLayout(
+        trFunc_diseaseProgression,
+        trFunc_HospitalAdmission,
+        trFunc_HospitalDischarge,
+        **kwargs,
+    )
+
+    trMatrix_complete = assemble_sparseTransitionMatrix(
+        layout,
+        trTensor_newInfections,
+        travelInfectionRate,
+        trTensor_testing,
+        trTensor_quarantineRate=(
+            quarantineRate_caseIsolation(
+                trTensor_testing, **kwargs["trFunc_quarantine_params"]
+            )
+            if policyQuarantineCaseIsolation
+            else None
+        ),
+    )
+
+    stateVector = np.reshape(stateTensor, -1)
+    dydt = trMatrix_complete.dot(stateVector)
+
+    if debugReturnNewPerDay:
+        # Only the positive "incoming" people, ie everything but the diagonal (see dydt_Complete)
+        dydt_newOnly = dydt - trMatrix_complete.data[layout.diagonalSlots] * stateVector
+        dydt = np.concatenate([dydt, dydt_newOnly])
+
+    if debugTransition:
+        return dydt, trMatrix_complete.T
+
+    return dydt
+
+
+# ## Full simulation function
+# Function that computes the right side of the non-lin model ODE
+@model_aware
+def dydt_Complete(
+    t,
+    stateTensor_flattened,  # Might be double the normal size (as first dimension) _withNewOnlyCopy, if debugReturnNewPerDay
+    realStartDate=inputDefault("testingStartDate"),
+    #realStartDate=pd.to_datetime("2020-02-20", format="%Y-%m-%d"),
+    # debug
+    debugTransition=False,
+    debugTimestep=False,
+    debugReturnNewPerDay=True,  # Now implemented by default into state iteration
+    # Dimensions
+    nAge=nAge,
+    nHS=nHS,
+    nI=nI,
+    nR=nR,
+    nIso=nIso,
+    nTest=nTest,
+    # Input functions and tensors
+    # ----------------------------
+    
+    # Health state updates
+    trFunc_diseaseProgression=trFunc_diseaseProgression,
+    trFunc_newInfections=trFunc_newInfections_Complete,
+    
+    # Initial incoming travel-based infections (before restrictions)
+    trFunc_travelInfectionRate_ageAdjusted=trFunc_travelInfectionRate_ageAdjusted,
+    
+    # Hospitalisation and recovery
+    trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+    
+    # Policy changes (on social distancing for now) (TODO - possibly make more changes)
+    tStartSocialDistancing=inputDefault("tStartSocialDistancing"),
+    tStopSocialDistancing=inputDefault("tStopSocialDistancing"),
+    tStartImmunityPassports=inputDefault("tStartImmunityPassports"),
+    tStopImmunityPassports=inputDefault("tStopImmunityPassports"),
+    tStartQuarantineCaseIsolation=inputDefault("tStartQuarantineCaseIsolation"),
+    tStopQuarantineCaseIsolation=inputDefault("tStopQuarantineCaseIsolation"),
+    trFunc_quarantine=trFunc_quarantine_caseIsolation,
     
     # Testing
     trFunc_testing=trFunc_testing,
+    # Numerical engine used to evaluate the transitions:
+    # "dense" (full transition tensor), "sparse" (CSR matrix) or "fused" (in/outflows computed directly, no transition tensor)
+    transitionEngine="dense",
     # policyFunc_testing = policyFunc_testing_symptomaticOnly,
     # testSpecifications = testSpecifications,
     # trFunc_testCapacity = trFunc_testCapacity,
@@ -1640,287 +3193,3679 @@ def dydt_Complete(
     **kwargs,
 ):
 
-    # print out sim day while running
-    tt = round(t,)
-    used = []
-    if tt % 5 == 0:
-        if t not in used:
-            print(f" Sim Day: {tt}", end="\r")
-            used.append(t)
+    # print out sim day while running
+    tt = round(t,)
+    used = []
+    if tt % 5 == 0:
+        if t not in used:
+            print(f" Sim Day: {tt}", end="\r")
+            used.append(t)
+
+    if debugTimestep:
+        print(t)
+
+    # Initialise return
+    if (
+        debugReturnNewPerDay
+    ):  # the input has 2 copies of the state tensor, second copy being the cumulative incomings
+        stateTensor = np.reshape(stateTensor_flattened, [2, nAge, nHS, nIso, nTest])[0]
+    else:
+        stateTensor = np.reshape(stateTensor_flattened, [nAge, nHS, nIso, nTest])
+
+    # Policies in place on day t (start / stop dates converted to day offsets once per set of dates)
+    (
+        cur_policySocialDistancing,
+        cur_policyImmunityPassports,
+        cur_policyQuarantineCaseIsolation,
+    ) = policyCalendar_flags(
+        policyCalendar(
+            realStartDate,
+            tStartSocialDistancing,
+            tStopSocialDistancing,
+            tStartImmunityPassports,
+            tStopImmunityPassports,
+            tStartQuarantineCaseIsolation,
+            tStopQuarantineCaseIsolation,
+        ),
+        t,
+    )
+
+    # Compute new infections (0->1 in HS) with no isolation or test transition ("diagonal along those")
+    trTensor_newInfections = trFunc_newInfections(
+        stateTensor,
+        policySocialDistancing=cur_policySocialDistancing,
+        policyImmunityPassports=cur_policyImmunityPassports,
+        **kwargs["trFunc_newInfections_params"],
+    )
+
+    # Also add new infected from travelling of healthy people, based on time-within-simulation (this is correct with all (0,0) states, as tested or isolated people dont travel)
+    travelInfectionRate = trFunc_travelInfectionRate_ageAdjusted(
+        t, **kwargs["trFunc_travelInfectionRate_ageAdjusted_params"]
+    )
+
+    # Testing state updates
+    # ---------------------
+
+    # trFunc_testing returns a stateTensor x testStates output
+    #      after the policyFunc assigns tests that are evaluated according to testSpecifications
+
+    # Diagonal (no transitions) in age, health state and isolation state
+    # (for now, probably TODO: testing positive correlates with new hospitalisation!)
+    trTensor_testing = trFunc_testing(
+        stateTensor, t, realStartDate, **kwargs["trFunc_testing_params"]
+    )
+
+    # Quarantine policy
+    # ------------------
+
+    # (cur_policyQuarantineCaseIsolation is looked up in the policy calendar above)
+
+    # The sparse and fused engines only implement case isolation, other quarantine functions use the dense one
+    if transitionEngine in ["sparse", "fused"] and trFunc_quarantine is not trFunc_quarantine_caseIsolation:
+        warnings.warn(
+            f"dydt_Complete: transitionEngine={transitionEngine!r} only supports trFunc_quarantine_caseIsolation, using 'dense'"
+        )
+        transitionEngine = "dense"
+
+    if transitionEngine == "sparse":
+        return dydt_sparseEngine(
+            stateTensor,
+            trTensor_newInfections,
+            travelInfectionRate,
+            trTensor_testing,
+            cur_policyQuarantineCaseIsolation,
+            debugTransition=debugTransition,
+            debugReturnNewPerDay=debugReturnNewPerDay,
+            trFunc_diseaseProgression=trFunc_diseaseProgression,
+            trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+            trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+            trFunc_quarantine=trFunc_quarantine,
+            **kwargs,
+        )
+    elif transitionEngine == "fused":
+        return dydt_fusedEngine(
+            stateTensor,
+            trTensor_newInfections,
+            travelInfectionRate,
+            trTensor_testing,
+            cur_policyQuarantineCaseIsolation,
+            debugTransition=debugTransition,
+            debugReturnNewPerDay=debugReturnNewPerDay,
+            trFunc_diseaseProgression=trFunc_diseaseProgression,
+            trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+            trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+            trFunc_quarantine=trFunc_quarantine,
+            **kwargs,
+        )
+    elif transitionEngine != "dense":
+        raise ValueError(f"dydt_Complete: unknown transitionEngine {transitionEngine}")
+
+    # Initialise the full transition tensor with the time-invariant transitions
+    # (disease progression, hospitalisation and hospital discharge), precomputed once per parameter set
+    trTensor_complete = staticTransitionTensor(
+        trFunc_diseaseProgression,
+        trFunc_HospitalAdmission,
+        trFunc_HospitalDischarge,
+        **kwargs,
+    ).copy()
+
+    np.einsum("iklkl->ikl", trTensor_complete[:, 0, :, :, 1, :, :])[
+        :
+    ] += trTensor_newInfections
+
+    trTensor_complete[:, 0, 0, 0, 1, 0, 0] += travelInfectionRate
+
+    np.einsum("ijkljkm->ijklm", trTensor_complete)[:] += trTensor_testing
+
+    if cur_policyQuarantineCaseIsolation:
+        # New quarantining only happens to people who are transitioning already from untested to virus positive state
+        # Therefore here we DO use non-diagonal transitions, and we
+        #     redistribute the transtion rates given the testing (which was previously assumed not to create transition in isolation state)
+        trTensor_complete = trFunc_quarantine(
+            trTensor_complete, t, trTensor_testing, **kwargs["trFunc_quarantine_params"]
+        )
+
+    # Final corrections
+    # -----------------
+
+    # TODO: simulate aging and normal birth / death (not terribly important on these time scales, but should be quite simple)
+
+    # Ensure that every "row" sums to 0 by adding to the diagonal (doesn't create new people out of nowhere)
+    # Extract (writable) diagonal array and subtract the "row"-sums for each initial state
+    np.einsum("ijkljkl->ijkl", trTensor_complete)[:] -= np.einsum(
+        "...jkl->...", trTensor_complete
+    )
+
+    # Compute the actual derivatives
+    dydt = np.einsum(
+        "ijkl,ijklmnp->imnp", stateTensor, trTensor_complete
+    )  # contract the HS axis, keep age
+
+    if debugReturnNewPerDay:
+        """
+        If this is true, instead of returning the real dydt,
+        return only the positive "incoming" number of people to each state, so we can track "new cases"
+        This needs some approximations, as follows:
+            1. Take the normal transition tensor (with rates potentially > 0)
+            2. From all states re-normalise the outgoing rates to sum at most to 1
+                (if they were less, keep it, if larger, then this represents
+                “in this day, all people will leave this state, in these ratios to these states”)
+            3. Multiply only these outgoing rates with the current state
+                (so the result wont keep the same number of people as normal,
+                but only represent the “new incomings” for each state)
+        """
+
+        trTensor_complete_newOnly = copy.deepcopy(trTensor_complete)
+
+        # TODO - Think - this is probably unnecessary actually, artifically reduces "new" rates?
+        #         # Devide each row by the absolute diagonal rate (that is the sum of the row), but only if its larger than 1
+        #         trTensor_complete_newOnly /= (
+        #             np.expand_dims(
+        #                 np.clip(np.abs(np.einsum('ijkljkl->ijkl', trTensor_complete_newOnly)), a_min=1., a_max=np.inf),
+        #                 axis=[4,5,6]
+        #             )
+        #         )
+
+        # Set the diagonals to zero (no preservation, no outgoing, will end up being the incoming only)
+        np.einsum("ijkljkl->ijkl", trTensor_complete_newOnly)[:] = 0.0
+
+        dydt_newOnly = np.einsum(
+            "ijkl,ijklmnp->imnp", stateTensor, trTensor_complete_newOnly
+        )
+
+        dydt = np.stack([dydt, dydt_newOnly], axis=0)
+
+    if debugTransition:
+        return np.reshape(dydt, -1), trTensor_complete
+
+    return np.reshape(dydt, -1)
+
+
+# ## Jacobian for implicit solvers
+#
+# The model is linear in the state, apart from the new infections (and the test allocation of the policy functions):
+# dydt = A(t, x) x, where the new infection rates of susceptible people are (linear function of the infected) / total population.
+# The Jacobian is therefore the transition generator A (as assembled by the sparse engine) plus a low-rank correction
+# for the infection rates' dependence on the infected states:
+#   d(rate_S * x_S) / dx = rate_S * e_S + x_S * M_S / N
+# where M is the linear map from states to infection rates (probed once per policy setting).
+# We treat the total population N as constant (it is conserved by the dynamics), and the test administration
+# rates as frozen (tests given out per person). The latter leaves out the state dependence of capacity-limited testing
+# (the tests available are shared by the people eligible), which is not small: on the default inputs some entries are off
+# by up to 0.6 (the largest entries are about 2). So this is an approximate Jacobian: good enough for the Newton iterations
+# of the implicit solvers, whose accuracy is set by their error estimates, but not an exact derivative of dydt_Complete.
+
+
+def build_infectionRateOperator(
+    trFunc_newInfections, policySocialDistancing, policyImmunityPassports, **kwargs
+):
+    """
+    Returns the (nAge*nIso*nTest) x nStates sparse matrix M, for which
+    trFunc_newInfections(stateTensor) = M stateTensor / sum(stateTensor)
+    """
+    # Probe the function with each unit state (total population 1)
+    unitState = np.zeros(stateTensor.shape)
+    infectionRateOperator = np.zeros((nAge * nIso * nTest, unitState.size))
+    for stateInd in range(unitState.size):
+        unitState.flat[stateInd] = 1.0
+        infectionRateOperator[:, stateInd] = np.reshape(
+            trFunc_newInfections(
+                unitState,
+                policySocialDistancing=policySocialDistancing,
+                policyImmunityPassports=policyImmunityPassports,
+                **kwargs,
+            ),
+            -1,
+        )
+        unitState.flat[stateInd] = 0.0
+
+    return sparse.csr_matrix(infectionRateOperator)
+
+
+def infectionRateOperator(
+    trFunc_newInfections, policySocialDistancing, policyImmunityPassports, **kwargs
+):
+    """
+    Cached version of build_infectionRateOperator
+    """
+    return cached_staticOperator(
+        (
+            "infectionRateOperator",
+            bool(policySocialDistancing),
+            bool(policyImmunityPassports),
+            memoized_fingerprint(
+                [trFunc_newInfections, kwargs["trFunc_newInfections_params"]]
+            ),
+        ),
+        lambda: build_infectionRateOperator(
+            trFunc_newInfections,
+            policySocialDistancing,
+            policyImmunityPassports,
+            **kwargs["trFunc_newInfections_params"],
+        ),
+    )
+
+
+# Flat state indices of the susceptible people, and of the exposed (newly infected) people they move to, nAge x nIso x nTest
+infectionFromStates = np.ravel_multi_index(
+    np.ix_(range(nAge), [0], range(nIso), range(nTest)), stateTensor.shape
+)[:, 0]
+infectionToStates = np.ravel_multi_index(
+    np.ix_(range(nAge), [1], range(nIso), range(nTest)), stateTensor.shape
+)[:, 0]
+
+
+@model_aware
+def dydt_Jacobian(
+    t,
+    stateTensor_flattened,  # Might be double the normal size (as first dimension) _withNewOnlyCopy, if debugReturnNewPerDay
+    realStartDate=inputDefault("testingStartDate"),
+    debugReturnNewPerDay=True,
+    trFunc_newInfections=trFunc_newInfections_Complete,
+    trFunc_diseaseProgression=trFunc_diseaseProgression,
+    trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+    tStartSocialDistancing=inputDefault("tStartSocialDistancing"),
+    tStopSocialDistancing=inputDefault("tStopSocialDistancing"),
+    tStartImmunityPassports=inputDefault("tStartImmunityPassports"),
+    tStopImmunityPassports=inputDefault("tStopImmunityPassports"),
+    tStartQuarantineCaseIsolation=inputDefault("tStartQuarantineCaseIsolation"),
+    tStopQuarantineCaseIsolation=inputDefault("tStopQuarantineCaseIsolation"),
+    **kwargs,
+):
+    """
+    Approximate Jacobian of dydt_Complete (same inputs), as a sparse (csc) matrix (see above)
+    """
+    if kwargs.get("trFunc_quarantine", trFunc_quarantine_caseIsolation) is not trFunc_quarantine_caseIsolation:
+        raise ValueError(
+            "dydt_Jacobian: only supports trFunc_quarantine_caseIsolation, use solverJacobian=None for other quarantine functions"
+        )
+    nStates = stateTensor.size
+    stateVector = np.reshape(stateTensor_flattened, (-1, nStates))[0]
+
+    policyDates = dict(
+        tStartSocialDistancing=tStartSocialDistancing,
+        tStopSocialDistancing=tStopSocialDistancing,
+        tStartImmunityPassports=tStartImmunityPassports,
+        tStopImmunityPassports=tStopImmunityPassports,
+        tStartQuarantineCaseIsolation=tStartQuarantineCaseIsolation,
+        tStopQuarantineCaseIsolation=tStopQuarantineCaseIsolation,
+    )
+    staticFuncs = dict(
+        trFunc_diseaseProgression=trFunc_diseaseProgression,
+        trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+        trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+    )
+
+    # Transition generator at the current state
+    _, trMatrix_transposed = dydt_Complete(
+        t,
+        stateVector,
+        **dict(
+            kwargs,
+            realStartDate=realStartDate,
+            trFunc_newInfections=trFunc_newInfections,
+            **staticFuncs,
+            **policyDates,
+            transitionEngine="sparse",
+            debugTransition=True,
+            debugReturnNewPerDay=False,
+        ),
+    )
+    trMatrix_complete = trMatrix_transposed.T.tocsr()
+
+    # Infection rate correction
+    (
+        cur_policySocialDistancing,
+        cur_policyImmunityPassports,
+        cur_policyQuarantineCaseIsolation,
+    ) = policyCalendar_flags(policyCalendar(realStartDate, **policyDates), t)
+
+    # Only the infections not removed by case isolation (see assemble_sparseTransitionMatrix)
+    infectedSusceptible = np.reshape(stateVector[infectionFromStates], -1)
+    if cur_policyQuarantineCaseIsolation:
+        layout = sparseTransitionLayout(**staticFuncs, **kwargs)
+        infectedSusceptible = infectedSusceptible * ~np.isin(
+            np.reshape(layout.infectionSlots, -1), layout.quarantineMaskSlots
+        )
+
+    infectionRateCorrection = sparse.diags(
+        infectedSusceptible / np.sum(stateVector)
+    ).dot(
+        infectionRateOperator(
+            trFunc_newInfections,
+            cur_policySocialDistancing,
+            cur_policyImmunityPassports,
+            **kwargs,
+        )
+    )
+    # Rows of the exposed (+) and susceptible (-) states
+    toExposed = sparse.csr_matrix(
+        (
+            np.ones(infectionToStates.size),
+            (np.reshape(infectionToStates, -1), np.arange(infectionToStates.size)),
+        ),
+        shape=(nStates, infectionToStates.size),
+    )
+    fromSusceptible = sparse.csr_matrix(
+        (
+            np.ones(infectionFromStates.size),
+            (np.reshape(infectionFromStates, -1), np.arange(infectionFromStates.size)),
+        ),
+        shape=(nStates, infectionFromStates.size),
+    )
+    newInfectionsJacobian = toExposed.dot(infectionRateCorrection)
+
+    jacobian = (
+        trMatrix_complete
+        + newInfectionsJacobian
+        - fromSusceptible.dot(infectionRateCorrection)
+    )
+
+    if debugReturnNewPerDay:
+        # The second copy is the incoming people only (off-diagonal of the generator), and does not affect dydt
+        jacobian_newOnly = (
+            trMatrix_complete
+            - sparse.diags(trMatrix_complete.diagonal())
+            + newInfectionsJacobian
+        )
+        jacobian = sparse.hstack(
+            [
+                sparse.vstack([jacobian, jacobian_newOnly]),
+                sparse.csr_matrix((2 * nStates, nStates)),
+            ]
+        )
+
+    return sparse.csc_matrix(jacobian)
+
+
+def dydt_JacobianSparsity(
+    debugReturnNewPerDay=True,
+    trFunc_diseaseProgression=trFunc_diseaseProgression,
+    trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+    trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+    **kwargs,
+):
+    """
+    Sparsity pattern of the Jacobian of dydt_Complete (for any time and state), as a sparse boolean matrix,
+    to be used by implicit solvers estimating the Jacobian with finite differences.
+    The rows of new infections are dense, so this is mainly a fallback for checking dydt_Jacobian
+    """
+    nStates = stateTensor.size
+
+    layout = sparseTransitionLayout(
+        trFunc_diseaseProgression=trFunc_diseaseProgression,
+        trFunc_HospitalAdmission=trFunc_HospitalAdmission,
+        trFunc_HospitalDischarge=trFunc_HospitalDischarge,
+        **kwargs,
+    )
+    # Every possible transition (the sparse layout is the transposed generator)
+    transitionPattern = sparse.csr_matrix(
+        (np.ones(layout.indices.size), layout.indices, layout.indptr),
+        shape=(nStates, nStates),
+    )
+
+    # Susceptible and exposed rows depend on all states through the total population (dydt_Jacobian treats it as constant)
+    infectionRows = np.zeros(nStates)
+    infectionRows[infectionFromStates] = 1.0
+    infectionRows[infectionToStates] = 1.0
+    sparsity = transitionPattern + sparse.csr_matrix(
+        np.outer(infectionRows, np.ones(nStates))
+    )
+
+    if debugReturnNewPerDay:
+        sparsity = sparse.hstack(
+            [
+                sparse.vstack([sparsity, sparsity]),
+                sparse.csr_matrix((2 * nStates, nStates)),
+            ]
+        )
+
+    return sparse.csc_matrix(sparsity != 0)
+
+
+def solveSystem_jacobianArgs(solverMethod, solverJacobian, kwargs):
+    """
+    The Jacobian arguments (jac or jac_sparsity) of integrate.solve_ivp for solverMethod and solverJacobian (see solveSystem)
+    """
+    jacobianArgs = {}
+    if solverMethod in ["BDF", "Radau", "LSODA"]:
+        # dydt_Jacobian only supports case isolation (as the sparse engine), otherwise use finite differences
+        if (
+            solverJacobian == "analytic"
+            and kwargs.get("trFunc_quarantine", trFunc_quarantine_caseIsolation) is not trFunc_quarantine_caseIsolation
+        ):
+            warnings.warn(
+                "solveSystem: solverJacobian='analytic' only supports trFunc_quarantine_caseIsolation, using None"
+            )
+            solverJacobian = None
+        if solverJacobian == "analytic":
+            if solverMethod == "LSODA":
+                # LSODA only takes dense Jacobians
+                jacobianArgs["jac"] = lambda t, y: dydt_Jacobian(
+                    t, y, **kwargs
+                ).toarray()
+            else:
+                jacobianArgs["jac"] = lambda t, y: dydt_Jacobian(t, y, **kwargs)
+        elif solverJacobian == "sparsity":
+            if solverMethod == "LSODA":
+                raise ValueError(
+                    "solveSystem: LSODA does not support solverJacobian='sparsity'"
+                )
+            jacobianArgs["jac_sparsity"] = dydt_JacobianSparsity(**kwargs)
+        elif solverJacobian is not None:
+            raise ValueError(
+                f"solveSystem: unknown solverJacobian {solverJacobian!r}, use 'analytic', 'sparsity' or None"
+            )
+
+    return jacobianArgs
+
+
+def segment_solverFunctions(fun, solverArgs, endDay):
+    """
+    Returns fun and solverArgs (with its "jac", if a function) for integrating a segment that ends on the switch day endDay:
+    at t = endDay they are evaluated at the float just before it, with the policies in place before the switch
+    (see policyCalendar_flags), so that the last step of the segment does not see the discontinuity
+    """
+    tLast = np.nextafter(float(endDay), -np.inf)
+
+    def clamped(func):
+        def clampedFunc(t, y):
+            return func(min(t, tLast), y)
+
+        return clampedFunc
+
+    solverArgs = dict(solverArgs)
+    if callable(solverArgs.get("jac")):
+        solverArgs["jac"] = clamped(solverArgs["jac"])
+
+    return clamped(fun), solverArgs
+
+
+def solve_memoizedFunctions(fun, solverArgs):
+    """
+    Returns fun and solverArgs (with its "jac", if a function) evaluated with the fingerprints of the parameters memoized
+    for this solve (see memoized_fingerprint), the parameters must not be modified while it runs
+    """
+    memo = {}
+
+    def memoized(func):
+        def memoizedFunc(t, y):
+            token = solveFingerprintMemo.set(memo)
+            try:
+                return func(t, y)
+            finally:
+                solveFingerprintMemo.reset(token)
+
+        return memoizedFunc
+
+    solverArgs = dict(solverArgs)
+    if callable(solverArgs.get("jac")):
+        solverArgs["jac"] = memoized(solverArgs["jac"])
+
+    return memoized(fun), solverArgs
+
+
+def solve_ivpSegments(fun, y0, total_days, switchDays, return_solverStats=False, **solverArgs):
+    """
+    Integrates fun from y0 over the days 0 ... total_days with integrate.solve_ivp (solverArgs: method, rtol, ...),
+    restarting the solver on each of switchDays (up to total_days), where fun is discontinuous
+    (see policyCalendar_switchDays), each segment is integrated with fun of before its switch (see segment_solverFunctions).
+    Returns the states on the days 0 ... total_days - 1 (nStates x total_days), and the summed solver stats
+    """
+    fun, solverArgs = solve_memoizedFunctions(fun, solverArgs)
+    segmentDays = [0] + [day for day in switchDays if day < total_days] + [total_days]
+    states = []
+    solverStats = {"nSteps": 0, "nfev": 0, "njev": 0, "nlu": 0}
+    for startDay, endDay in zip(segmentDays[:-1], segmentDays[1:]):
+        segmentFun, segmentArgs = fun, solverArgs
+        if endDay in switchDays:
+            segmentFun, segmentArgs = segment_solverFunctions(fun, solverArgs, endDay)
+        # Also evaluated on the switch day, that state is the initial state of the next segment
+        evalDays = np.arange(startDay, endDay + 1 if endDay < total_days else endDay)
+        out = integrate.solve_ivp(
+            fun=segmentFun,
+            t_span=(float(startDay), float(endDay)),
+            y0=y0,
+            # The step count is only available if we keep all steps (and evaluate them on the days afterwards)
+            t_eval=None if return_solverStats else evalDays,
+            dense_output=return_solverStats,
+            **segmentArgs,
+        )
+        if out.status == -1:
+            raise RuntimeError(f"solve_ivpSegments: the solver failed on day {out.t[-1]:.2f}: {out.message}")
+
+        segmentStates = out.sol(evalDays) if return_solverStats else out.y
+        states.append(segmentStates[:, : endDay - startDay])
+        y0 = segmentStates[:, -1].copy()
+        solverStats["nSteps"] += len(out.t) - 1
+        solverStats["nfev"] += out.nfev
+        solverStats["njev"] += out.njev
+        solverStats["nlu"] += out.nlu
+
+    return np.concatenate(states, axis=1), solverStats
+
+
+def solve_ivpDays(fun, y0, total_days, switchDays, method="RK45", **solverArgs):
+    """
+    Generator version of solve_ivpSegments, yields the (day, state) of the days 0 ... total_days - 1 as they are
+    simulated, so that only the current state is kept in memory. The states are the same, as solve_ivp with t_eval,
+    each step evaluates the days up to and including its end on its dense output.
+    """
+    fun, solverArgs = solve_memoizedFunctions(fun, solverArgs)
+    segmentDays = [0] + [day for day in switchDays if day < total_days] + [total_days]
+    for startDay, endDay in zip(segmentDays[:-1], segmentDays[1:]):
+        segmentFun, segmentArgs = fun, solverArgs
+        if endDay in switchDays:
+            segmentFun, segmentArgs = segment_solverFunctions(fun, solverArgs, endDay)
+        # Also evaluated on the switch day, that state is the initial state of the next segment
+        evalDays = np.arange(startDay, endDay + 1 if endDay < total_days else endDay)
+        solver = getattr(integrate, method)(segmentFun, float(startDay), y0, float(endDay), **segmentArgs)
+        nextInd = 0
+        while solver.status == "running":
+            message = solver.step()
+            if solver.status == "failed":
+                raise RuntimeError(f"solve_ivpDays: the solver failed on day {solver.t:.2f}: {message}")
+
+            stepDays = evalDays[nextInd : np.searchsorted(evalDays, solver.t, side="right")]
+            if stepDays.size > 0:
+                stepStates = solver.dense_output()(stepDays)
+                for ii, day in enumerate(stepDays):
+                    if day < endDay:
+                        yield int(day), stepStates[:, ii]
+                nextInd += stepDays.size
+
+        y0 = stepStates[:, -1].copy()
+
+
+def solveSystem(
+    stateTensor_init,
+    total_days,
+    samplesPerDay=np.inf,
+    solverMethod="RK23",
+    solverJacobian="analytic",
+    solverRtol=1e-3,
+    solverAtol=1e-3,
+    solverMaxStep=np.inf,
+    return_solverStats=False,
+    checkpointDays=(),
+    checkpointFile="checkpoint_{day}.pkl",
+    resumeFrom=None,
+    model=None,
+    **kwargs,
+):
+    # kwargs are the parameters of dydt_Complete, including the transitionEngine ("dense", "sparse" or "fused") to use
+    # If a Model is given (see build_model), the parameters not in kwargs are taken from model.paramDict,
+    #   stateTensor_init may be None for the model's, and the precomputed operators are cached in the model
+    # solverMethod is passed to integrate.solve_ivp, for the implicit methods ("BDF", "Radau", "LSODA") solverJacobian sets
+    #   "analytic": use dydt_Jacobian, "sparsity": finite differences with the dydt_JacobianSparsity pattern (BDF / Radau),
+    #   None: dense finite differences
+    # solverRtol, solverAtol and solverMaxStep are the rtol, atol and max_step of integrate.solve_ivp (see also solverPresets)
+    # If return_solverStats, also returns a dict with the number of steps, RHS and Jacobian evaluations and LU decompositions
+    # checkpointDays, checkpointFile and resumeFrom write checkpoints and continue from one (see solveSystem_stream),
+    #   a resumed run returns the total_days days from the day of the checkpoint
+    if len(checkpointDays) > 0 or resumeFrom is not None:
+        if return_solverStats:
+            raise ValueError("solveSystem: return_solverStats is not supported with checkpoints")
+        stream = solveSystem_stream(
+            stateTensor_init,
+            total_days,
+            samplesPerDay=samplesPerDay,
+            solverMethod=solverMethod,
+            solverJacobian=solverJacobian,
+            solverRtol=solverRtol,
+            solverAtol=solverAtol,
+            solverMaxStep=solverMaxStep,
+            checkpointDays=checkpointDays,
+            checkpointFile=checkpointFile,
+            resumeFrom=resumeFrom,
+            model=model,
+            **kwargs,
+        )
+        return np.stack([stateTensor for _, stateTensor in stream], axis=-1)
+
+    if model is not None:
+        if stateTensor_init is None:
+            stateTensor_init = model.inputs["stateTensor_init"]
+        with model_context(model):
+            return solveSystem(
+                stateTensor_init,
+                total_days,
+                samplesPerDay=samplesPerDay,
+                solverMethod=solverMethod,
+                solverJacobian=solverJacobian,
+                solverRtol=solverRtol,
+                solverAtol=solverAtol,
+                solverMaxStep=solverMaxStep,
+                return_solverStats=return_solverStats,
+                **dict(model.paramDict, **kwargs),
+            )
+
+    # Run the simulation
+    if kwargs["debugReturnNewPerDay"]:  # Keep the second copy as well
+        cur_stateTensor = np.reshape(
+            np.stack(
+                [copy.deepcopy(stateTensor_init), copy.deepcopy(stateTensor_init)],
+                axis=0,
+            ),
+            -1,
+        )
+    else:
+        # print("else 1")
+        cur_stateTensor = np.reshape(copy.deepcopy(stateTensor_init), -1)
+
+    solverStats = {}
+
+    if np.isinf(samplesPerDay):
+        # print("if 2")
+        jacobianArgs = solveSystem_jacobianArgs(solverMethod, solverJacobian, kwargs)
+
+        # Run precise integrator - used for all simulations
+        # The policies switch on and off at the start of a day, each smooth segment in between is integrated separately
+        # (rather than the solver rejecting steps across the switch)
+        out, solverStats = solve_ivpSegments(
+            lambda t, y: dydt_Complete(t, y, **kwargs),
+            cur_stateTensor,
+            total_days,
+            policyCalendar_switchDays(paramDict_policyCalendar(kwargs), total_days + 1),
+            return_solverStats=return_solverStats,
+            method=solverMethod,
+            rtol=solverRtol,  # default 1e-3
+            atol=solverAtol,  # default 1e-6
+            max_step=solverMaxStep,
+            **jacobianArgs,
+        )
+
+    else:
+        # print("else 2")
+        # Run simple Euler method with given step size (1/samplesPerDay) for quickly investigating code behavior
+        deltaT = 1.0 / samplesPerDay
+        out = np.zeros((np.prod(stateTensor_init.shape), total_days))
+        fun, _ = solve_memoizedFunctions(lambda t, y: dydt_Complete(t, y, **kwargs), {})
+
+        for tt in range(total_days * samplesPerDay):
+            if tt % samplesPerDay == 0:
+                out[:, int(tt / samplesPerDay)] = cur_stateTensor
+
+            cur_stateTensor += deltaT * fun((tt * 1.0) / (1.0 * samplesPerDay), cur_stateTensor)
+
+        solverStats = {
+            "nSteps": total_days * samplesPerDay,
+            "nfev": total_days * samplesPerDay,
+            "njev": 0,
+            "nlu": 0,
+        }
+
+    # Reshape to reasonable format
+    if kwargs["debugReturnNewPerDay"]:
+        out = np.reshape(out, (2,) + stateTensor_init.shape + (-1,))
+    else:
+        out = np.reshape(out, stateTensor_init.shape + (-1,))
+
+    if return_solverStats:
+        return out, solverStats
+
+    return out
+
+
+# Named ODE solver settings for solveSystem, selected with the -preset command line option
+# "balanced" is the default of solveSystem, "fast" was chosen from the Pareto front of tune_solveSystem over 180 days
+# of the bundled inputs: about half the run time of "balanced", with max error of the aggregated outputs
+# relative to the largest output of ~2e-5 (vs. ~1e-6 for "balanced")
+solverPresets = OrderedDict(
+    [
+        (
+            "fast",
+            dict(solverMethod="BDF", solverRtol=1e-3, solverAtol=1.0, solverMaxStep=np.inf),
+        ),
+        (
+            "balanced",
+            dict(solverMethod="RK23", solverRtol=1e-3, solverAtol=1e-3, solverMaxStep=np.inf),
+        ),
+        (
+            "reference",
+            dict(solverMethod="DOP853", solverRtol=1e-8, solverAtol=1e-6, solverMaxStep=np.inf),
+        ),
+    ]
+)
+
+
+def tune_solveSystem(
+    stateTensor_init,
+    total_days,
+    solverMethods=("RK23", "RK45", "DOP853", "BDF", "LSODA"),
+    solverRtols=(1e-2, 1e-3, 1e-4),
+    solverAtols=(1e-3, 1.0, 100.0),
+    solverMaxSteps=(np.inf, 1.0),
+    referencePreset="reference",
+    **kwargs,
+):
+    """
+    Runs solveSystem with the referencePreset settings, and with all combinations of the given solver settings,
+    returns a DataFrame with the wall time, RHS evaluations and the errors of the aggregated (per age and health state) outputs
+    of each combination, with the Pareto optimal (in wall time and max error) combinations marked.
+    kwargs are the parameters of dydt_Complete
+    """
+
+    def runSolver(**solverSettings):
+        startTime = time.perf_counter()
+        out, solverStats = solveSystem(
+            stateTensor_init,
+            total_days,
+            return_solverStats=True,
+            **solverSettings,
+            **kwargs,
+        )
+        # Aggregate over isolation and test states, as array_to_df does
+        return np.sum(out, axis=(-3, -2)), time.perf_counter() - startTime, solverStats
+
+    reference, _, _ = runSolver(**solverPresets[referencePreset])
+    referenceScale = np.max(np.abs(reference))
+
+    results = []
+    for solverMethod, solverRtol, solverAtol, solverMaxStep in itertools.product(
+        solverMethods, solverRtols, solverAtols, solverMaxSteps
+    ):
+        solverSettings = dict(
+            solverMethod=solverMethod,
+            solverRtol=solverRtol,
+            solverAtol=solverAtol,
+            solverMaxStep=solverMaxStep,
+        )
+        try:
+            out, wallTime, solverStats = runSolver(**solverSettings)
+            maxError = np.max(np.abs(out - reference))
+        except Exception as e:  # eg. too loose settings failing to converge
+            warnings.warn(f"tune_solveSystem: {solverSettings} failed: {e}")
+            continue
+
+        results.append(
+            dict(
+                solverSettings,
+                wallTime=wallTime,
+                nfev=solverStats["nfev"],
+                nSteps=solverStats["nSteps"],
+                maxError=maxError,
+                maxRelError=maxError / referenceScale,
+            )
+        )
+
+    df = pd.DataFrame(results).sort_values("wallTime", ignore_index=True)
+
+    # Pareto optimal: no other combination is both faster and more accurate
+    # (sorted by wall time, these are the ones more accurate than all faster ones)
+    df["pareto"] = df["maxError"] < df["maxError"].cummin().shift(1, fill_value=np.inf)
+
+    return df
+
+# ## Streaming simulation
+#
+# solveSystem keeps the state of every day in memory until the end. solveSystem_stream instead yields the state of each
+# day as soon as the solver has stepped past it, so that long runs can be written to disk (see save_streamedOutput)
+# or reduced on the fly with memory independent of the number of days. It steps the same solver as integrate.solve_ivp
+# and evaluates the days on its dense output in the same way, so the states are identical to those of solveSystem.
+#
+# It can also write checkpoints at given days, and continue from a checkpoint (eg. a daily forecast continuing from
+# the checkpoint of the previous day, instead of simulating the whole history again). A checkpoint at day d holds the
+# complete state of the solver before the first step that evaluated dydt_Complete on day d or later (also in rejected
+# trial steps), and the first day evaluated on that step: a resumed run repeats that step, and so yields exactly
+# the states of an uninterrupted run (with the same parameters, solver settings and end day). As the solver has not
+# looked at day d yet, the same holds for parameters that only differ from day d on (see run_scenarioTree).
+# The LU factorizations kept by the implicit solvers are stored as the matrices they factorize. As the solver state is
+# a copy of the attributes of the SciPy solver, a checkpoint is only resumed with the SciPy version that wrote it.
+
+Checkpoint = namedtuple(
+    "Checkpoint",
+    [
+        "day",  # first day not simulated yet (days since realStartDate)
+        "realStartDate",  # date of simulation day 0
+        "paramFingerprint",  # paramDict_fingerprint of the parameters of dydt_Complete
+        "solverSettings",  # OrderedDict of samplesPerDay, solverMethod, solverJacobian, solverRtol, solverAtol and solverMaxStep
+        "scipyVersion",  # scipy.__version__ of the solver solverState was taken from
+        "stateShape",  # shape of the state tensor of a day
+        "solverState",  # OrderedDict of the solver attributes before the step reaching day (Euler method: the state at day)
+        "stepFirstDay",  # first day evaluated on that step
+        "evaluatedUntil",  # latest (float) day dydt_Complete was evaluated on before solverState (before day, except if
+        #   the solver had to look further ahead to choose its first step)
+    ],
+)
+
+FactorizedMatrix = namedtuple("FactorizedMatrix", ["matrix"])  # stands for the LU factorization of matrix in a solverState
+LeadingRows = namedtuple("LeadingRows", ["base", "nRows"])  # stands for a view of the first nRows rows of the array base
+
+
+def save_checkpoint(filename, checkpoint):
+    """
+    Writes the Checkpoint to filename
+    """
+    with open(filename, "wb") as f:
+        pickle.dump(checkpoint._asdict(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_checkpoint(filename):
+    """
+    Reads a Checkpoint written by save_checkpoint (scipyVersion None if written before it was recorded)
+    """
+    with open(filename, "rb") as f:
+        return Checkpoint(**dict({"scipyVersion": None}, **pickle.load(f)))
+
+
+def scipy_version():
+    return importlib.import_module("scipy").__version__
+
+
+def check_checkpoint(checkpoint, solverSettings, paramDict):
+    """
+    Raises a ValueError if the Checkpoint was written with other solver settings, parameters or SciPy version than to be
+    resumed with
+    """
+    if checkpoint.scipyVersion != scipy_version():
+        raise ValueError(
+            f"check_checkpoint: the checkpoint of day {checkpoint.day} was written with SciPy {checkpoint.scipyVersion}, "
+            f"not {scipy_version()}"
+        )
+    if checkpoint.solverSettings != solverSettings:
+        raise ValueError(
+            f"check_checkpoint: the checkpoint of day {checkpoint.day} was written with the solver settings "
+            f"{dict(checkpoint.solverSettings)}, not {dict(solverSettings)}"
+        )
+    if checkpoint.paramFingerprint != paramDict_fingerprint(paramDict):
+        raise ValueError(f"check_checkpoint: the checkpoint of day {checkpoint.day} was written with other parameters")
+
+
+def solver_snapshot(solver, factorizations):
+    """
+    Copy of the attributes of the integrate.OdeSolver solver, without its functions, the factorizations in
+    factorizations (list of (factorization, matrix)) replaced by FactorizedMatrix, and arrays that are views of
+    the first rows of another attribute (DOP853 keeps its stages K in K_extended) by LeadingRows
+    """
+    attributes = vars(solver)
+    solverState = OrderedDict()
+    for name, value in attributes.items():
+        if inspect.isfunction(value) or inspect.ismethod(value):
+            continue
+        if isinstance(value, np.ndarray) and value.base is not None:
+            baseName = next((other for other, base in attributes.items() if value.base is base), None)
+            if baseName is not None and value.ctypes.data == value.base.ctypes.data and value.strides == value.base.strides:
+                solverState[name] = LeadingRows(baseName, value.shape[0])
+                continue
+        for factorization, matrix in factorizations:
+            if value is factorization:
+                solverState[name] = FactorizedMatrix(matrix)
+                break
+        else:
+            solverState[name] = copy.deepcopy(value)
+
+    return solverState
+
+
+def restore_solverSnapshot(solver, solverState):
+    """
+    Sets the attributes of solver to solverState (see solver_snapshot), factorizing the FactorizedMatrix again
+    """
+    for name, value in solverState.items():
+        if isinstance(value, FactorizedMatrix):
+            setattr(solver, name, solver.lu(value.matrix))
+    # (after the factorizations, which count in nlu)
+    for name, value in solverState.items():
+        if not isinstance(value, (FactorizedMatrix, LeadingRows)):
+            setattr(solver, name, copy.deepcopy(value))
+    for name, value in solverState.items():
+        if isinstance(value, LeadingRows):
+            setattr(solver, name, getattr(solver, value.base)[: value.nRows])
+
+
+def solveSystem_stream(
+    stateTensor_init,
+    total_days,
+    samplesPerDay=np.inf,
+    solverMethod="RK23",
+    solverJacobian="analytic",
+    solverRtol=1e-3,
+    solverAtol=1e-3,
+    solverMaxStep=np.inf,
+    checkpointDays=(),
+    checkpointFile="checkpoint_{day}.pkl",
+    resumeFrom=None,
+    model=None,
+    **kwargs,
+):
+    """
+    Generator of (day, stateTensor) for the days 0 ... total_days - 1 of the simulation, stateTensor being out[..., day]
+    of solveSystem with the same arguments.
+    A Checkpoint is written to checkpointFile (formatted with the day, or a function called with the Checkpoint)
+    at each of checkpointDays (up to total_days).
+    If resumeFrom (a Checkpoint or its file) is given, stateTensor_init is not used, and the simulation continues
+    from its day for total_days days.
+    """
+    # The model context is only entered while stepping, as the consumer runs in between
+    stepContext = contextlib.nullcontext
+    if model is not None:
+        if stateTensor_init is None and resumeFrom is None:
+            stateTensor_init = model.inputs["stateTensor_init"]
+        kwargs = dict(model.paramDict, **kwargs)
+        stepContext = functools.partial(model_context, model)
+
+    solverSettings = OrderedDict(
+        [
+            ("samplesPerDay", samplesPerDay),
+            ("solverMethod", solverMethod),
+            ("solverJacobian", solverJacobian),
+            ("solverRtol", solverRtol),
+            ("solverAtol", solverAtol),
+            ("solverMaxStep", solverMaxStep),
+        ]
+    )
+
+    if resumeFrom is not None:
+        if isinstance(resumeFrom, str):
+            resumeFrom = load_checkpoint(resumeFrom)
+        check_checkpoint(resumeFrom, solverSettings, kwargs)
+        firstDay = resumeFrom.day
+        stateShape = resumeFrom.stateShape
+    elif kwargs["debugReturnNewPerDay"]:  # Keep the second copy as well
+        firstDay = 0
+        stateShape = (2,) + stateTensor_init.shape
+        cur_stateTensor = np.reshape(np.stack([stateTensor_init, stateTensor_init], axis=0), -1)
+    else:
+        firstDay = 0
+        stateShape = stateTensor_init.shape
+        cur_stateTensor = np.array(stateTensor_init, dtype=float).reshape(-1)
+    endDay = firstDay + total_days
+
+    checkpointDays = sorted(set(int(day) for day in checkpointDays if firstDay < day <= endDay))
+    paramFingerprint = paramDict_fingerprint(kwargs) if checkpointDays else None
+
+    def writeCheckpoint(day, solverState, stepFirstDay, evaluatedUntil):
+        checkpoint = Checkpoint(
+            day,
+            kwargs["realStartDate"],
+            paramFingerprint,
+            solverSettings,
+            scipy_version(),
+            stateShape,
+            solverState,
+            stepFirstDay,
+            evaluatedUntil,
+        )
+        if callable(checkpointFile):
+            checkpointFile(checkpoint)
+        else:
+            save_checkpoint(checkpointFile.format(day=day), checkpoint)
+
+    if not np.isinf(samplesPerDay):
+        # Simple Euler method, as in solveSystem
+        if resumeFrom is not None:
+            cur_stateTensor = resumeFrom.solverState["y"].copy()
+        deltaT = 1.0 / samplesPerDay
+        fun, _ = solve_memoizedFunctions(lambda t, y: dydt_Complete(t, y, **kwargs), {})
+        for tt in range(firstDay * samplesPerDay, endDay * samplesPerDay):
+            if tt % samplesPerDay == 0:
+                day = tt // samplesPerDay
+                if day in checkpointDays:
+                    writeCheckpoint(day, OrderedDict(y=cur_stateTensor.copy()), day, (tt - 1.0) / samplesPerDay)
+                yield day, np.reshape(cur_stateTensor.copy(), stateShape)
+
+            with stepContext():
+                cur_stateTensor += deltaT * fun((tt * 1.0) / (1.0 * samplesPerDay), cur_stateTensor)
+        if endDay in checkpointDays:
+            writeCheckpoint(
+                endDay, OrderedDict(y=cur_stateTensor.copy()), endDay, (endDay * samplesPerDay - 1.0) / samplesPerDay
+            )
+        return
+
+    if solverMethod == "LSODA" and (checkpointDays or resumeFrom is not None):
+        # Its state is kept in the Fortran solver
+        raise ValueError("solveSystem_stream: checkpoints are not supported with LSODA")
+
+    # Latest day dydt_Complete (or its Jacobian) was evaluated on, for the checkpoints
+    evaluatedUntil = [-np.inf if resumeFrom is None else resumeFrom.evaluatedUntil]
+
+    def fun(t, y):
+        evaluatedUntil[0] = max(evaluatedUntil[0], t)
+        return dydt_Complete(t, y, **kwargs)
+
+    jacobianArgs = solveSystem_jacobianArgs(solverMethod, solverJacobian, kwargs)
+    if "jac" in jacobianArgs:
+        jac = jacobianArgs["jac"]
+
+        def trackedJac(t, y):
+            evaluatedUntil[0] = max(evaluatedUntil[0], t)
+            return jac(t, y)
+
+        jacobianArgs["jac"] = trackedJac
+    fun, jacobianArgs = solve_memoizedFunctions(fun, jacobianArgs)
+
+    # As solveSystem, each smooth segment between the days the policies switch on is integrated by a new solver,
+    # with the policies of before its switch (see segment_solverFunctions)
+    switchDays = policyCalendar_switchDays(paramDict_policyCalendar(kwargs), endDay + 1)
+    segmentEnds = [day for day in switchDays if day < endDay] + [endDay]
+    factorizations = []  # the matrices of the last LU factorizations (BDF keeps one, Radau two) for the checkpoints
+
+    def startSolver(t0, y0):
+        segmentEnd = next(day for day in segmentEnds if day > t0)
+        segmentFun, segmentArgs = fun, jacobianArgs
+        if segmentEnd in switchDays:
+            segmentFun, segmentArgs = segment_solverFunctions(fun, jacobianArgs, segmentEnd)
+        solver = getattr(integrate, solverMethod)(
+            segmentFun,
+            t0,
+            y0,
+            float(segmentEnd),
+            rtol=solverRtol,
+            atol=solverAtol,
+            max_step=solverMaxStep,
+            **segmentArgs,
+        )
+
+        factorizations.clear()
+        if hasattr(solver, "lu"):
+            solverLu = solver.lu
+
+            def recordingLu(matrix):
+                factorization = solverLu(matrix)
+                factorizations[:] = factorizations[-1:] + [(factorization, matrix)]
+                return factorization
+
+            solver.lu = recordingLu
+
+        return solver
+
+    with stepContext():
+        if resumeFrom is not None:
+            solver = startSolver(resumeFrom.solverState["t"], resumeFrom.solverState["y"])
+            tBound = solver.t_bound
+            restore_solverSnapshot(solver, resumeFrom.solverState)
+            solver.t_bound = tBound
+            solver.status = "running"
+            nextDay = resumeFrom.stepFirstDay
+            evaluatedUntil[0] = resumeFrom.evaluatedUntil
+        else:
+            solver = startSolver(0.0, cur_stateTensor)
+            nextDay = firstDay
+
+    # As solve_ivp with t_eval: after each step, the days up to and including solver.t are evaluated on its dense output
+    days = np.arange(endDay)
+    while nextDay < endDay or checkpointDays:
+        with stepContext():
+            # A step only evaluates up to solver.t + solver.h_abs (less if rejected), so it needs no snapshot
+            # if that (with a margin) is before the next checkpoint day
+            solverState = None
+            if checkpointDays and max(evaluatedUntil[0], solver.t + 2.0 * solver.h_abs) >= checkpointDays[0]:
+                solverState = solver_snapshot(solver, factorizations)
+            stepFirstDay = nextDay
+            stepEvaluatedFrom = evaluatedUntil[0]
+            message = solver.step()
+        if solver.status == "failed":
+            raise RuntimeError(f"solveSystem_stream: the solver failed on day {solver.t:.2f}: {message}")
+
+        while checkpointDays and checkpointDays[0] <= max(evaluatedUntil[0], solver.t):
+            if solverState is None:
+                raise RuntimeError(f"solveSystem_stream: no snapshot before the step reaching day {checkpointDays[0]}")
+            writeCheckpoint(checkpointDays.pop(0), solverState, stepFirstDay, stepEvaluatedFrom)
+
+        # The end of a segment before endDay is a switch day, simulated by the next segment
+        switched = solver.status == "finished" and solver.t < endDay
+        stepDays = days[nextDay : np.searchsorted(days, solver.t, side="right")]
+        if stepDays.size > 0:
+            stepStates = solver.dense_output()(stepDays)
+            for ii, day in enumerate(stepDays):
+                # (the first step of a resumed run may evaluate earlier days)
+                if day >= firstDay and not (switched and day == solver.t):
+                    yield int(day), np.reshape(stepStates[:, ii], stateShape)
+            nextDay = stepDays[-1] + 1
+
+        if switched:
+            # Started from the state evaluated on the switch day, as solve_ivpSegments
+            nextDay = int(solver.t)
+            with stepContext():
+                solver = startSolver(solver.t, stepStates[:, -1].copy())
+        elif solver.status == "finished":
+            break
+
+
+# ## Ensemble simulation
+#
+# Simulates N parameter sets (ensemble members) at once, eg. for uncertainty runs. The state gets a leading ensemble dimension,
+# the time-invariant operators, rate tables and calendars are precomputed for each member and stacked,
+# and the time- and state-dependent rates (new infections, testing, case isolation) are evaluated for all members
+# in one vectorized pass of the (batch-aware) transition functions, as in the fused engine.
+# All members are integrated together, sharing the adaptive time steps of the solver.
+
+# Parameters evaluated by the batch-aware functions during the simulation, stacked by stack_paramDicts
+# (all other parameters are only used to precompute the per-member operators, so they may differ in any way)
+ensembleStackedParams = [
+    "debugReturnNewPerDay",
+    "trFunc_newInfections",
+    "trFunc_newInfections_params",
+    "trFunc_quarantine",
+    "trFunc_quarantine_params",
+    "trFunc_testing",
+]
+ensembleStackedTestingParams = ["policyFunc", "policyFunc_params"]
+
+
+def stack_paramDicts(paramDicts):
+    """
+    Merges the (nested) paramDicts of the ensemble members into a single paramDict:
+    parameters that are the same for all members are kept as they are,
+    numeric parameters (numbers or arrays of the same shape) that differ are stacked along a new leading (ensemble) dimension
+    """
+
+    def stackRecurse(values, paramName):
+        if all(isinstance(value, dict) for value in values):
+            if any(list(value.keys()) != list(values[0].keys()) for value in values):
+                raise ValueError(
+                    f"stack_paramDicts: {paramName} has different parameters in the ensemble members"
+                )
+            return OrderedDict(
+                (key, stackRecurse([value[key] for value in values], key))
+                for key in values[0]
+            )
+
+        if all(
+            paramDict_fingerprint(value) == paramDict_fingerprint(values[0])
+            for value in values
+        ):
+            return values[0]
+
+        if all(
+            isinstance(value, (numbers.Number, np.ndarray))
+            and not isinstance(value, (bool, np.bool_))
+            and np.asarray(value).dtype.kind in "iuf"
+            and np.shape(value) == np.shape(values[0])
+            for value in values
+        ):
+            return np.stack([np.asarray(value) for value in values], axis=0)
+
+        raise ValueError(
+            f"stack_paramDicts: {paramName} differs between the ensemble members, but is not a numeric parameter"
+        )
+
+    return stackRecurse(list(paramDicts), "paramDict")
+
+
+Ensemble = namedtuple(
+    "Ensemble",
+    [
+        "nMembers",
+        "paramDict",  # stacked ensembleStackedParams (and ensembleStackedTestingParams) of the members
+        "staticRates",  # FusedStaticRates, each with a leading nMembers dimension
+        "travelMaxTime",  # nMembers vector
+        "travelInterpolate",  # nMembers boolean vector
+        "travelInfectionRateTable",  # nMembers x nAge x (max travelMaxTime + 2), zero after each member's travelMaxTime
+        "policyCalendar",  # PolicyCalendar of nMembers x nDays flags, with a common firstDay
+        "testingCalendar",  # TestingCalendar of nMembers x nDays (x nAge) vectors
+        "testTypes",
+        "testOutcomeRates",  # (nMembers x) nTestTypes x nHS x nTest x nTest, see CompiledTestSpecifications
+    ],
+)
+
+
+def ensemble_supports(paramDict):
+    """
+    True if paramDict can be an ensemble member (see build_ensemble), otherwise simulate it with solveSystem
+    """
+    # (the travel infection rates are tabulated from the parameters of trFunc_travelInfectionRate_ageAdjusted)
+    return (
+        paramDict["trFunc_quarantine"] is trFunc_quarantine_caseIsolation
+        and paramDict["trFunc_testing"] is trFunc_testing
+        and paramDict["trFunc_travelInfectionRate_ageAdjusted"] is trFunc_travelInfectionRate_ageAdjusted
+    )
+
+
+def build_ensemble(paramDicts, total_days):
+    """
+    Precomputes the Ensemble for simulating total_days with the given list of paramDicts (see build_paramDict and
+    paramTable_toDict), one per ensemble member. Only the default trFunc_testing, trFunc_quarantine_caseIsolation
+    and trFunc_travelInfectionRate_ageAdjusted are supported (see ensemble_supports).
+    """
+    paramDicts = list(paramDicts)
+    nMembers = len(paramDicts)
+
+    for paramDict in paramDicts:
+        if not ensemble_supports(paramDict):
+            raise ValueError(
+                "build_ensemble: only trFunc_testing, trFunc_quarantine_caseIsolation and "
+                "trFunc_travelInfectionRate_ageAdjusted are supported, "
+                "simulate members with other functions with solveSystem"
+            )
+
+    stackedParamDict = stack_paramDicts(
+        [
+            OrderedDict(
+                [(key, paramDict[key]) for key in ensembleStackedParams]
+                + [
+                    (key, paramDict["trFunc_testing_params"][key])
+                    for key in ensembleStackedTestingParams
+                ]
+            )
+            for paramDict in paramDicts
+        ]
+    )
+
+    # Disease progression, hospital admission and discharge
+    memberStaticRates = [
+        fusedStaticRates(**paramDict) for paramDict in paramDicts
+    ]
+    staticRates = FusedStaticRates(
+        *[np.stack(rates, axis=0) for rates in zip(*memberStaticRates)]
+    )
+
+    # Travel infection rates, padded with zeros to the longest table
+    # (plus one more zero day, so that interpolating on the last travel day reads a zero rate)
+    travelParams = [
+        paramDict["trFunc_travelInfectionRate_ageAdjusted_params"] for paramDict in paramDicts
+    ]
+    travelMaxTime = np.array([params["travelMaxTime"] for params in travelParams])
+    travelInfectionRateTable = np.zeros((nMembers, nAge, travelMaxTime.max() + 2))
+    for memberInd, params in enumerate(travelParams):
+        travelInfectionRateTable[memberInd, :, : params["travelMaxTime"]] = (
+            build_travelInfectionRateTable(
+                params["travelMaxTime"],
+                params["travelBaseRate"],
+                params["travelDecline_mean"],
+                params["travelDecline_slope"],
+                params["travelInfection_peak"],
+                params["travelInfection_maxloc"],
+                params["travelInfection_shape"],
+                params["agePopulationRatio"],
+            )[:, :-1]
+        )
+
+    # Policy flags on the union of the days the members' policies change on
+    memberPolicyCalendars = [
+        policyCalendar(
+            paramDict["realStartDate"],
+            paramDict["tStartSocialDistancing"],
+            paramDict["tStopSocialDistancing"],
+            paramDict["tStartImmunityPassports"],
+            paramDict["tStopImmunityPassports"],
+            paramDict["tStartQuarantineCaseIsolation"],
+            paramDict["tStopQuarantineCaseIsolation"],
+        )
+        for paramDict in paramDicts
+    ]
+    firstDay = min(cal.firstDay for cal in memberPolicyCalendars)
+    lastDay = max(
+        cal.firstDay + len(cal.socialDistancing) - 1 for cal in memberPolicyCalendars
+    )
+    days = np.arange(firstDay, lastDay + 1)
+    policyFlags = [
+        np.stack(
+            [
+                getattr(cal, policyName)[
+                    np.clip(days - cal.firstDay, 0, len(cal.socialDistancing) - 1)
+                ]
+                for cal in memberPolicyCalendars
+            ],
+            axis=0,
+        )
+        for policyName in PolicyCalendar._fields[1:]
+    ]
+
+    # Test capacity and real testing data (covering day total_days as well, the end of the integration)
+    memberTestingCalendars = [
+        testingCalendar(
+            total_days, paramDict["realStartDate"], **paramDict["trFunc_testing_params"]
+        )
+        for paramDict in paramDicts
+    ]
+    nDays = min(len(cal.realDataAvailable) for cal in memberTestingCalendars)
+    testingCal = TestingCalendar(
+        testsAvailable={
+            testType: np.stack(
+                [cal.testsAvailable[testType][:nDays] for cal in memberTestingCalendars],
+                axis=0,
+            )
+            for testType in memberTestingCalendars[0].testsAvailable
+        },
+        realDataAvailable=np.stack(
+            [cal.realDataAvailable[:nDays] for cal in memberTestingCalendars], axis=0
+        ),
+        realData=np.stack(
+            [cal.realData[:nDays] for cal in memberTestingCalendars], axis=0
+        ),
+    )
+
+    # Test specifications
+    memberTestSpecifications = [
+        compiledTestSpecifications(
+            paramDict["trFunc_testing_params"]["inpFunc_testSpecifications"],
+            paramDict["trFunc_testing_params"]["inpFunc_testSpecifications_params"],
+        )
+        for paramDict in paramDicts
+    ]
+    testTypes = memberTestSpecifications[0].testTypes
+    if any(specs.testTypes != testTypes for specs in memberTestSpecifications):
+        raise ValueError("build_ensemble: the test types differ between the ensemble members")
+
+    return Ensemble(
+        nMembers=nMembers,
+        paramDict=stackedParamDict,
+        staticRates=staticRates,
+        travelMaxTime=travelMaxTime,
+        travelInterpolate=np.array(
+            [bool(params.get("travelInterpolate", False)) for params in travelParams]
+        ),
+        travelInfectionRateTable=travelInfectionRateTable,
+        policyCalendar=PolicyCalendar(firstDay, *policyFlags),
+        testingCalendar=testingCal,
+        testTypes=testTypes,
+        testOutcomeRates=np.stack(
+            [specs.testOutcomeRates for specs in memberTestSpecifications], axis=0
+        ),
+    )
+
+
+def dydt_Ensemble(t, stateTensor_flattened, ensemble, mobility=None):
+    """
+    dydt_Complete(transitionEngine="fused") of all ensemble members at once,
+    stateTensor_flattened is the flattened nMembers x [2 x] nAge x nHS x nIso x nTest state (2 copies if debugReturnNewPerDay).
+    If the Mobility between the members is given, they are the coupled regions of a metapopulation (see build_metapopulation)
+    """
+    params = ensemble.paramDict
+    debugReturnNewPerDay = params["debugReturnNewPerDay"]
+
+    if debugReturnNewPerDay:
+        stateTensor = np.reshape(
+            stateTensor_flattened, [ensemble.nMembers, 2, nAge, nHS, nIso, nTest]
+        )[:, 0]
+    else:
+        stateTensor = np.reshape(
+            stateTensor_flattened, [ensemble.nMembers, nAge, nHS, nIso, nTest]
+        )
+
+    curDay = max(int(t), 0)
+
+    # Policies in place on day t (see policyCalendar_flags)
+    dayInd = min(
+        max(int(np.floor(t)) - ensemble.policyCalendar.firstDay, 0),
+        ensemble.policyCalendar.socialDistancing.shape[-1] - 1,
+    )
+    policySocialDistancing = ensemble.policyCalendar.socialDistancing[:, dayInd]
+    policyImmunityPassports = ensemble.policyCalendar.immunityPassports[:, dayInd]
+    policyQuarantineCaseIsolation = ensemble.policyCalendar.quarantineCaseIsolation[
+        :, dayInd
+    ]
+
+    def newInfections(stateTensor):
+        return params["trFunc_newInfections"](
+            stateTensor,
+            policySocialDistancing=policySocialDistancing,
+            policyImmunityPassports=policyImmunityPassports,
+            **params["trFunc_newInfections_params"],
+        )
+
+    if mobility is None:
+        trTensor_newInfections = newInfections(stateTensor)
+    else:
+        trTensor_newInfections = metapopulation_newInfections(stateTensor, mobility, newInfections)
+
+    # Travel infections (see trFunc_travelInfectionRate_ageAdjusted), no travel after each member's travelMaxTime
+    travelDay = np.minimum(int(t), ensemble.travelMaxTime)
+    travelFrac = np.where(
+        ensemble.travelInterpolate & (t < ensemble.travelMaxTime), t - int(t), 0.0
+    )[:, np.newaxis]
+    memberInds = np.arange(ensemble.nMembers)
+    travelInfectionRate = (1.0 - travelFrac) * ensemble.travelInfectionRateTable[
+        memberInds, :, travelDay
+    ] + travelFrac * ensemble.travelInfectionRateTable[memberInds, :, travelDay + 1]
+
+    # Testing (see trFunc_testing)
+    testsAdministeredRate = testing_administeredRate(
+        stateTensor,
+        curDay,
+        ensemble.testTypes,
+        realDataAvailable=ensemble.testingCalendar.realDataAvailable[:, curDay],
+        realData=ensemble.testingCalendar.realData[:, curDay],
+        testsAvailable={
+            # copies, as the policy functions subtract the tests used
+            testType: ensemble.testingCalendar.testsAvailable[testType][:, curDay].copy()
+            for testType in ensemble.testingCalendar.testsAvailable
+        },
+        policyFunc=params["policyFunc"],
+        policyFunc_params=params["policyFunc_params"],
+    )
+    # (optimize=True contracts via BLAS, the plain einsum loops very slowly over the ensemble dimension)
+    trTensor_testing = np.einsum(
+        "...ijklt,...tjlm->...ijklm",
+        testsAdministeredRate,
+        ensemble.testOutcomeRates,
+        optimize=True,
+    )
+
+    # Case isolation, only in the members where the policy is in place
+    if np.any(policyQuarantineCaseIsolation):
+        trTensor_quarantineRate = quarantineRate_caseIsolation(
+            trTensor_testing, **params["trFunc_quarantine_params"]
+        )
+    else:
+        trTensor_quarantineRate = None
+
+    inflow, outflow = fused_inOutFlows(
+        stateTensor,
+        ensemble.staticRates,
+        trTensor_newInfections,
+        travelInfectionRate,
+        trTensor_testing,
+        trTensor_quarantineRate=trTensor_quarantineRate,
+        policyQuarantineCaseIsolation=policyQuarantineCaseIsolation,
+    )
+
+    dydt = inflow - outflow
+
+    if debugReturnNewPerDay:
+        dydt = np.stack([dydt, inflow], axis=1)
+
+    return np.reshape(dydt, -1)
+
+
+def solveEnsemble(
+    stateTensor_init,
+    total_days,
+    ensemble,
+    solverMethod="RK23",
+    solverRtol=1e-3,
+    solverAtol=1e-3,
+    solverMaxStep=np.inf,
+):
+    """
+    Simulates all members of the ensemble (see build_ensemble) for total_days, like solveSystem does for a single paramDict.
+    stateTensor_init is either the nAge x nHS x nIso x nTest initial state of all members, or nMembers x that.
+    Returns the nMembers x [2 x] nAge x nHS x nIso x nTest x total_days states.
+    Only the explicit solvers of integrate.solve_ivp are supported, the step size is controlled by the error of all members.
+    """
+    if solverMethod in ["BDF", "Radau", "LSODA"]:
+        raise ValueError(
+            f"solveEnsemble: implicit solverMethod {solverMethod} is not supported, use an explicit one (eg. 'RK23')"
+        )
+
+    stateShape = (nAge, nHS, nIso, nTest)
+    stateTensor_init = np.broadcast_to(
+        stateTensor_init, (ensemble.nMembers,) + stateShape
+    )
+    if ensemble.paramDict["debugReturnNewPerDay"]:  # Keep the second copy as well
+        stateShape = (2,) + stateShape
+        stateTensor_init = np.stack([stateTensor_init, stateTensor_init], axis=1)
+
+    # Restarted on the days any member's policies switch on (see solveSystem)
+    out, _ = solve_ivpSegments(
+        lambda t, y: dydt_Ensemble(t, y, ensemble),
+        np.reshape(stateTensor_init, -1).astype(float),
+        total_days,
+        policyCalendar_switchDays(ensemble.policyCalendar, total_days + 1),
+        method=solverMethod,
+        rtol=solverRtol,
+        atol=solverAtol,
+        max_step=solverMaxStep,
+    )
+
+    return np.reshape(out, (ensemble.nMembers,) + stateShape + (-1,))
+
+
+# ## Metapopulation simulation
+#
+# Simulates many coupled regions (eg. the districts of a country) at once. Each region has its own inputs (a Model, eg. of
+# its own data folder with its own sme_input.json and social mixing matrices), and the regions are simulated together as
+# the members of an ensemble (see build_ensemble), with the region as the leading state dimension.
+# The regions are coupled by the movements of their non-isolated people (isolation states 0 and 3), as in commuter models:
+# mobility[r, s] is the fraction of the contacts of the residents of region r made in region s (rows sum to 1).
+# The force of infection in region s is that of the people present there (the mobile people of all regions, weighted by
+# mobility[:, s], and the isolated and hospitalised people of s), and the mobile residents of region r are infected
+# at the mobility[r, :] weighted average of the forces of infection of the regions they go to.
+# Home isolated and hospitalised people stay in their own region.
+# Both couplings are products with the sparse mobility matrix over the region dimension, so a time step costs about
+# the same per region for any number of regions (and mobility links), and only the daily states summed over the
+# isolation and test states are kept (a 16th of the full states, summed as they are simulated, see solve_ivpDays).
+# Without mobility (None) the regions are independent, and simulated exactly as by solveEnsemble.
+
+# Isolation states of the people moving between the regions: non-isolated people, and hospital staff
+mobileIsoStates = [0, 3]
+
+Mobility = namedtuple(
+    "Mobility",
+    [
+        "matrix",  # nRegions x nRegions sparse (CSR) matrix of the fractions of the contacts of region r made in region s
+        "transposed",  # its transpose (CSR), for the products over the regions of origin
+    ],
+)
+
+Metapopulation = namedtuple(
+    "Metapopulation",
+    [
+        "regions",  # names of the regions
+        "ensemble",  # Ensemble of the regions' parameters (see build_ensemble)
+        "mobility",  # Mobility between the regions (None if they are independent)
+        "stateTensor_init",  # nRegions x nAge x nHS x nIso x nTest initial states of the regions' inputs
+        "realStartDates",  # date of simulation day 0 of each region
+    ],
+)
+
+
+def build_mobility(nRegions, origins=(), destinations=(), fractions=()):
+    """
+    Returns the Mobility between nRegions regions, given the fractions of the contacts of the residents of the origins
+    made in the destinations (region indices; repeated pairs are summed, the ones within a region are ignored).
+    The rest of their contacts are made in their own region.
+    """
+    origins, destinations = np.asarray(origins, dtype=int), np.asarray(destinations, dtype=int)
+    fractions = np.asarray(fractions, dtype=float)
+    if np.any(fractions < 0.0):
+        raise ValueError("build_mobility: the mobility fractions must not be negative")
+
+    between = origins != destinations
+    matrix = sparse.csr_matrix(
+        (fractions[between], (origins[between], destinations[between])), shape=(nRegions, nRegions)
+    )
+    stay = 1.0 - np.asarray(matrix.sum(axis=1)).ravel()
+    if np.any(stay < 0.0):
+        raise ValueError(
+            f"build_mobility: the mobility fractions out of regions {list(np.flatnonzero(stay < 0.0))} sum to more than 1"
+        )
+    matrix = (matrix + sparse.diags(stay)).tocsr()
+
+    return Mobility(matrix, matrix.T.tocsr())
+
+
+def load_mobility(filename, regions):
+    """
+    Reads the CSV table of the mobility between the regions (columns origin, destination: region names, and fraction),
+    see build_mobility
+    """
+    df = pd.read_csv(filename, dtype={"origin": str, "destination": str})
+    regionInds = pd.Series(np.arange(len(regions)), index=[str(region) for region in regions])
+    unknown = set(df["origin"]).union(df["destination"]).difference(regionInds.index)
+    if unknown:
+        raise ValueError(f"load_mobility: unknown regions {sorted(unknown)} in {filename}")
+
+    return build_mobility(
+        len(regions),
+        regionInds[df["origin"]].values,
+        regionInds[df["destination"]].values,
+        df["fraction"].values,
+    )
+
+
+def load_regionsTable(filename):
+    """
+    Reads the CSV table of the regions (columns region, and data_dir: the folder of its input files, relative to
+    the folder of the table), returns the (region names, Models of the regions), see build_model.
+    Any other columns override the parameters of the regions, as in the scenario table of a sweep (see sweepTable_toParamDicts),
+    eg. the test capacities (trFunc_testing_params_trFunc_testCapacity_params_...), which are absolute numbers.
+    """
+    df = pd.read_csv(filename, dtype={"region": str, "data_dir": str})
+    if df["region"].duplicated().any():
+        raise ValueError(f"load_regionsTable: duplicate regions in {filename}")
+
+    tableDir = os.path.dirname(os.path.abspath(filename))
+    paramTable = df.drop(columns=["region", "data_dir"])
+    regionModels = []
+    for rowInd, data_dir in enumerate(df["data_dir"]):
+        model = build_model(os.path.join(tableDir, data_dir))
+        if len(paramTable.columns) > 0:
+            _, _, paramDict = sweepTable_toParamDicts(paramTable.iloc[[rowInd]], model.paramDict, None)[0]
+            model = model._replace(paramDict=paramDict)
+        regionModels.append(model)
+
+    return list(df["region"]), regionModels
+
+
+def build_metapopulation(regionModels, total_days, mobility=None, regions=None):
+    """
+    Precomputes the Metapopulation of the regions of the given Models (see build_model, their paramDicts may be modified,
+    see build_ensemble for what may differ) for simulating total_days, coupled by their Mobility (default: independent regions).
+    regions are their names (default: their numbers).
+    """
+    regionModels = list(regionModels)
+    nRegions = len(regionModels)
+    if mobility is not None and mobility.matrix.shape != (nRegions, nRegions):
+        raise ValueError(
+            f"build_metapopulation: the mobility matrix is {mobility.matrix.shape}, but there are {nRegions} regions"
+        )
+
+    return Metapopulation(
+        regions=list(range(nRegions)) if regions is None else list(regions),
+        ensemble=build_ensemble([model.paramDict for model in regionModels], total_days),
+        mobility=mobility,
+        stateTensor_init=np.stack([model.inputs["stateTensor_init"] for model in regionModels], axis=0),
+        realStartDates=[model.paramDict["realStartDate"] for model in regionModels],
+    )
+
+
+def metapopulation_newInfections(stateTensor, mobility, newInfections):
+    """
+    New infection rates (see trFunc_newInfections_Complete) of the nRegions x nAge x nHS x nIso x nTest stateTensor
+    of coupled regions, where newInfections(stateTensor) are those of the regions on their own
+    """
+    nRegions = stateTensor.shape[0]
+
+    # People present in each region
+    presentTensor = stateTensor.copy()
+    mobileTensor = stateTensor[..., mobileIsoStates, :]
+    presentTensor[..., mobileIsoStates, :] = np.reshape(
+        mobility.transposed @ np.reshape(mobileTensor, (nRegions, -1)), mobileTensor.shape
+    )
+
+    # Isolated and hospitalised people are infected in their region, mobile people where they go
+    trTensor_newInfections = newInfections(stateTensor)
+    presentRates = newInfections(presentTensor)[..., mobileIsoStates, :]
+    trTensor_newInfections[..., mobileIsoStates, :] = np.reshape(
+        mobility.matrix @ np.reshape(presentRates, (nRegions, -1)), presentRates.shape
+    )
+
+    return trTensor_newInfections
+
+
+def solveMetapopulation(
+    stateTensor_init,
+    total_days,
+    metapopulation,
+    solverMethod="RK23",
+    solverRtol=1e-3,
+    solverAtol=1e-3,
+    solverMaxStep=np.inf,
+):
+    """
+    Simulates the coupled regions of the metapopulation (see build_metapopulation) for total_days, as solveEnsemble.
+    stateTensor_init is the nRegions x nAge x nHS x nIso x nTest initial state (None for that of the regions' inputs).
+    Returns the nRegions x [2 x] nAge x nHS x total_days states summed over the isolation and test states (see array_to_df).
+    """
+    ensemble = metapopulation.ensemble
+    if solverMethod in ["BDF", "Radau", "LSODA"]:
+        raise ValueError(
+            f"solveMetapopulation: implicit solverMethod {solverMethod} is not supported, use an explicit one (eg. 'RK23')"
+        )
+
+    if stateTensor_init is None:
+        stateTensor_init = metapopulation.stateTensor_init
+    stateShape = (ensemble.nMembers, nAge, nHS, nIso, nTest)
+    stateTensor_init = np.broadcast_to(stateTensor_init, stateShape)
+    if ensemble.paramDict["debugReturnNewPerDay"]:  # Keep the second copy as well
+        stateShape = (ensemble.nMembers, 2) + stateShape[1:]
+        stateTensor_init = np.stack([stateTensor_init, stateTensor_init], axis=1)
+
+    result = np.zeros(stateShape[:-2] + (total_days,))
+    for day, state in solve_ivpDays(
+        lambda t, y: dydt_Ensemble(t, y, ensemble, mobility=metapopulation.mobility),
+        np.reshape(stateTensor_init, -1).astype(float),
+        total_days,
+        policyCalendar_switchDays(ensemble.policyCalendar, total_days + 1),
+        method=solverMethod,
+        rtol=solverRtol,
+        atol=solverAtol,
+        max_step=solverMaxStep,
+    ):
+        result[..., day] = np.sum(np.reshape(state, stateShape), axis=(-2, -1))
+
+    return result
+
+
+def metapopulation_toDf(metapopulation, result):
+    """
+    Output table (see clean_df) of the result of solveMetapopulation, the rows of all regions keyed by region
+    """
+    dfs = []
+    for region, realStartDate, regionResult in zip(
+        metapopulation.regions, metapopulation.realStartDates, result
+    ):
+        df = clean_df(array_to_df(result.shape[-1], regionResult), realStartDate)
+        df.insert(0, "region", region)
+        dfs.append(df)
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+### df Clean up for folding on all states except Health States
+# Labels of the state tensor axes in the output tables
+outputArrivalTypes = ["current", "new"]
+outputAgeGroups = ["0-9", "10-19", "20-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80+"]
+outputHealthStates = ["susceptible", "exposed", "asymptomatic", "infected1", "infected2", "recovered1", "recovered2", "deceased"]
+outputIsoStates = ["distancing", "quarantined", "hospitalized", "hospStaff"]
+outputTestStates = ["neg_noTest", "pos_test", "pos_antibody", "pos_both"]
+
+
+def array_to_df(total_days, result, firstDay=1):
+    """
+    Long format table of the 2 x nAge x nHS x nIso x nTest x total_days result of solveSystem, summed over the isolation
+    and test states (or of an already summed 2 x nAge x nHS x total_days one, see solveMetapopulation):
+    one row per (simDay, arrivalType, ageGroup, healthState), sorted by these (labels alphabetically).
+    The days of result are numbered from firstDay.
+    """
+    # Sum out the isolation and test states, then order the axes as the rows: day, arrival type, age group, health state
+    # (alphabetical order of the labels, as grouping by them did)
+    labelOrders = [
+        np.argsort(labels, kind="stable")
+        for labels in [outputArrivalTypes, outputAgeGroups, outputHealthStates]
+    ]
+    summed = np.sum(np.reshape(result, (2, nAge, nHS, -1, total_days)), axis=3)
+    summed = summed[np.ix_(*labelOrders, range(total_days))]
+    values = np.transpose(summed, (3, 0, 1, 2))
+
+    # Index columns broadcast along the other axes
+    def indexColumn(labels, axis):
+        shape = [1] * values.ndim
+        shape[axis] = -1
+        return np.broadcast_to(np.reshape(labels, shape), values.shape).ravel()
+
+    return pd.DataFrame(
+        {
+            "simDay": indexColumn(np.arange(firstDay, firstDay + total_days), 0),
+            "arrivalType": indexColumn(np.array(outputArrivalTypes, dtype=object)[labelOrders[0]], 1),
+            "ageGroup": indexColumn(np.array(outputAgeGroups, dtype=object)[labelOrders[1]], 2),
+            "healthState": indexColumn(np.array(outputHealthStates, dtype=object)[labelOrders[2]], 3),
+            "value": values.ravel(),
+        }
+    )
+
+# add the date of each simDay ("YYYY-MM-DD") and reorder columns
+def clean_df(df, realStartDate=None):
+    # realStartDate is the date of simulation day 0 (default: testingStartDate of the inputs)
+    if realStartDate is None:
+        realStartDate = load_inputs()["testingStartDate"]
+    startDate = np.datetime64(pd.Timestamp(realStartDate).date(), "D")
+    ts = np.datetime_as_string(startDate + df["simDay"].to_numpy().astype("timedelta64[D]"), unit="D")
+
+    if "timestamp" in df.columns:
+        df.drop(labels=['timestamp'], axis=1, inplace=True)
+    df.insert(0, 'timestamp', ts.astype(object))
+
+    return df    
+
+# ## Output files
+#
+# The output table is written as CSV, or in the columnar Parquet / Feather formats (needs the optional pyarrow package),
+# with the label columns dictionary encoded (pandas categoricals), which are much faster to write and read back.
+# A single run can also be saved as the raw state tensor (not summed over the isolation and test states): as .npz,
+# or as a memory-mapped store (.npy with a JSON sidecar, see the raw state tensor store below).
+# The format is chosen by the file extension, or given explicitly (-format).
+
+outputFormats = OrderedDict(
+    [(".csv", "csv"), (".parquet", "parquet"), (".feather", "feather"), (".npz", "npz"), (".npy", "npy")]
+)
+
+# Label columns of the output tables, with their categories in state tensor order
+outputCategories = OrderedDict(
+    [
+        ("arrivalType", outputArrivalTypes),
+        ("ageGroup", outputAgeGroups),
+        ("healthState", outputHealthStates),
+        ("isoState", outputIsoStates),
+        ("testState", outputTestStates),
+    ]
+)
+
+
+def output_format(filename, outputFormat=None):
+    """
+    Returns outputFormat if given, otherwise the format of the extension of filename (CSV if not one of outputFormats)
+    """
+    if outputFormat is not None:
+        if outputFormat not in outputFormats.values():
+            raise ValueError(
+                f"output_format: unknown format {outputFormat!r}, use one of {list(outputFormats.values())}"
+            )
+        return outputFormat
+
+    return outputFormats.get(os.path.splitext(filename)[1].lower(), "csv")
+
+
+def require_pyarrow(outputFormat):
+    """
+    Raises an ImportError with installation instructions if pyarrow (needed for Parquet and Feather files) is missing
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        raise ImportError(f"{outputFormat} files need the pyarrow package: pip install pyarrow")
+
+
+def output_toCategorical(df):
+    """
+    Returns a copy of the output table with the label columns (outputCategories) as pandas categoricals
+    """
+    df = df.copy()
+    for col, categories in outputCategories.items():
+        if col in df.columns:
+            df[col] = pd.Categorical(df[col], categories=categories)
+
+    return df
+
+
+def save_output(filename, df=None, result=None, realStartDate=None, outputFormat=None, paramDict=None, firstDay=1):
+    """
+    Writes the output table df (see clean_df) to filename, in outputFormat (default: by its extension, see output_format).
+    The "npz" and "npy" formats store the raw state tensor result of solveSystem instead, with the axis labels,
+    realStartDate (the date of simulation day 0) and the number of its first day (firstDay, as in array_to_df),
+    "npy" also the fingerprint of paramDict (see save_stateStore).
+    """
+    outputFormat = output_format(filename, outputFormat)
+
+    if outputFormat == "npy":
+        if result is None:
+            raise ValueError("save_output: the npy format needs the state tensor result (only for a single run)")
+        save_stateStore(filename, result, realStartDate, paramDict, firstDay)
+    elif outputFormat == "npz":
+        if result is None:
+            raise ValueError("save_output: the npz format needs the state tensor result (only for a single run)")
+        np.savez(
+            filename,
+            result=result,
+            realStartDate=str(pd.Timestamp(realStartDate).date()),
+            firstDay=firstDay,
+            **{f"labels_{col}": np.array(labels) for col, labels in outputCategories.items()},
+        )
+    elif outputFormat in ["parquet", "feather"]:
+        require_pyarrow(outputFormat)
+        df = output_toCategorical(df)
+        if outputFormat == "parquet":
+            df.to_parquet(filename, index=False)
+        else:
+            df.to_feather(filename)
+    else:
+        df.to_csv(filename, index=False)
+
+
+def load_output(filename, outputFormat=None):
+    """
+    Reads an output file written by save_output as the output table (the label columns are categoricals if the file
+    was Parquet / Feather). An npz / npy state tensor is summed over the isolation and test states as in array_to_df.
+    """
+    outputFormat = output_format(filename, outputFormat)
+
+    if outputFormat == "npy":
+        store = open_stateStore(filename)
+        return clean_df(
+            array_to_df(store.data.shape[-1], np.asarray(store.data), firstDay=store.labels["simDay"][0]),
+            store.realStartDate,
+        )
+    elif outputFormat == "npz":
+        with np.load(filename) as npz:
+            result = npz["result"]
+            realStartDate = pd.to_datetime(str(npz["realStartDate"]), format="%Y-%m-%d")
+            firstDay = int(npz["firstDay"]) if "firstDay" in npz.files else 1
+        return clean_df(array_to_df(result.shape[-1], result, firstDay=firstDay), realStartDate)
+    elif outputFormat in ["parquet", "feather"]:
+        require_pyarrow(outputFormat)
+        if outputFormat == "parquet":
+            return pd.read_parquet(filename)
+        return pd.read_feather(filename)
+
+    return pd.read_csv(filename)
+
+
+# ## Raw state tensor store
+#
+# The full 2 x nAge x nHS x nIso x nTest x days result of solveSystem is saved as a .npy file, with a JSON sidecar
+# (same name, .json extension) of the axis labels, the start date and the fingerprint of the parameters.
+# The store is opened memory-mapped, and stateStore_marginal sums it over any of its axes one (arrivalType, ageGroup)
+# block at a time, so eg. the isolation or test states by day can be looked at without loading the whole store
+# or simulating again.
+
+stateStoreAxes = ["arrivalType", "ageGroup", "healthState", "isoState", "testState", "simDay"]
+
+StateStore = namedtuple(
+    "StateStore",
+    [
+        "data",  # memory-mapped 2 x nAge x nHS x nIso x nTest x days state tensor
+        "labels",  # OrderedDict of stateStoreAxes -> labels along the axis (simDay: the day numbers of array_to_df)
+        "realStartDate",  # date of simulation day 0 (pd.Timestamp)
+        "paramFingerprint",  # paramDict_fingerprint of the parameters simulated (None if not known)
+    ],
+)
+
+
+def stateStore_sidecar(filename):
+    """
+    Name of the JSON metadata file of the store filename
+    """
+    return os.path.splitext(filename)[0] + ".json"
+
+
+def save_stateStore(filename, result, realStartDate, paramDict=None, firstDay=1):
+    """
+    Saves the result of solveSystem (with debugReturnNewPerDay) as the store filename (.npy) and its JSON sidecar,
+    its days numbered from firstDay
+    """
+    days = result.shape[-1]
+    np.save(filename, np.reshape(result, (2, nAge, nHS, nIso, nTest, days)))
+    save_stateStoreSidecar(filename, days, realStartDate, paramDict, firstDay)
+
+
+def save_stateStoreSidecar(filename, days, realStartDate, paramDict=None, firstDay=1):
+    """
+    Writes the JSON sidecar of the store filename of days days numbered from firstDay (see save_stateStore)
+    """
+    metadata = OrderedDict(
+        [
+            ("axes", stateStoreAxes),
+            (
+                "labels",
+                OrderedDict(list(outputCategories.items()) + [("simDay", list(range(firstDay, firstDay + days)))]),
+            ),
+            ("realStartDate", str(pd.Timestamp(realStartDate).date())),
+            ("paramFingerprint", None if paramDict is None else paramDict_fingerprint(paramDict)),
+        ]
+    )
+    with open(stateStore_sidecar(filename), "w") as jf:
+        json.dump(metadata, jf, indent=4)
+
+
+def open_stateStore(filename):
+    """
+    Opens the store filename (see save_stateStore) memory-mapped, returns a StateStore
+    """
+    with open(stateStore_sidecar(filename)) as jf:
+        metadata = json.load(jf)
+
+    return StateStore(
+        np.load(filename, mmap_mode="r"),
+        OrderedDict((axis, metadata["labels"][axis]) for axis in metadata["axes"]),
+        pd.to_datetime(metadata["realStartDate"], format="%Y-%m-%d"),
+        metadata["paramFingerprint"],
+    )
+
+
+def stateStore_marginal(store, keep, select=None):
+    """
+    Sums the StateStore over all axes but keep (a list of stateStoreAxes names), only including the labels
+    in select (a dict of axis name -> label or list of labels, eg. {"healthState": ["infected1", "infected2"]}).
+    Returns a long format table with a column per kept axis (in the order of keep, plus the timestamp if simDay is kept)
+    and the summed value.
+    """
+    select = {} if select is None else select
+    for axis in list(keep) + list(select):
+        if axis not in stateStoreAxes:
+            raise ValueError(f"stateStore_marginal: unknown axis {axis!r}, use one of {stateStoreAxes}")
+
+    # Indices of the included labels along each axis
+    indices = []
+    for axis, labels in store.labels.items():
+        if axis in select:
+            included = select[axis]
+            if isinstance(included, (str, numbers.Integral)):
+                included = [included]
+            missing = [label for label in included if label not in labels]
+            if missing:
+                raise ValueError(f"stateStore_marginal: {axis} has no labels {missing}")
+            indices.append(np.array([labels.index(label) for label in included], dtype=int))
+        else:
+            indices.append(np.arange(len(labels)))
+
+    keptAxes = [stateStoreAxes.index(axis) for axis in keep]
+    sortedKeptAxes = sorted(keptAxes)
+    out = np.zeros([len(indices[axis]) for axis in sortedKeptAxes])
+
+    # Read one (arrivalType, ageGroup) block at a time, only the included labels of the other axes
+    summedBlockAxes = tuple(axis - 2 for axis in range(2, len(stateStoreAxes)) if axis not in keptAxes)
+    for (pos0, ind0), (pos1, ind1) in itertools.product(enumerate(indices[0]), enumerate(indices[1])):
+        block = np.asarray(store.data[ind0, ind1])[np.ix_(*indices[2:])]
+        outInd = tuple(pos for axis, pos in [(0, pos0), (1, pos1)] if axis in keptAxes)
+        out[outInd] += np.sum(block, axis=summedBlockAxes)
+
+    # Long format table, the columns in the order of keep
+    out = np.transpose(out, [sortedKeptAxes.index(axis) for axis in keptAxes])
+    columns = OrderedDict()
+    for outAxis, axis in enumerate(keptAxes):
+        labels = np.array(list(store.labels.values())[axis], dtype=object)[indices[axis]]
+        shape = [1] * out.ndim
+        shape[outAxis] = -1
+        columns[stateStoreAxes[axis]] = np.broadcast_to(np.reshape(labels, shape), out.shape).ravel()
+    columns["value"] = out.ravel()
+    df = pd.DataFrame(columns)
+
+    if "simDay" in keep:
+        df["simDay"] = df["simDay"].astype(int)
+        df = clean_df(df, store.realStartDate)
+
+    return df
+
+
+# ## Streamed output files
+#
+# save_streamedOutput writes the days of a solveSystem_stream to the output file chunkDays at a time as they are simulated
+# (-stream), so that only one chunk is held in memory however long the run: the output table is appended to a CSV file
+# or written as Parquet row groups, and the state tensor is written into a state store allocated on disk (npy).
+# The files are the same as save_output writes for the whole run.
+
+streamChunkDays = 32  # number of days held in memory before they are written
+
+
+def stream_chunks(stream, chunkDays=streamChunkDays):
+    """
+    Groups the (day, stateTensor) of stream into (firstDay, chunk) with up to chunkDays days along the last axis of chunk
+    """
+    chunk = []
+    for day, stateTensor in stream:
+        if not chunk:
+            firstDay = day
+        chunk.append(stateTensor)
+        if len(chunk) == chunkDays:
+            yield firstDay, np.stack(chunk, axis=-1)
+            chunk = []
+    if chunk:
+        yield firstDay, np.stack(chunk, axis=-1)
+
+
+def save_streamedOutput(
+    filename,
+    stream,
+    total_days,
+    realStartDate,
+    outputFormat=None,
+    paramDict=None,
+    chunkDays=streamChunkDays,
+):
+    """
+    Writes the total_days days of stream (see solveSystem_stream, with debugReturnNewPerDay) to filename as it is
+    simulated, in the "csv", "parquet" (output table) or "npy" (state store) outputFormat (see save_output).
+    The days are numbered from the first day of stream (after the day of the checkpoint of a resumed run).
+    """
+    outputFormat = output_format(filename, outputFormat)
+    if outputFormat not in ["csv", "parquet", "npy"]:
+        raise ValueError(f"save_streamedOutput: the {outputFormat} format can only be written for the whole run")
+
+    if outputFormat == "npy":
+        store = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=float, shape=(2, nAge, nHS, nIso, nTest, total_days)
+        )
+        streamFirstDay = None
+        for firstDay, chunk in stream_chunks(stream, chunkDays):
+            if streamFirstDay is None:
+                streamFirstDay = firstDay
+            storeDay = firstDay - streamFirstDay
+            store[..., storeDay : storeDay + chunk.shape[-1]] = np.reshape(chunk, store.shape[:-1] + (-1,))
+            store.flush()  # the written days need not stay in memory
+        del store
+        save_stateStoreSidecar(filename, total_days, realStartDate, paramDict, streamFirstDay + 1)
+        return
+
+    if outputFormat == "parquet":
+        require_pyarrow(outputFormat)
+        import pyarrow
+        import pyarrow.parquet
+
+    parquetWriter = None
+    firstChunk = True
+    try:
+        for firstDay, chunk in stream_chunks(stream, chunkDays):
+            df = clean_df(array_to_df(chunk.shape[-1], chunk, firstDay=firstDay + 1), realStartDate)
+            if outputFormat == "parquet":
+                table = pyarrow.Table.from_pandas(output_toCategorical(df), preserve_index=False)
+                if parquetWriter is None:
+                    parquetWriter = pyarrow.parquet.ParquetWriter(filename, table.schema)
+                parquetWriter.write_table(table)
+            else:
+                df.to_csv(filename, mode="w" if firstChunk else "a", header=firstChunk, index=False)
+            firstChunk = False
+    finally:
+        if parquetWriter is not None:
+            parquetWriter.close()
+
+
+# ## Scenario sweeps
+#
+# Runs many scenarios in parallel, each given as one row of a table of parameter overrides.
+# The columns are the flattened parameter names of paramDict_toTable (eg. "trFunc_newInfections_params_withinHospitalSocialMixing"),
+# empty cells keep the default value. Array parameters are given as JSON lists, functions by their name in this module.
+# Two optional extra columns: "scenario" (the key of the scenario in the output, the row number by default)
+# and "days" (number of days to simulate, if different from the default)
+
+sweepBlasThreadVars = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def load_sweepTable(filename):
+    """
+    Reads a table of scenarios from a CSV or Parquet (.parquet) file
+    """
+    if os.path.splitext(filename)[1].lower() == ".parquet":
+        return pd.read_parquet(filename)
+
+    return pd.read_csv(filename)
+
+
+def sweepValue_toParam(value, default, paramName):
+    """
+    Converts a value of the scenario table to the type of the default value of the parameter
+    """
+    if paramName in policyDateParams:  # (a date or a list of dates, see policy_intervals)
+        return parse_policyDates(value)
+
+    if isinstance(value, str) and isinstance(default, (np.ndarray, list, tuple)):
+        value = json.loads(value)
+
+    if callable(default):
+        if isinstance(value, str):
+            if not callable(globals().get(value)):
+                raise ValueError(f"sweepValue_toParam: {paramName}: no function named {value}")
+            value = globals()[value]
+    elif isinstance(default, np.ndarray):
+        value = np.array(value, dtype=default.dtype)
+        if value.shape != default.shape:
+            raise ValueError(
+                f"sweepValue_toParam: {paramName} should have shape {default.shape}, got {value.shape}"
+            )
+    elif isinstance(default, pd.Timestamp):
+        value = pd.to_datetime(value, format="%Y-%m-%d")
+    elif isinstance(default, (bool, np.bool_)):
+        if isinstance(value, str):
+            if value.strip().lower() not in ["true", "false"]:
+                raise ValueError(f"sweepValue_toParam: {paramName} should be True or False, got {value}")
+            value = value.strip().lower() == "true"
+        else:
+            value = bool(value)
+    elif isinstance(default, numbers.Integral):
+        value = int(value)
+    elif isinstance(default, numbers.Real):
+        value = float(value)
+
+    return value
+
+
+def sweepTable_toParamDicts(sweepTable, defaultDict, total_days):
+    """
+    Returns the list of (scenario, days, paramDict) of the rows of the scenario table,
+    the paramDicts are copies of defaultDict with the (non-empty) values of the row overriding the defaults
+    """
+    defaultTable = paramDict_toTable(defaultDict)
+
+    paramColumns = [col for col in sweepTable.columns if col not in ["scenario", "days"]]
+    unknownColumns = [col for col in paramColumns if col not in defaultTable.columns]
+    if len(unknownColumns) > 0:
+        raise ValueError(f"sweepTable_toParamDicts: unknown parameters {unknownColumns}")
+
+    scenarios = []
+    for rowInd in range(len(sweepTable)):
+        row = sweepTable.iloc[rowInd]
+
+        functionOverrides = OrderedDict()
+        overrides = OrderedDict()
+        for col in paramColumns:
+            value = row[col]
+            if np.ndim(value) == 0 and pd.isna(value):  # empty cell, keep the default
+                continue
+            value = sweepValue_toParam(value, defaultTable.at[0, col], col)
+            if callable(value) and value is not defaultTable.at[0, col]:
+                # A different function comes with its own default parameters (overridden by the later columns)
+                functionOverrides[col] = [value]
+                functionOverrides[col + "_params"] = [build_paramDict(value)]
+            else:
+                overrides[col] = [value]
+
+        paramDict = paramTable_toDict(
+            pd.DataFrame(OrderedDict(list(functionOverrides.items()) + list(overrides.items()))),
+            defaultDict=copy.deepcopy(defaultDict),
+        )
+
+        scenario = row["scenario"] if "scenario" in sweepTable.columns else rowInd
+        days = total_days
+        if "days" in sweepTable.columns and not pd.isna(row["days"]):
+            days = int(row["days"])
+
+        scenarios.append((scenario, days, paramDict))
+
+    if len(set(scenario for scenario, _, _ in scenarios)) < len(scenarios):
+        raise ValueError("sweepTable_toParamDicts: the scenario names are not unique")
+
+    return scenarios
+
+
+def sweep_workerInit(blasThreads):
+    """
+    Limits the number of threads of the BLAS / OpenMP libraries already loaded in a sweep worker process
+    (the workers already run in parallel), if threadpoolctl is available (see sweep_pool)
+    """
+    try:
+        import threadpoolctl
+    except ImportError:
+        return
+
+    # Keep a reference, the limits are reverted when the controller is garbage collected
+    global sweep_threadpoolLimits
+    sweep_threadpoolLimits = threadpoolctl.threadpool_limits(limits=blasThreads)
+
+
+def sweep_runScenario(scenarioTask):
+    """
+    Simulates a single scenario, returns (scenario, output DataFrame, None), or (scenario, None, error message) if it failed
+    """
+    scenario, days, stateTensor_init, paramDict, solverSettings, prefixCache = scenarioTask
+
+    try:
+        if prefixCache is None:
+            result = solveSystem(stateTensor_init, days, **solverSettings, **paramDict)
+        else:
+            result = solveSystem_cached(stateTensor_init, days, prefixCache, **solverSettings, **paramDict)
+        df = clean_df(array_to_df(days, result), paramDict["realStartDate"])
+    except Exception as e:
+        return scenario, None, f"{type(e).__name__}: {e}"
+
+    df.insert(0, "scenario", scenario)
+
+    return scenario, df, None
+
+
+def sweep_pool(nWorkers, blasThreads=1):
+    """
+    Returns a pool of nWorkers worker processes, each using at most blasThreads BLAS threads
+    """
+    # Forked workers inherit the loaded inputs and precomputed operators (spawn, where fork is not available, reloads them)
+    startMethod = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    mpContext = multiprocessing.get_context(startMethod)
+
+    # The thread limits of the environment only apply to the libraries loaded after it is set: in spawned workers,
+    # which load them anew, but forked workers inherit the already loaded ones, only threadpoolctl can limit those
+    if startMethod == "fork" and importlib.util.find_spec("threadpoolctl") is None:
+        warnings.warn(
+            f"sweep_pool: threadpoolctl is not installed, the BLAS libraries of the workers can not be limited to {blasThreads} threads"
+        )
+
+    savedEnviron = {var: os.environ.get(var) for var in sweepBlasThreadVars}
+    os.environ.update({var: str(blasThreads) for var in sweepBlasThreadVars})
+    try:
+        return mpContext.Pool(nWorkers, initializer=sweep_workerInit, initargs=(blasThreads,))
+    finally:
+        for var, value in savedEnviron.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+
+
+def sweep_imapUnordered(func, tasks, nWorkers=None, blasThreads=1, pool=None):
+    """
+    Yields func(task) for all tasks in the order they finish, computed in a pool of nWorkers processes (default: number of CPUs),
+    each using at most blasThreads BLAS threads (or in the given sweep_pool). The workers take the next task whenever they finish one.
+    """
+    if pool is not None:
+        for result in pool.imap_unordered(func, tasks, chunksize=1):
+            yield result
+        return
+
+    if nWorkers is None:
+        nWorkers = os.cpu_count() or 1
+    nWorkers = max(min(nWorkers, len(tasks)), 1)
+
+    if nWorkers == 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    with sweep_pool(nWorkers, blasThreads) as pool:
+        for result in pool.imap_unordered(func, tasks, chunksize=1):
+            yield result
+
+
+def run_sweep(
+    sweepTable,
+    defaultDict,
+    total_days,
+    nWorkers=None,
+    blasThreads=1,
+    prefixCache=None,
+    model=None,
+    verbose=False,
+    **solverSettings,
+):
+    """
+    Runs all scenarios of the sweepTable (see sweepTable_toParamDicts) in a pool of nWorkers processes (default: number of CPUs),
+    each using at most blasThreads BLAS threads, resumed from the prefixCache if given (see solveSystem_cached).
+    The scenarios start from the initial state of the model defaultDict belongs to (default: of the default data dir).
+    Returns the outputs of the scenarios (as clean_df) concatenated, with the scenario in the first column.
+    solverSettings are passed to solveSystem (eg. one of solverPresets). Prints the progress if verbose
+    """
+    stateTensor_init = (load_inputs() if model is None else model.inputs)["stateTensor_init"]
+    scenarioTasks = [
+        (scenario, days, stateTensor_init, paramDict, solverSettings, prefixCache)
+        for scenario, days, paramDict in sweepTable_toParamDicts(
+            sweepTable, defaultDict, total_days
+        )
+    ]
+    scenarioOrder = [task[0] for task in scenarioTasks]
+
+    # The workers take the next scenario whenever they finish one,
+    # start with the longest ones so that they don't end up running alone at the end
+    scenarioTasks.sort(key=lambda task: task[1], reverse=True)
+
+    results = {}
+    for scenario, df, error in sweep_imapUnordered(
+        sweep_runScenario, scenarioTasks, nWorkers, blasThreads
+    ):
+        if error is not None:
+            warnings.warn(f"run_sweep: scenario {scenario} failed: {error}")
+        else:
+            results[scenario] = df
+        if verbose:
+            print(f"Scenario {scenario} done ({len(results)}/{len(scenarioTasks)} succeeded)")
+
+    if len(results) == 0:
+        raise RuntimeError("run_sweep: all scenarios failed")
+
+    return pd.concat(
+        [results[scenario] for scenario in scenarioOrder if scenario in results],
+        ignore_index=True,
+    )
+
+
+# ## Scenario trees
+#
+# Scenarios that only differ in their time-dependent inputs (the policy dates, eg. when social distancing stops, and
+# the test capacity and real testing data, see paramDict_dayInputs) simulate the same trajectory until the first day
+# these inputs differ on. run_scenarioTree simulates such a shared prefix once: the scenarios are
+# arranged in a tree, each branching from the scenario it shares the longest prefix with, at the day they diverge.
+# Each scenario is simulated from the checkpoint of its parent at that day (see solveSystem_stream), including
+# the days of the solver step that reached it, so its output is identical to simulating it in full.
+
+# Parameters in trFunc_testing_params only used through the testing calendar
+testingCalendarParams = [
+    "trFunc_testCapacity",
+    "trFunc_testCapacity_params",
+    "inpFunc_realData_testCapacity",
+    "inpFunc_realData_testCapacity_params",
+]
+
+ScenarioBranch = namedtuple(
+    "ScenarioBranch",
+    [
+        "parent",  # index of the scenario branched from (None for a scenario simulated in full)
+        "day",  # day the scenario is simulated from (0 if simulated in full)
+    ],
+)
+
+
+def paramDict_dayInputs(paramDict, total_days):
+    """
+    Array (total_days x nInputs) of the time-dependent inputs of dydt_Complete on the days 0 ... total_days - 1:
+    the policy flags (see policyCalendar_flags), the tests available of each type and the real testing data
+    (see testingCalendar)
+    """
+    policies = paramDict_policyCalendar(paramDict)
+    testing = testingCalendar(total_days - 1, paramDict["realStartDate"], **paramDict["trFunc_testing_params"])
+
+    return np.column_stack(
+        [np.array([policyCalendar_flags(policies, day) for day in range(total_days)], dtype=float).reshape(-1, 3)]
+        + [testing.testsAvailable[testType][:total_days] for testType in sorted(testing.testsAvailable)]
+        + [testing.realDataAvailable[:total_days], testing.realData[:total_days]]
+    )
+
+
+def paramDict_staticKey(paramDict):
+    """
+    Fingerprint of the parameters other than those only used through paramDict_dayInputs
+    """
+    staticParams = {key: value for key, value in paramDict.items() if key not in policyDateParams}
+    staticParams["trFunc_testing_params"] = {
+        key: value for key, value in paramDict["trFunc_testing_params"].items() if key not in testingCalendarParams
+    }
+
+    return paramDict_fingerprint(staticParams)
+
+
+def plan_scenarioTree(paramDicts, days):
+    """
+    Arranges the scenarios (paramDicts, simulated for days[i] days) in a tree, each branching from the scenario
+    it shares the longest prefix with: the first day their time-dependent inputs differ on, if only those differ.
+    Returns the order to simulate them in (parents first) and their ScenarioBranch.
+    """
+    # Only the time-dependent inputs differ between scenarios of the same static key, compare them per day
+    staticKeys = [paramDict_staticKey(paramDict) for paramDict in paramDicts]
+    dayInputs = [paramDict_dayInputs(paramDict, nDays) for paramDict, nDays in zip(paramDicts, days)]
+
+    def divergenceDay(ii, jj):
+        if staticKeys[ii] != staticKeys[jj]:
+            return 0
+        nDays = min(days[ii], days[jj])
+        differs = np.any(dayInputs[ii][:nDays] != dayInputs[jj][:nDays], axis=1)
+        return int(np.argmax(differs)) if np.any(differs) else nDays
+
+    # Maximum spanning tree of the divergence days (Prim's algorithm), the scenarios simulated in full as roots
+    branches = [None] * len(paramDicts)
+    order = []
+    best = OrderedDict((ii, (0, None)) for ii in range(len(paramDicts)))  # not yet in the tree: (day, parent)
+    while best:
+        ii = max(best, key=lambda jj: best[jj][0])
+        day, parent = best.pop(ii)
+        if day == 0:
+            branches[ii] = ScenarioBranch(None, 0)
+        else:
+            # The parent itself may only be simulated from day on, then branch from its ancestor
+            # (which has the same state on that day)
+            while branches[parent].parent is not None and branches[parent].day >= day:
+                parent = branches[parent].parent
+            branches[ii] = ScenarioBranch(parent, day)
+        order.append(ii)
+
+        for jj in best:
+            day = divergenceDay(ii, jj)
+            if day > best[jj][0]:
+                best[jj] = (day, ii)
+
+    return order, branches
+
+
+def run_scenarioTree(sweepTable, defaultDict, total_days, model=None, verbose=False, **solverSettings):
+    """
+    Runs all scenarios of the sweepTable (see sweepTable_toParamDicts) as a scenario tree, in this process,
+    from the initial state of the model defaultDict belongs to (default: of the default data dir).
+    Returns the outputs of the scenarios (as clean_df) concatenated, with the scenario in the first column, as run_sweep.
+    solverSettings are passed to solveSystem_stream (eg. one of solverPresets). Prints the progress if verbose
+    """
+    scenarios, days, paramDicts = zip(*sweepTable_toParamDicts(sweepTable, defaultDict, total_days))
+    order, branches = plan_scenarioTree(paramDicts, days)
+
+    checkpointDays = [[] for _ in scenarios]
+    for ii, branch in enumerate(branches):
+        if branch.parent is not None and branch.day < days[ii]:
+            checkpointDays[branch.parent].append(branch.day)
+
+    stateTensor_init = (load_inputs() if model is None else model.inputs)["stateTensor_init"]
+    checkpoints = {}  # (scenario index, day) -> Checkpoint
+    results = {}  # scenario index -> state tensor
+    nSimulatedDays = 0
+    for ii in order:
+        parent, day = branches[ii]
+        if parent in results and day == days[ii]:
+            # The same as its parent on all its days
+            results[ii] = results[parent][..., :day].copy()
+            if verbose:
+                print(f"Scenario {scenarios[ii]} done, same as {scenarios[parent]} ({len(results)}/{len(scenarios)} succeeded)")
+            continue
+
+        resumeFrom = checkpoints.get((parent, day))
+        if parent is not None and (
+            parent not in results
+            or resumeFrom is None
+            or resumeFrom.evaluatedUntil >= day
+            or resumeFrom.solverState.get("t_old", 0.0) is None
+        ):
+            # The parent failed, or its solver had looked beyond day, or had not stepped yet since the start of its
+            # segment (the first step depends on where the segment ends, see solveSystem_stream)
+            parent, day, resumeFrom = None, 0, None
+        if resumeFrom is not None:
+            # The parameters only differ from day on, but the days of the step reaching it are simulated again
+            # (the checkpoint is checked against the parameters it is resumed with)
+            day = resumeFrom.stepFirstDay
+            resumeFrom = resumeFrom._replace(day=day, paramFingerprint=paramDict_fingerprint(paramDicts[ii]))
+
+        try:
+            stream = solveSystem_stream(
+                stateTensor_init,
+                days[ii] - day,
+                checkpointDays=checkpointDays[ii],
+                checkpointFile=lambda checkpoint, ii=ii: checkpoints.__setitem__((ii, checkpoint.day), checkpoint),
+                resumeFrom=resumeFrom,
+                **solverSettings,
+                **paramDicts[ii],
+            )
+            result = np.stack([stateTensor for _, stateTensor in stream], axis=-1)
+        except Exception as e:
+            warnings.warn(f"run_scenarioTree: scenario {scenarios[ii]} failed: {type(e).__name__}: {e}")
+            continue
+
+        if parent is not None:
+            result = np.concatenate([results[parent][..., :day], result], axis=-1)
+        results[ii] = result
+        nSimulatedDays += days[ii] - day
+        if verbose:
+            print(f"Scenario {scenarios[ii]} done, simulated from day {day} ({len(results)}/{len(scenarios)} succeeded)")
+
+    if len(results) == 0:
+        raise RuntimeError("run_scenarioTree: all scenarios failed")
+    if verbose:
+        print(f"Simulated {nSimulatedDays} of {sum(days)} scenario days")
+
+    dfs = []
+    for ii, scenario in enumerate(scenarios):
+        if ii in results:
+            df = clean_df(array_to_df(days[ii], results[ii]), paramDicts[ii]["realStartDate"])
+            df.insert(0, "scenario", scenario)
+            dfs.append(df)
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+# ## Prefix cache
+#
+# Runs with the same static parameters (see paramDict_staticKey), initial state and solver settings, whose time-dependent
+# inputs (see paramDict_dayInputs) agree before day d, have the same solver state before the first step looking at day d.
+# solveSystem_cached keeps such states on disk, as a Checkpoint and the states of the days before its step, keyed by
+# a fingerprint of everything they depend on (see prefixCache_keys), and resumes each run from the latest day it finds.
+# Re-running a scenario with a later policy change or test capacity, or for more days, only simulates the days after
+# its last cached day before the change. The least recently used entries are removed to keep the cache within its size.
+
+PrefixCache = namedtuple(
+    "PrefixCache",
+    [
+        "directory",  # folder of the cache entries (one file each)
+        "maxBytes",  # total size of the entries kept
+    ],
+)
+
+prefixCacheEveryDays = 30  # days between the entries added by a run (and its last day)
+prefixCacheMaxBytes = 2**30
+
+
+def open_prefixCache(directory, maxBytes=prefixCacheMaxBytes):
+    """
+    Returns the PrefixCache kept in directory (created if needed), of at most maxBytes
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    return PrefixCache(directory, maxBytes)
+
+
+@functools.lru_cache(maxsize=None)
+def prefixCache_codeVersion():
+    """
+    Fingerprint of this module's source: functions are fingerprinted by name, the cache must not outlive their code
+    """
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def prefixCache_keys(stateTensor_init, total_days, solverSettings, paramDict):
+    """
+    Keys of the cache entries of the days 0 ... total_days, the key of day d covering everything the solver state
+    before the first step looking at day d depends on: the inputs of paramDict_dayInputs only up to the day before
+    (entries of another SciPy version are not found, see check_checkpoint)
+    """
+    hasher = hashlib.sha1()
+    hasher.update(
+        paramDict_fingerprint(
+            [
+                prefixCache_codeVersion(),
+                scipy_version(),
+                stateTensor_init,
+                solverSettings,
+                paramDict_staticKey(paramDict),
+            ]
+        ).encode()
+    )
+    keys = [hasher.hexdigest()]
+    for dayInputs in paramDict_dayInputs(paramDict, total_days):
+        hasher.update(np.ascontiguousarray(dayInputs).tobytes())
+        keys.append(hasher.hexdigest())
+
+    return keys
+
+
+def prefixCache_entryFile(prefixCache, key):
+    return os.path.join(prefixCache.directory, f"{key}.pkl")
+
+
+def prefixCache_load(prefixCache, keys):
+    """
+    Returns (Checkpoint, states of the days before its stepFirstDay) of the latest day whose key is in the cache,
+    (None, None) if there is none
+    """
+    for day in range(len(keys) - 1, 0, -1):
+        filename = prefixCache_entryFile(prefixCache, keys[day])
+        try:
+            with open(filename, "rb") as f:
+                checkpoint, states = pickle.load(f)
+            os.utime(filename)  # most recently used
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # (also when evicted by another process meanwhile)
+            continue
+
+        return Checkpoint(**checkpoint), states
+
+    return None, None
+
+
+def prefixCache_store(prefixCache, key, checkpoint, states):
+    """
+    Adds the Checkpoint and the states of the days before its stepFirstDay to the cache, then removes the least recently
+    used entries until the cache is within its size
+    """
+    # Written to a temporary file first, so other processes sharing the cache never read a partial entry
+    filename = prefixCache_entryFile(prefixCache, key)
+    tempFilename = f"{filename}.{os.getpid()}.tmp"
+    with open(tempFilename, "wb") as f:
+        pickle.dump((checkpoint._asdict(), states), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tempFilename, filename)
+
+    entries = []
+    for name in os.listdir(prefixCache.directory):
+        if name.endswith(".pkl"):
+            try:
+                stat = os.stat(os.path.join(prefixCache.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    cacheBytes = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if cacheBytes <= prefixCache.maxBytes:
+            break
+        try:
+            os.remove(os.path.join(prefixCache.directory, name))
+        except FileNotFoundError:
+            pass
+        cacheBytes -= size
+
+
+def solveSystem_cached(
+    stateTensor_init,
+    total_days,
+    prefixCache,
+    cacheEveryDays=prefixCacheEveryDays,
+    samplesPerDay=np.inf,
+    solverMethod="RK23",
+    solverJacobian="analytic",
+    solverRtol=1e-3,
+    solverAtol=1e-3,
+    solverMaxStep=np.inf,
+    model=None,
+    **kwargs,
+):
+    """
+    As solveSystem, resumed from the latest day of the run found in the prefixCache.
+    The days after it that are multiples of cacheEveryDays, and the last day, are added to the cache
+    """
+    solverSettings = OrderedDict(
+        [
+            ("samplesPerDay", samplesPerDay),
+            ("solverMethod", solverMethod),
+            ("solverJacobian", solverJacobian),
+            ("solverRtol", solverRtol),
+            ("solverAtol", solverAtol),
+            ("solverMaxStep", solverMaxStep),
+        ]
+    )
+    if np.isinf(samplesPerDay) and solverMethod == "LSODA":
+        # No checkpoints (see solveSystem_stream)
+        return solveSystem(stateTensor_init, total_days, **solverSettings, model=model, **kwargs)
+
+    # The parameters solveSystem_stream runs with
+    paramDict = kwargs
+    stepContext = contextlib.nullcontext
+    if model is not None:
+        if stateTensor_init is None:
+            stateTensor_init = model.inputs["stateTensor_init"]
+        paramDict = dict(model.paramDict, **kwargs)
+        stepContext = functools.partial(model_context, model)
+
+    with stepContext():
+        keys = prefixCache_keys(stateTensor_init, total_days, solverSettings, paramDict)
+    resumeFrom, states = prefixCache_load(prefixCache, keys)
+
+    firstDay, cachedDay = 0, 0
+    if resumeFrom is not None:
+        # Resumed with the days of the step reaching the cached day (the checkpoint is checked against the parameters
+        # it is resumed with)
+        firstDay, cachedDay = resumeFrom.stepFirstDay, resumeFrom.day
+        resumeFrom = resumeFrom._replace(day=firstDay, paramFingerprint=paramDict_fingerprint(paramDict))
+
+    checkpoints = []
+    stream = solveSystem_stream(
+        stateTensor_init,
+        total_days - firstDay,
+        **solverSettings,
+        checkpointDays=[
+            day
+            for day in list(range(cacheEveryDays, total_days, cacheEveryDays)) + [total_days]
+            if day > cachedDay
+        ],
+        checkpointFile=checkpoints.append,
+        resumeFrom=resumeFrom,
+        model=model,
+        **kwargs,
+    )
+    result = [stateTensor for _, stateTensor in stream]  # (none if the cached step already reached the last day)
+    if resumeFrom is not None:
+        result = list(np.moveaxis(states, -1, 0)) + result
+    result = np.stack(result, axis=-1)
+
+    for checkpoint in checkpoints:
+        # Only states that did not look at the day, nor at where their segment ends in choosing its first step
+        # (an entry of the last day is thus also valid for longer runs)
+        if checkpoint.evaluatedUntil < checkpoint.day and checkpoint.solverState.get("t_old", 0.0) is not None:
+            prefixCache_store(
+                prefixCache, keys[checkpoint.day], checkpoint, result[..., : checkpoint.stepFirstDay].copy()
+            )
+
+    return result
+
+
+# ## Global sensitivity analysis
+#
+# Sobol (Saltelli design, Saltelli 2010 first order and Jansen total effect estimators) and Morris (elementary effects)
+# sensitivity indices of summary outputs of the simulation (sensitivitySummaries) to parameters of the flattened parameter
+# table (paramDict_toTable), each varied uniformly within a given range. Array parameters are multiplied by the sampled value
+# as a whole, or a single element is set if given as "<name>[<index>]".
+# The samples are simulated in parallel, in chunks of ensembleSize members run as one ensemble (see solveEnsemble),
+# so the operators precomputed for the parameters that are not varied are shared, and only the summary outputs are kept.
+
+
+def summary_hospitalised(result):
+    """
+    Number of infected people in hospital on each day, given the result of solveSystem (with debugReturnNewPerDay)
+    """
+    return np.sum(result[0, :, 1 : (nI + 1), 2], axis=(0, 1, 2))
+
+
+def summary_peakHospitalised(result):
+    return np.max(summary_hospitalised(result))
+
+
+def summary_timeToPeakHospitalised(result):
+    return float(np.argmax(summary_hospitalised(result)))
+
+
+def summary_cumulativeDeceased(result):
+    return np.sum(result[0, :, -1, ..., -1])
+
+
+# Summary outputs available for the sensitivity analysis, functions of the result of solveSystem (with debugReturnNewPerDay)
+sensitivitySummaries = OrderedDict(
+    [
+        ("peakHospitalised", summary_peakHospitalised),
+        ("timeToPeakHospitalised", summary_timeToPeakHospitalised),
+        ("cumulativeDeceased", summary_cumulativeDeceased),
+    ]
+)
+
 
-    if debugTimestep:
-        print(t)
+def sensitivity_splitParamName(paramName):
+    """
+    Splits "<name>[<index>]" into (name, index), returns (paramName, None) if there is no index
+    """
+    if paramName.endswith("]") and "[" in paramName:
+        name, index = paramName[:-1].rsplit("[", 1)
+        return name, int(index)
 
-    # Initialise return
-    if (
-        debugReturnNewPerDay
-    ):  # the input has 2 copies of the state tensor, second copy being the cumulative incomings
-        stateTensor = np.reshape(stateTensor_flattened, [2, nAge, nHS, nIso, nTest])[0]
-    else:
-        stateTensor = np.reshape(stateTensor_flattened, [nAge, nHS, nIso, nTest])
+    return paramName, None
 
-    dydt = np.zeros_like(stateTensor)
 
-    # Initialise the full transition tensor
-    trTensor_complete = np.zeros((nAge, nHS, nIso, nTest, nHS, nIso, nTest))
+def sensitivity_paramDicts(defaultDict, paramNames, paramValues):
+    """
+    Returns copies of defaultDict with the parameters paramNames set to each row of paramValues (see above)
+    """
+    defaultTable = paramDict_toTable(defaultDict)
+
+    paramDicts = []
+    for values in paramValues:
+        overrides = OrderedDict()
+        for paramName, value in zip(paramNames, values):
+            name, index = sensitivity_splitParamName(paramName)
+            curValue = overrides[name][0] if name in overrides else defaultTable.at[0, name]
+
+            if index is not None:
+                curValue = np.array(curValue, dtype=float)
+                curValue[index] = value
+            elif isinstance(curValue, np.ndarray):
+                curValue = curValue * value
+            elif isinstance(curValue, numbers.Integral):
+                curValue = int(round(value))
+            else:
+                curValue = float(value)
+
+            overrides[name] = [curValue]
 
-    # Disease condition updates
-    # ---------------------------
-    trTensor_diseaseProgression = trFunc_diseaseProgression(
-        **kwargs["trFunc_diseaseProgression_params"]
+        paramDicts.append(
+            paramTable_toDict(pd.DataFrame(overrides), defaultDict=copy.deepcopy(defaultDict))
+        )
+
+    return paramDicts
+
+
+def sensitivity_sampleSobol(nParams, nSamples, seed=None):
+    """
+    Saltelli design in the unit cube: the nSamples x nParams matrices A, B, then AB_1, ..., AB_nParams
+    (A with column i taken from B), stacked into (nParams + 2) * nSamples rows
+    """
+    baseSamples = stats.qmc.Sobol(d=2 * nParams, scramble=True, seed=seed).random(nSamples)
+    A, B = baseSamples[:, :nParams], baseSamples[:, nParams:]
+
+    AB = np.repeat(A[np.newaxis], nParams, axis=0)
+    for paramInd in range(nParams):
+        AB[paramInd, :, paramInd] = B[:, paramInd]
+
+    return np.concatenate([A, B, AB.reshape(-1, nParams)], axis=0)
+
+
+def sensitivity_sobolIndices(outputs, nParams, nBootstrap=100, seed=None):
+    """
+    First order (S1) and total (ST) Sobol indices of each parameter, and their 95% bootstrap confidence intervals,
+    given the outputs of the samples of sensitivity_sampleSobol
+    """
+    nSamples = len(outputs) // (nParams + 2)
+    # Centering doesn't change the expected value of the estimators, but reduces their variance
+    outputs = outputs - np.mean(outputs[: 2 * nSamples])
+    fA = outputs[:nSamples]
+    fB = outputs[nSamples : 2 * nSamples]
+    fAB = np.reshape(outputs[2 * nSamples :], (nParams, nSamples))
+
+    def sobolIndices(sampleInds):
+        with np.errstate(divide="ignore", invalid="ignore"):  # constant outputs have no sensitivity indices
+            variance = np.var(np.concatenate([fA[sampleInds], fB[sampleInds]]))
+            S1 = np.mean(fB[sampleInds] * (fAB[:, sampleInds] - fA[sampleInds]), axis=1) / variance
+            ST = 0.5 * np.mean((fA[sampleInds] - fAB[:, sampleInds]) ** 2, axis=1) / variance
+        return S1, ST
+
+    S1, ST = sobolIndices(np.arange(nSamples))
+
+    rng = np.random.default_rng(seed)
+    bootstrap = np.array(
+        [sobolIndices(rng.integers(nSamples, size=nSamples)) for _ in range(nBootstrap)]
     )
+    S1_conf, ST_conf = 1.96 * np.std(bootstrap, axis=0)
 
-    # Get disease condition updates with no isolation or test transition ("diagonal along those")
-    for k1 in [0, 1, 2, 3]:
-        np.einsum("ijlml->ijlm", trTensor_complete[:, :, k1, :, :, k1, :])[
-            :
-        ] += np.expand_dims(
-            trTensor_diseaseProgression[:, :, k1, :], [2]
-        )  # all non-hospitalised disease progression is same
+    return OrderedDict([("S1", S1), ("S1_conf", S1_conf), ("ST", ST), ("ST_conf", ST_conf)])
 
-    # Compute new infections (0->1 in HS) with no isolation or test transition ("diagonal along those")
-    cur_policySocialDistancing = (
-        t >= (tStartSocialDistancing - realStartDate).days
-    ) * (t < (tStopSocialDistancing - realStartDate).days)
-    cur_policyImmunityPassports = (
-        t >= (tStartImmunityPassports - realStartDate).days
-    ) * (t < (tStopImmunityPassports - realStartDate).days)
-    np.einsum("iklkl->ikl", trTensor_complete[:, 0, :, :, 1, :, :])[
-        :
-    ] += trFunc_newInfections(
-        stateTensor,
-        policySocialDistancing=cur_policySocialDistancing,
-        policyImmunityPassports=cur_policyImmunityPassports,
-        **kwargs["trFunc_newInfections_params"],
+
+def sensitivity_sampleMorris(nParams, nTrajectories, nLevels=4, seed=None):
+    """
+    Morris design in the unit cube: nTrajectories random one-at-a-time trajectories of nParams + 1 points on a grid of nLevels,
+    stacked into nTrajectories * (nParams + 1) rows
+    """
+    rng = np.random.default_rng(seed)
+    delta = nLevels / (2.0 * (nLevels - 1))
+
+    trajectories = np.zeros((nTrajectories, nParams + 1, nParams))
+    for trajInd in range(nTrajectories):
+        point = rng.integers(nLevels, size=nParams) / (nLevels - 1)
+        trajectories[trajInd, 0] = point
+        for step, paramInd in enumerate(rng.permutation(nParams)):
+            point = point.copy()
+            point[paramInd] += delta if point[paramInd] + delta <= 1.0 else -delta
+            trajectories[trajInd, step + 1] = point
+
+    return np.reshape(trajectories, (-1, nParams))
+
+
+def sensitivity_morrisIndices(samples, outputs, nParams, nBootstrap=100, seed=None):
+    """
+    Mean (mu), mean absolute (mu_star) and standard deviation (sigma) of the elementary effects of each parameter
+    (per unit of the parameter range), and the 95% bootstrap confidence interval of mu_star,
+    given the samples of sensitivity_sampleMorris and their outputs
+    """
+    samples = np.reshape(samples, (-1, nParams + 1, nParams))
+    outputs = np.reshape(outputs, (-1, nParams + 1))
+    nTrajectories = len(samples)
+
+    # Each step of a trajectory changes a single parameter
+    stepSizes = np.diff(samples, axis=1)
+    changedParam = np.argmax(np.abs(stepSizes), axis=2)
+    trajInds = np.arange(nTrajectories)[:, np.newaxis]
+    elementaryEffects = np.zeros((nTrajectories, nParams))
+    elementaryEffects[trajInds, changedParam] = np.diff(outputs, axis=1) / np.take_along_axis(
+        stepSizes, changedParam[..., np.newaxis], axis=2
+    )[..., 0]
+
+    rng = np.random.default_rng(seed)
+    bootstrap = np.array(
+        [
+            np.mean(np.abs(elementaryEffects[rng.integers(nTrajectories, size=nTrajectories)]), axis=0)
+            for _ in range(nBootstrap)
+        ]
     )
 
-    # Also add new infected from travelling of healthy people, based on time-within-simulation (this is correct with all (0,0) states, as tested or isolated people dont travel)
-    trTensor_complete[:, 0, 0, 0, 1, 0, 0] += trFunc_travelInfectionRate_ageAdjusted(
-        t, **kwargs["trFunc_travelInfectionRate_ageAdjusted_params"]
+    return OrderedDict(
+        [
+            ("mu", np.mean(elementaryEffects, axis=0)),
+            ("mu_star", np.mean(np.abs(elementaryEffects), axis=0)),
+            ("sigma", np.std(elementaryEffects, axis=0, ddof=1)),
+            ("mu_star_conf", 1.96 * np.std(bootstrap, axis=0)),
+        ]
     )
 
-    # Hospitalisation state updates
-    # -----------------------
 
-    # Hospitalisation and recovery rates
-    # We assume for now that these only depend on age and disease progression, not on testing state
-    # (TODO - update this given new policies)
+def sensitivity_runSamples(sampleTask):
+    """
+    Simulates a chunk of samples, returns (chunk index, nSamples x nSummaries outputs, None),
+    or (chunk index, None, error message) if it failed
+    """
+    chunkInd, stateTensor_init, defaultDict, paramNames, paramValues, total_days, summaries, solverSettings = sampleTask
 
-    # The disease and testing states don't change due to hospitalisation.
-    # Hospital staff is treated as already hospitalised from all aspects expect social mixing, should suffice for now
-    # TODO - Could try to devise a scheme in which hospital staff gets hospitalised and some recoveries from hospitalised state go back to hospital staff.
-    # TODO - same issue with hospital staff home isolating; that's probably more important question!
-    for k1 in [0, 1]:
-        np.einsum("ijljl->ijl", trTensor_complete[:, :, k1, :, :, 2, :])[
-            :
-        ] += np.expand_dims(
-            trFunc_HospitalAdmission(**kwargs["trFunc_HospitalAdmission_params"]), [2]
+    try:
+        paramDicts = sensitivity_paramDicts(defaultDict, paramNames, paramValues)
+        if len(paramDicts) > 1 and all(ensemble_supports(paramDict) for paramDict in paramDicts):
+            results = solveEnsemble(
+                stateTensor_init, total_days, build_ensemble(paramDicts, total_days), **solverSettings
+            )
+        else:
+            results = [
+                solveSystem(stateTensor_init, total_days, **solverSettings, **paramDict) for paramDict in paramDicts
+            ]
+
+        outputs = np.array(
+            [[sensitivitySummaries[summary](result) for summary in summaries] for result in results]
+        )
+    except Exception as e:
+        return chunkInd, None, f"{type(e).__name__}: {e}"
+
+    return chunkInd, outputs, None
+
+
+def run_sensitivity(
+    sensitivityParams,
+    defaultDict,
+    total_days,
+    method="sobol",
+    nSamples=64,
+    summaries=tuple(sensitivitySummaries),
+    nWorkers=None,
+    blasThreads=1,
+    ensembleSize=16,
+    seed=0,
+    model=None,
+    verbose=False,
+    **solverSettings,
+):
+    """
+    Global sensitivity analysis of the summaries (names in sensitivitySummaries) to the parameters in sensitivityParams,
+    a dict of parameter name -> (low, high) range (see above).
+    method "sobol" runs nSamples x (nParams + 2) simulations (nSamples should be a power of 2),
+    "morris" runs nSamples trajectories, nSamples x (nParams + 1) simulations.
+    Runs in a pool of nWorkers processes with blasThreads BLAS threads each (see sweep_imapUnordered),
+    ensembleSize samples at a time (1: separately with solveSystem). solverSettings are passed to the solver.
+    The simulations start from the initial state of the model defaultDict belongs to (default: of the default data dir).
+    Prints the progress if verbose.
+    Returns (samples, indices) DataFrames, samples has the parameter values and summary outputs of every simulation,
+    indices the sensitivity indices of each summary output and parameter.
+    """
+    paramNames = list(sensitivityParams)
+    nParams = len(paramNames)
+
+    defaultTable = paramDict_toTable(defaultDict)
+    for paramName in paramNames:
+        name, index = sensitivity_splitParamName(paramName)
+        if name not in defaultTable.columns:
+            raise ValueError(f"run_sensitivity: unknown parameter {name}")
+        defaultValue = defaultTable.at[0, name]
+        if isinstance(defaultValue, (bool, np.bool_)) or np.asarray(defaultValue).dtype.kind not in "iuf":
+            raise ValueError(f"run_sensitivity: {name} is not a numeric parameter")
+        if index is not None and not 0 <= index < np.size(defaultValue):
+            raise ValueError(f"run_sensitivity: {paramName} is out of range")
+    for summary in summaries:
+        if summary not in sensitivitySummaries:
+            raise ValueError(f"run_sensitivity: unknown summary {summary}, see sensitivitySummaries")
+
+    if method == "sobol":
+        unitSamples = sensitivity_sampleSobol(nParams, nSamples, seed=seed)
+    elif method == "morris":
+        unitSamples = sensitivity_sampleMorris(nParams, nSamples, seed=seed)
+    else:
+        raise ValueError(f"run_sensitivity: unknown method {method}, use 'sobol' or 'morris'")
+
+    paramRanges = np.array([sensitivityParams[paramName] for paramName in paramNames], dtype=float)
+    paramValues = paramRanges[:, 0] + unitSamples * (paramRanges[:, 1] - paramRanges[:, 0])
+
+    if solverSettings.get("solverMethod") in ["BDF", "Radau", "LSODA"]:
+        ensembleSize = 1  # solveEnsemble only supports explicit solvers
+
+    stateTensor_init = (load_inputs() if model is None else model.inputs)["stateTensor_init"]
+    sampleTasks = [
+        (
+            chunkInd,
+            stateTensor_init,
+            defaultDict,
+            paramNames,
+            paramValues[sampleInd : sampleInd + ensembleSize],
+            total_days,
+            list(summaries),
+            solverSettings,
         )
+        for chunkInd, sampleInd in enumerate(range(0, len(paramValues), ensembleSize))
+    ]
 
-    # Add recovery from hospital rates
-    # TODO - again here (for now) we assume all discharged people go back to "normal state" instead of home isolation, have to think more on this
-    np.einsum("ijljl->ijl", trTensor_complete[:, :, 2, :, :, 0, :])[
-        :
-    ] += np.expand_dims(
-        trFunc_HospitalDischarge(**kwargs["trFunc_HospitalDischarge_params"]), [2]
-    )
+    outputChunks = {}
+    for chunkInd, outputs, error in sweep_imapUnordered(
+        sensitivity_runSamples, sampleTasks, nWorkers, blasThreads
+    ):
+        if error is not None:
+            raise RuntimeError(f"run_sensitivity: simulating samples failed: {error}")
+        outputChunks[chunkInd] = outputs
+        if verbose:
+            print(f"Sensitivity samples done: {len(outputChunks)}/{len(sampleTasks)} chunks")
+
+    outputs = np.concatenate([outputChunks[chunkInd] for chunkInd in range(len(sampleTasks))], axis=0)
+
+    samples = pd.DataFrame(paramValues, columns=paramNames)
+    for summaryInd, summary in enumerate(summaries):
+        samples[summary] = outputs[:, summaryInd]
+
+    indices = []
+    for summaryInd, summary in enumerate(summaries):
+        if method == "sobol":
+            summaryIndices = sensitivity_sobolIndices(outputs[:, summaryInd], nParams, seed=seed)
+        else:
+            summaryIndices = sensitivity_morrisIndices(unitSamples, outputs[:, summaryInd], nParams, seed=seed)
+        indices.append(pd.DataFrame(OrderedDict([("output", summary), ("param", paramNames)], **summaryIndices)))
 
-    # Testing state updates
-    # ---------------------
+    return samples, pd.concat(indices, ignore_index=True)
 
-    # trFunc_testing returns a stateTensor x testStates output
-    #      after the policyFunc assigns tests that are evaluated according to testSpecifications
 
-    # Diagonal (no transitions) in age, health state and isolation state
-    # (for now, probably TODO: testing positive correlates with new hospitalisation!)
-    trTensor_testing = trFunc_testing(
-        stateTensor, t, realStartDate, **kwargs["trFunc_testing_params"]
+def load_sensitivityParams(filename):
+    """
+    Reads the parameters of the sensitivity analysis from a CSV file with columns param, low, high
+    """
+    paramTable = pd.read_csv(filename)
+
+    return OrderedDict(
+        (row.param, (row.low, row.high)) for row in paramTable.itertuples(index=False)
     )
 
-    np.einsum("ijkljkm->ijklm", trTensor_complete)[:] += trTensor_testing
 
-    # Quarantine policy
-    # ------------------
+# ## Calibration
+#
+# Fits inputs of sme_input.json / user_input.json (calibrationInputs) to observed daily numbers of COVID hospital admissions
+# and deaths, minimising the squared error of log(1 + daily number) summed over the observed days.
+# As in the sensitivity analysis, an input array is multiplied by the fitted value as a whole, or a single element
+# is fitted if given as "<name>[<index>]".
+# Candidate parameters are simulated in parallel in a pool of worker processes, with the losses of already evaluated points memoized.
+# The loss only grows day by day, so with differential evolution the simulation of a trial candidate is stopped as soon as
+# its partial loss exceeds the loss of the population member it would replace (the optimizer gets an infinite loss for it,
+# the partial loss is kept in the history). The other optimizers simulate every candidate to the end.
+
+# Inputs that can be calibrated, and which input file they are in
+calibrationInputs = OrderedDict(
+    [
+        ("transmissionInfectionStage", "sme_input"),
+        ("infToHospitalExtra", "sme_input"),
+        ("percent_admitted", "user_input"),
+        ("deaths_by_age", "user_input"),
+    ]
+)
 
-    # Check if policy is "on"
-    if (t >= (tStartQuarantineCaseIsolation - realStartDate).days) * (
-        t < (tStopQuarantineCaseIsolation - realStartDate).days
-    ):
-        # New quarantining only happens to people who are transitioning already from untested to virus positive state
-        # Therefore here we DO use non-diagonal transitions, and we
-        #     redistribute the transtion rates given the testing (which was previously assumed not to create transition in isolation state)
-        trTensor_complete = trFunc_quarantine(
-            trTensor_complete, t, trTensor_testing, **kwargs["trFunc_quarantine_params"]
-        )
+# Daily series that can be calibrated against
+calibrationSeries = ["admissions", "deaths"]
 
-    # Final corrections
-    # -----------------
 
-    # TODO: simulate aging and normal birth / death (not terribly important on these time scales, but should be quite simple)
+def calibration_applyInputs(paramDict, smeInput, userInput):
+    """
+    Sets the parameters of paramDict that are derived from the calibrationInputs, as done for the default parameters
+    from the input files (see the input parameter section at the top)
+    """
+    paramDict["trFunc_newInfections_params"]["transmissionInfectionStage"] = np.array(
+        smeInput["transmissionInfectionStage"]
+    )
+    paramDict["trFunc_HospitalAdmission_params"]["infToHospitalExtra"] = np.array(
+        smeInput["infToHospitalExtra"]
+    )
 
-    # Ensure that every "row" sums to 0 by adding to the diagonal (doesn't create new people out of nowhere)
-    # Extract (writable) diagonal array and subtract the "row"-sums for each initial state
-    np.einsum("ijkljkl->ijkl", trTensor_complete)[:] -= np.einsum(
-        "...jkl->...", trTensor_complete
+    agePopulationTotal = np.array(smeInput["agePopulationTotal"])
+    agePopulationRatio = agePopulationTotal / np.sum(agePopulationTotal)
+
+    totalCOVIDAdmitted_byAge = userInput["percent_admitted"] * agePopulationTotal
+    relativeAdmissionRisk = totalCOVIDAdmitted_byAge / agePopulationTotal
+    relativeAdmissionRisk /= np.mean(relativeAdmissionRisk)
+    relativeAdmissionRisk -= 1
+
+    relativeDeathRisk = userInput["deaths_by_age"] / agePopulationTotal
+    relativeDeathRisk /= np.mean(relativeDeathRisk)
+    relativeDeathRisk -= 1
+
+    paramDict["trFunc_HospitalAdmission_params"]["ageRelativeExtraAdmissionRiskToCovid"] = (
+        relativeAdmissionRisk * np.array(smeInput["riskOfAEAttandance_by_age"])
+    )
+    paramDict["trFunc_quarantine_params"]["symptomHospitalisedRate_ageAdjusted"] = np.clip(
+        adjustRatesByAge_KeepAverageRate(
+            0.3, ageRelativeAdjustment=relativeAdmissionRisk, agePopulationRatio=agePopulationRatio
+        ),
+        0.0,
+        1.0,
     )
+    paramDict["trFunc_diseaseProgression_params"]["caseFatalityRatioHospital_given_COVID_by_age"] = (
+        userInput["deaths_by_age"] / totalCOVIDAdmitted_byAge
+    )
+    paramDict["trFunc_diseaseProgression_params"]["relativeDeathRisk_given_COVID_by_age"] = relativeDeathRisk
 
-    # Compute the actual derivatives
-    dydt = np.einsum(
-        "ijkl,ijklmnp->imnp", stateTensor, trTensor_complete
-    )  # contract the HS axis, keep age
+    return paramDict
 
-    if debugReturnNewPerDay:
-        """
-        If this is true, instead of returning the real dydt,
-        return only the positive "incoming" number of people to each state, so we can track "new cases"
-        This needs some approximations, as follows:
-            1. Take the normal transition tensor (with rates potentially > 0)
-            2. From all states re-normalise the outgoing rates to sum at most to 1
-                (if they were less, keep it, if larger, then this represents
-                “in this day, all people will leave this state, in these ratios to these states”)
-            3. Multiply only these outgoing rates with the current state
-                (so the result wont keep the same number of people as normal,
-                but only represent the “new incomings” for each state)
-        """
 
-        trTensor_complete_newOnly = copy.deepcopy(trTensor_complete)
+def calibration_inputs(calibrationParams, paramValues, smeInput, userInput):
+    """
+    Returns copies of the (smeInput, userInput) input dicts with the calibrationParams set to paramValues
+    """
+    calibratedInputs = {"sme_input": copy.deepcopy(smeInput), "user_input": copy.deepcopy(userInput)}
+
+    for paramName, value in zip(calibrationParams, paramValues):
+        name, index = sensitivity_splitParamName(paramName)
+        inputDict = calibratedInputs[calibrationInputs[name]]
+        curValue = np.array(inputDict[name], dtype=float)
+        if index is None:
+            curValue = curValue * value
+        else:
+            curValue[index] = value
+        inputDict[name] = curValue.tolist()
 
-        # TODO - Think - this is probably unnecessary actually, artifically reduces "new" rates?
-        #         # Devide each row by the absolute diagonal rate (that is the sum of the row), but only if its larger than 1
-        #         trTensor_complete_newOnly /= (
-        #             np.expand_dims(
-        #                 np.clip(np.abs(np.einsum('ijkljkl->ijkl', trTensor_complete_newOnly)), a_min=1., a_max=np.inf),
-        #                 axis=[4,5,6]
-        #             )
-        #         )
+    return calibratedInputs["sme_input"], calibratedInputs["user_input"]
 
-        # Set the diagonals to zero (no preservation, no outgoing, will end up being the incoming only)
-        np.einsum("ijkljkl->ijkl", trTensor_complete_newOnly)[:] = 0.0
 
-        dydt_newOnly = np.einsum(
-            "ijkl,ijklmnp->imnp", stateTensor, trTensor_complete_newOnly
+def load_observedSeries(filename):
+    """
+    Reads the observed daily series from a csv file (first column the date in YYYY-MM-DD format,
+    then any of the calibrationSeries columns, empty cells are not observed), returns them as a DataFrame indexed by date
+    """
+    df = pd.read_csv(filename, sep=",")
+    df.index = pd.to_datetime(df.iloc[:, 0], format="%Y-%m-%d")
+    df = df.iloc[:, 1:].astype(float)
+
+    unknownSeries = [col for col in df.columns if col not in calibrationSeries]
+    if len(unknownSeries) > 0:
+        raise ValueError(f"{filename} has unknown series {unknownSeries}, expected any of {calibrationSeries}")
+    if df.index.duplicated().any():
+        raise ValueError(f"{filename} has more than one row for the same date")
+
+    return df.sort_index()
+
+
+def calibration_loss(
+    paramDict,
+    stateTensor_init,
+    observedDays,
+    observed,
+    lossThreshold=np.inf,
+    solverMethod="RK23",
+    solverRtol=1e-3,
+    solverAtol=1e-3,
+    solverMaxStep=np.inf,
+):
+    """
+    Simulates paramDict (with debugReturnNewPerDay) from stateTensor_init up to the last of observedDays, and returns
+    (loss, complete).
+    observed is the len(observedDays) x len(calibrationSeries) array of the observed daily numbers (NaN: not observed).
+    The days are simulated one by one with solve_ivpDays (same results as solveSystem), but stopped with complete=False
+    (and the partial loss) as soon as the loss of the days so far exceeds lossThreshold
+    """
+    lastDay = int(np.max(observedDays))
+    observedLog = np.log1p(observed)
+
+    # COVID admission rates, of infected people from isolation states 0 and 1
+    admissionRate = trFunc_HospitalAdmission(**paramDict["trFunc_HospitalAdmission_params"])[:, 1 : (nI + 1)]
+
+    def admissionsPerDay(stateTensor):
+        return np.sum(stateTensor[:, 1 : (nI + 1), :2] * admissionRate[..., np.newaxis, np.newaxis])
+
+    def dayLoss(day, stateTensor, prevStateTensor):
+        dayInds = np.nonzero(observedDays == day)[0]
+        if len(dayInds) == 0:
+            return 0.0
+        # The admissions of the day (from day - 1 to day): the admission rate integrated with the trapezoidal rule,
+        # the deaths: the change of the deceased
+        modelled = np.array(
+            [
+                0.5 * (admissionsPerDay(prevStateTensor) + admissionsPerDay(stateTensor)),
+                np.sum(stateTensor[:, -1]) - np.sum(prevStateTensor[:, -1]),
+            ]
         )
+        return np.nansum((np.log1p(np.maximum(modelled, 0.0)) - observedLog[dayInds[0]]) ** 2)
+
+    stateTensor = copy.deepcopy(stateTensor_init)
+    y0 = np.reshape(np.stack([stateTensor, stateTensor], axis=0), -1)
+
+    # Segmented at the policy switches, as solveSystem
+    days = solve_ivpDays(
+        lambda t, y: dydt_Complete(t, y, **paramDict),
+        y0,
+        lastDay + 1,
+        policyCalendar_switchDays(paramDict_policyCalendar(paramDict), lastDay + 2),
+        method=solverMethod,
+        rtol=solverRtol,
+        atol=solverAtol,
+        max_step=solverMaxStep,
+        **solveSystem_jacobianArgs(solverMethod, "analytic", paramDict),
+    )
 
-        dydt = np.stack([dydt, dydt_newOnly], axis=0)
+    loss = 0.0
+    for day, y in days:
+        prevStateTensor = stateTensor
+        stateTensor = np.reshape(y, (2,) + stateTensor_init.shape)[0]
+        if day == 0:  # no daily numbers on day 0
+            continue
+        loss += dayLoss(day, stateTensor, prevStateTensor)
 
-    if debugTransition:
-        return np.reshape(dydt, -1), trTensor_complete
+        if loss > lossThreshold:
+            days.close()
+            return loss, False
 
-    return np.reshape(dydt, -1)
+    return loss, True
 
 
-def solveSystem(stateTensor_init, total_days, samplesPerDay=np.inf, **kwargs):
-    # Run the simulation
-    if kwargs["debugReturnNewPerDay"]:  # Keep the second copy as well
-        cur_stateTensor = np.reshape(
-            np.stack(
-                [copy.deepcopy(stateTensor_init), copy.deepcopy(stateTensor_init)],
-                axis=0,
-            ),
-            -1,
+def calibration_evaluate(calibrationTask):
+    """
+    Computes the loss of a candidate, returns (candidate index, loss, complete, None),
+    or (candidate index, None, None, error message) if it failed
+    """
+    (
+        candidateInd,
+        paramValues,
+        lossThreshold,
+        calibrationParams,
+        defaultDict,
+        stateTensor_init,
+        smeInput,
+        userInput,
+        observedDays,
+        observed,
+        solverSettings,
+    ) = calibrationTask
+
+    try:
+        paramDict = calibration_applyInputs(
+            copy.deepcopy(defaultDict),
+            *calibration_inputs(calibrationParams, paramValues, smeInput, userInput),
         )
-    else:
-        # print("else 1")
-        cur_stateTensor = np.reshape(copy.deepcopy(stateTensor_init), -1)
-
-    if np.isinf(samplesPerDay):
-        # print("if 2")
-        # Run precise integrator - used for all simulations
-        out = integrate.solve_ivp(
-            fun=lambda t, y: dydt_Complete(t, y, **kwargs),
-            t_span=(0.0, total_days),
-            y0=cur_stateTensor,
-            method="RK23",
-            t_eval=range(total_days),
-            rtol=1e-3,  # default 1e-3
-            atol=1e-3,  # default 1e-6
+        loss, complete = calibration_loss(
+            paramDict, stateTensor_init, observedDays, observed, lossThreshold=lossThreshold, **solverSettings
         )
-        # print(out)
-        out = out.y
-
-    else:
-        # print("else 2")
-        # Run simple Euler method with given step size (1/samplesPerDay) for quickly investigating code behavior
-        deltaT = 1.0 / samplesPerDay
-        out = np.zeros((np.prod(stateTensor_init.shape), total_days))
+    except Exception as e:
+        return candidateInd, None, None, f"{type(e).__name__}: {e}"
+
+    return candidateInd, loss, complete, None
+
+
+def run_calibration(
+    calibrationParams,
+    observedSeries,
+    defaultDict,
+    smeInput=None,
+    userInput=None,
+    optimizer="differential_evolution",
+    maxiter=20,
+    earlyStop=True,
+    nWorkers=None,
+    blasThreads=1,
+    seed=0,
+    model=None,
+    verbose=False,
+    **solverSettings,
+):
+    """
+    Fits calibrationParams, a dict of calibrationInputs names -> (low, high) bounds (see above), to the observedSeries
+    (see load_observedSeries, dates relative to the realStartDate of defaultDict), starting from the smeInput and userInput inputs
+    (default: sme_input and user_input of the model defaultDict belongs to, by default of the default data dir),
+    simulated from the initial state of that model.
+    optimizer is "differential_evolution" (the candidates of each generation are evaluated in parallel),
+    "L-BFGS-B" (with parallel finite difference gradients), or a derivative-free method of scipy.optimize.minimize
+    (eg. "Nelder-Mead" or "Powell", evaluating one candidate at a time); maxiter is the maximum number of iterations.
+    If earlyStop, differential_evolution stops simulating a trial once it can no longer replace its population member.
+    Candidates are evaluated in a pool of nWorkers processes with blasThreads BLAS threads each (see sweep_pool),
+    solverSettings are passed to the ODE solver (see calibration_loss). Prints each new best loss if verbose.
+    Returns (calibrated smeInput, calibrated userInput, DataFrame of all evaluated candidates and their losses)
+    """
+    inputs = load_inputs() if model is None else model.inputs
+    if smeInput is None:
+        smeInput = inputs["sme_input"]
+    if userInput is None:
+        userInput = inputs["user_input"]
+    stateTensor_init = inputs["stateTensor_init"]
+
+    calibrationParams = OrderedDict(calibrationParams)
+    for paramName in calibrationParams:
+        name, index = sensitivity_splitParamName(paramName)
+        if name not in calibrationInputs:
+            raise ValueError(f"run_calibration: {name} can not be calibrated, see calibrationInputs")
+        curInput = (smeInput if calibrationInputs[name] == "sme_input" else userInput)[name]
+        if index is not None and not 0 <= index < len(curInput):
+            raise ValueError(f"run_calibration: {paramName} is out of range")
+
+    observedDays = np.array(
+        [date_toDayIndex(date, defaultDict["realStartDate"]) for date in observedSeries.index]
+    )
+    observed = np.full((len(observedDays), len(calibrationSeries)), np.nan)
+    for seriesInd, series in enumerate(calibrationSeries):
+        if series in observedSeries.columns:
+            observed[:, seriesInd] = observedSeries[series].values
+    inHorizon = observedDays >= 1
+    if not np.any(inHorizon):
+        raise ValueError("run_calibration: no observations after the start of the simulation")
+    observedDays, observed = observedDays[inHorizon], observed[inHorizon]
+
+    bounds = np.array([calibrationParams[paramName] for paramName in calibrationParams], dtype=float)
+
+    # Memoized losses, by the exact candidate values: (loss, complete)
+    lossCache = OrderedDict()
+    best = {"loss": np.inf, "paramValues": None}
+    if nWorkers is None:
+        nWorkers = os.cpu_count() or 1
+    pool = sweep_pool(nWorkers, blasThreads) if nWorkers > 1 else None
+
+    def evaluateCandidates(candidates, lossThresholds=None):
+        # lossThresholds: the loss the optimizer compares each candidate with, its simulation is stopped as soon as
+        # its loss exceeds it (None: all simulated to the end)
+        candidates = [np.clip(np.asarray(x, dtype=float), bounds[:, 0], bounds[:, 1]) for x in candidates]
+        keys = [x.tobytes() for x in candidates]
+        keyThresholds = {}  # (the same candidate may be given twice, with different thresholds)
+        for key, threshold in zip(keys, np.full(len(keys), np.inf) if lossThresholds is None else lossThresholds):
+            keyThresholds[key] = max(keyThresholds.get(key, -np.inf), threshold)
+
+        calibrationTasks = []
+        for candidateInd, (x, key) in enumerate(zip(candidates, keys)):
+            if key in lossCache:
+                loss, complete = lossCache[key]
+                # An early stopped loss is still valid if it exceeds the threshold
+                if complete or loss > keyThresholds[key]:
+                    continue
+            if key in keys[:candidateInd]:  # same candidate twice
+                continue
+            calibrationTasks.append(
+                (
+                    candidateInd,
+                    x,
+                    keyThresholds[key],
+                    list(calibrationParams),
+                    defaultDict,
+                    stateTensor_init,
+                    smeInput,
+                    userInput,
+                    observedDays,
+                    observed,
+                    solverSettings,
+                )
+            )
 
-        for tt in range(total_days * samplesPerDay):
-            if tt % samplesPerDay == 0:
-                out[:, int(tt / samplesPerDay)] = cur_stateTensor
+        for candidateInd, loss, complete, error in sweep_imapUnordered(
+            calibration_evaluate, calibrationTasks, nWorkers=1, pool=pool
+        ):
+            if error is not None:
+                warnings.warn(f"run_calibration: {candidates[candidateInd]} failed: {error}")
+                loss, complete = np.inf, True
+            lossCache[keys[candidateInd]] = (loss, complete)
+            if complete and loss < best["loss"]:
+                best["loss"], best["paramValues"] = loss, candidates[candidateInd]
+                if verbose:
+                    print(f"Calibration: new best loss {loss:.6g} at {candidates[candidateInd]}")
+
+        # Early stopped candidates are only known to be worse than their threshold, their partial loss is kept in lossCache
+        return np.array([loss if complete else np.inf for loss, complete in (lossCache[key] for key in keys)])
+
+    # The optimizers work on the parameters scaled to the unit cube by their bounds
+    def toParamValues(u):
+        return bounds[:, 0] + np.asarray(u) * (bounds[:, 1] - bounds[:, 0])
+
+    def objective(u):
+        return evaluateCandidates([toParamValues(u)])[0]
+
+    unitBounds = [(0.0, 1.0)] * len(bounds)
+
+    try:
+        # Start from the current inputs (multiplier 1, or the current value of single elements)
+        x0 = np.ones(len(bounds))
+        for paramInd, paramName in enumerate(calibrationParams):
+            name, index = sensitivity_splitParamName(paramName)
+            if index is not None:
+                x0[paramInd] = (smeInput if calibrationInputs[name] == "sme_input" else userInput)[name][index]
+        u0 = np.clip((x0 - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0]), 0.0, 1.0)
+
+        if optimizer == "differential_evolution":
+            # The solver of optimize.differential_evolution, whose population_energies are needed for the early stopping
+            from scipy.optimize._differentialevolution import DifferentialEvolutionSolver
+
+            def evaluateGeneration(func, candidates):
+                # Each generation is evaluated as one parallel batch. With deferred updating, the trials are in the order
+                # of the population members they replace if their loss is lower (the initial population: all inf)
+                return evaluateCandidates(
+                    [toParamValues(u) for u in candidates],
+                    lossThresholds=solver.population_energies[: len(candidates)] if earlyStop else None,
+                )
 
-            cur_stateTensor += deltaT * dydt_Complete(
-                (tt * 1.0) / (1.0 * samplesPerDay), cur_stateTensor, **kwargs
+            # (the seed argument is called rng from SciPy 1.15)
+            seedArg = "rng" if "rng" in inspect.signature(DifferentialEvolutionSolver).parameters else "seed"
+            solver = DifferentialEvolutionSolver(
+                objective,
+                unitBounds,
+                maxiter=maxiter,
+                polish=False,
+                updating="deferred",
+                workers=evaluateGeneration,
+                x0=u0,
+                **{seedArg: seed},
+            )
+            solver.solve()
+        elif optimizer == "L-BFGS-B":
+
+            def gradient(u):
+                # Forward differences, all evaluated in one parallel batch (never stopped early),
+                # with steps well above the error of the ODE solver
+                stepSize = 1e-3
+                losses = evaluateCandidates(
+                    [toParamValues(u)]
+                    + [toParamValues(u + stepSize * np.eye(len(u))[i]) for i in range(len(u))]
+                )
+                return (losses[1:] - losses[0]) / stepSize
+
+            optimize.minimize(
+                objective,
+                u0,
+                jac=gradient,
+                method="L-BFGS-B",
+                bounds=unitBounds,
+                options={"maxiter": maxiter},
+            )
+        else:
+            optimize.minimize(
+                objective, u0, method=optimizer, bounds=unitBounds, options={"maxiter": maxiter}
             )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    # Reshape to reasonable format
-    if kwargs["debugReturnNewPerDay"]:
-        out = np.reshape(out, (2,) + stateTensor_init.shape + (-1,))
-    else:
-        out = np.reshape(out, stateTensor_init.shape + (-1,))
+    if best["paramValues"] is None:
+        raise RuntimeError("run_calibration: no candidate could be evaluated")
 
-    return out
+    history = pd.DataFrame(
+        [np.frombuffer(key) for key in lossCache], columns=list(calibrationParams)
+    )
+    history["loss"] = [loss for loss, _ in lossCache.values()]
+    history["complete"] = [complete for _, complete in lossCache.values()]
 
-### df Clean up for folding on all states except Health States
-def array_to_df(total_days, result):
-    
-    reshape = 2*nAge*nHS*nIso*nTest*total_days
-    sim_days = [x+1 for x in range(total_days)]
-
-    iterables=[['current','new'],
-               ["0-9","10-19","20-29","30-39","40-49","50-59","60-69","70-79","80+"],
-               ["susceptible", "exposed", "asymptomatic", "infected1", "infected2", "recovered1", "recovered2", "deceased"],
-               ['distancing','quarantined','hospitalized','hospStaff'],
-               ["neg_noTest", "pos_test","pos_antibody", "pos_both"],
-               sim_days
-          ]
-    index = pd.MultiIndex.from_product(iterables, names=['arrivalType','ageGroup','healthState','isoState','testState','simDay'])
-
-    df = pd.DataFrame(result.reshape(reshape, 1),index=index).stack().reset_index().rename(columns={0: "value"})
-
-    #delete phantom column "level_6"
-    for col in df.columns.to_list():
-        if "level" in col:
-            del df[col]
-    
-    df = df.groupby(['simDay','arrivalType', 'ageGroup', 'healthState',], as_index=False)["value"].sum()
-    
-    return df
+    calibratedSmeInput, calibratedUserInput = calibration_inputs(
+        calibrationParams, best["paramValues"], smeInput, userInput
+    )
 
-# convert int simday to datetime
-def num_to_date(testingStartDate, simDay):
-    temp_date = testingStartDate + timedelta(days=simDay)
-    return str(temp_date.date())
+    return calibratedSmeInput, calibratedUserInput, history
 
-# call num_to_date and reorder columns
-def clean_df(df):
-    df['timestamp'] = df.simDay.apply(lambda x: num_to_date(testingStartDate, x)) 
 
-    ts = df['timestamp']
-    df.drop(labels=['timestamp'], axis=1,inplace = True)
-    df.insert(0, 'timestamp', ts)
+def save_calibratedInputs(smeInput, userInput, outDir, prefix=""):
+    """
+    Writes the (calibrated) inputs as <prefix>sme_input.json and <prefix>user_input.json into outDir
+    """
+    for inputName, inputDict in [("sme_input", smeInput), ("user_input", userInput)]:
+        with open(f"{outDir}/{prefix}{inputName}.json", "w") as jf:
+            json.dump(inputDict, jf, indent=4)
 
-    return df    
 
 if __name__ == "__main__":
 
+    parser = build_argParser()
+    args = parser.parse_args()
+
+    total_days = args.total_days
+    outfile = args.outfile
+
+    # Set Working/Data dirs
+    workdir = os.getcwd()
+    data_dir = f"{workdir}/{data_folder}"
+    print(data_dir)
+
+    model = build_model(data_dir)
+    stateTensor_init = model.inputs["stateTensor_init"]
+
     print("\n")
     start_it = datetime.now()
     print(f"Started at {start_it}")
     print("Running model...")
 
     # # Build a dictionary out of arguments with defaults
-    paramDict_default = build_paramDict(dydt_Complete)
+    paramDict_default = copy.deepcopy(model.paramDict)
     paramDict_default["dydt_Complete"] = dydt_Complete
     paramDict_default["INIT_stateTensor_init"] = stateTensor_init
 
     paramDict_current = copy.deepcopy(paramDict_default)
+    paramDict_current["transitionEngine"] = args.transitionEngine
+
+    # Checkpoints of a single run
+    checkpointArgs = dict(
+        checkpointDays=[] if args.checkpointDays is None else [int(day) for day in args.checkpointDays.split(",")],
+        checkpointFile=f"{workdir}/results/{os.path.splitext(outfile)[0]}_checkpoint_{{day}}.pkl",
+        resumeFrom=None if args.resumeFile is None else load_checkpoint(args.resumeFile),
+    )
+    firstDay = 0 if args.resumeFile is None else checkpointArgs["resumeFrom"].day  # first day of a single run
+
+    prefixCache = None
+    if args.cacheDir is not None:
+        if args.checkpointDays is not None or args.resumeFile is not None or args.streamOutput:
+            parser.error("-cache cannot be combined with -checkpoint, -resume or -stream")
+        prefixCache = open_prefixCache(args.cacheDir, maxBytes=int(args.cacheSize * 2**20))
+
+    result = None  # state tensor of a single run (for the npz format)
+    streamed = False  # the single run was written as it was simulated (-stream)
+    if args.tuneSolver:
+        # Compare solver settings instead of running the model, writes the comparison table
+        df = tune_solveSystem(stateTensor_init, total_days, **paramDict_current)
+
+        print("Pareto optimal solver settings:")
+        print(df[df["pareto"]].to_string())
+    elif args.observedFile is not None:
+        if args.calibrateParamsFile is None:
+            parser.error("-calibrate needs -calibrateParams")
+
+        # The evaluated candidates are written to the output file, the calibrated inputs next to it
+        calibratedSmeInput, calibratedUserInput, df = run_calibration(
+            load_sensitivityParams(args.calibrateParamsFile),
+            load_observedSeries(args.observedFile),
+            paramDict_current,
+            optimizer=args.optimizer,
+            maxiter=args.maxiter,
+            nWorkers=args.nWorkers,
+            blasThreads=args.blasThreads,
+            model=model,
+            verbose=True,
+            **solverPresets[args.solverPreset],
+        )
+        save_calibratedInputs(
+            calibratedSmeInput,
+            calibratedUserInput,
+            f"{workdir}/results",
+            prefix=os.path.splitext(outfile)[0] + "_",
+        )
+
+        print(df.sort_values("loss").head().to_string())
+    elif args.sensitivityFile is not None:
+        # Sensitivity indices of the summary outputs are written to the output file, the simulated samples next to it
+        samples, df = run_sensitivity(
+            load_sensitivityParams(args.sensitivityFile),
+            paramDict_current,
+            total_days,
+            method=args.sensitivityMethod,
+            nSamples=args.sensitivitySamples,
+            nWorkers=args.nWorkers,
+            blasThreads=args.blasThreads,
+            model=model,
+            verbose=True,
+            **solverPresets[args.solverPreset],
+        )
+        samplesFile = "{}_samples{}".format(*os.path.splitext(outfile))
+        save_output(f"{workdir}/results/{samplesFile}", samples, outputFormat=args.outputFormat)
+
+        print(df.to_string())
+    elif args.sweepFile is not None and args.scenarioTree:
+        # Run the scenarios of the table from the days they diverge on, writes their outputs as for the sweep
+        df = run_scenarioTree(
+            load_sweepTable(args.sweepFile),
+            paramDict_current,
+            total_days,
+            model=model,
+            verbose=True,
+            **solverPresets[args.solverPreset],
+        )
+
+        print(df.tail())
+    elif args.sweepFile is not None:
+        # Run all scenarios of the table in parallel, writes their outputs into one table keyed by scenario
+        df = run_sweep(
+            load_sweepTable(args.sweepFile),
+            paramDict_current,
+            total_days,
+            nWorkers=args.nWorkers,
+            blasThreads=args.blasThreads,
+            prefixCache=prefixCache,
+            model=model,
+            verbose=True,
+            **solverPresets[args.solverPreset],
+        )
+
+        print(df.tail())
+    elif args.regionsFile is not None:
+        # Simulate the coupled regions together, writes their outputs into one table keyed by region
+        regions, regionModels = load_regionsTable(args.regionsFile)
+        metapopulation = build_metapopulation(
+            regionModels,
+            total_days,
+            mobility=None if args.mobilityFile is None else load_mobility(args.mobilityFile, regions),
+            regions=regions,
+        )
+        df = metapopulation_toDf(
+            metapopulation,
+            solveMetapopulation(None, total_days, metapopulation, **solverPresets[args.solverPreset]),
+        )
+
+        print(df.tail())
+    elif args.streamOutput:
+        # Written as it is simulated, not kept in memory
+        streamed = True
+        save_streamedOutput(
+            f"{workdir}/results/{outfile}",
+            solveSystem_stream(
+                stateTensor_init,
+                total_days,
+                **solverPresets[args.solverPreset],
+                **paramDict_current,
+                **checkpointArgs,
+                model=model,
+            ),
+            total_days,
+            paramDict_current["realStartDate"],
+            outputFormat=args.outputFormat,
+            paramDict=paramDict_current,
+        )
+    elif prefixCache is not None:
+        # Resumed from the latest cached day of the same run
+        result = solveSystem_cached(
+            stateTensor_init,
+            total_days,
+            prefixCache,
+            **solverPresets[args.solverPreset],
+            **paramDict_current,
+            model=model,
+        )
 
-    result = solveSystem(stateTensor_init, total_days, **paramDict_current)
+        df = clean_df(array_to_df(total_days, result), paramDict_current["realStartDate"])
 
-    df = clean_df(array_to_df(total_days, result))
+        print(df.tail())
+    else:
+        result = solveSystem(
+            stateTensor_init,
+            total_days,
+            **solverPresets[args.solverPreset],
+            **paramDict_current,
+            **checkpointArgs,
+            model=model,
+        )
 
-    print(df.tail())
-    df.to_csv(f"{workdir}/results/{outfile}", index=False)
+        df = clean_df(array_to_df(total_days, result, firstDay=firstDay + 1), paramDict_current["realStartDate"])
+
+        print(df.tail())
+    if not streamed:
+        save_output(
+            f"{workdir}/results/{outfile}",
+            df,
+            result=result,
+            realStartDate=paramDict_current["realStartDate"],
+            outputFormat=args.outputFormat,
+            paramDict=paramDict_current,
+            firstDay=firstDay + 1,
+        )
     
     end_it = datetime.now()
     print(f"Runtime = {end_it-start_it}")